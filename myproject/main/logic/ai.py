@@ -1,10 +1,28 @@
 import os
 import json
+import functools
 import google.generativeai as genai
+from django.conf import settings
 from dotenv import load_dotenv
 import logging
-from pathlib import Path
+import random
+from contextlib import contextmanager
+import threading
 import time
+from concurrent.futures import CancelledError, as_completed
+
+from .backends import RateLimited, get_backend
+from .derivatives import make_derivatives
+from .context import context_json, prepare_prompt
+from .edits import build_dependency_index, merge_story_patch, scenes_sharing_entities
+from .image_cache import ImageCache
+from .metrics import registry, span
+from .prompts import get_prompt_expander
+from .ratelimit import SharedRateLimiter
+from .scheduler import SPECULATIVE, VISIBLE, ImageScheduler
+from .storage import content_name, get_storage
+from .store import Superseded
+from .text_cache import TextCache
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +33,129 @@ api_key = os.getenv("GEMINI_API_KEY")
 # Configure Gemini
 genai.configure(api_key=api_key)
 
+IMAGE_MODEL = "gemini-3-pro-image-preview"
+IMAGE_ASPECT_RATIO = "9:16"
+
+# Text model tiers. Rewriting one paragraph or brainstorming ideas doesn't
+# need pro; anything that restructures the story does.
+MODEL_TIERS = {
+    'fast': os.getenv("TEXT_MODEL_FAST", "models/gemini-2.5-flash"),
+    'pro': os.getenv("TEXT_MODEL_PRO", "models/gemini-2.5-pro"),
+}
+
+# Scene image concurrency: how many image calls this process may have in flight
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", "6"))
+IMAGE_REQUESTS_PER_MINUTE = float(os.getenv("IMAGE_REQUESTS_PER_MINUTE", "60"))
+
+# Text calls likewise; 0 leaves them unlimited. The web app's text calls are
+# already bounded by its request and story job workers, batch_generate's are not.
+TEXT_MAX_CONCURRENCY = int(os.getenv("TEXT_MAX_CONCURRENCY", "0"))
+text_slots = threading.BoundedSemaphore(TEXT_MAX_CONCURRENCY) if TEXT_MAX_CONCURRENCY > 0 else None
+
+# Each model's quota in requests per minute, shared by every process on the
+# host through RATE_LIMIT_DB (see SharedRateLimiter); 0 only honours 429s
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", str(settings.BASE_DIR / "rate_limits.sqlite3"))
+MODEL_REQUESTS_PER_MINUTE = {
+    MODEL_TIERS['pro']: float(os.getenv("TEXT_MODEL_PRO_RPM", "150")),
+    MODEL_TIERS['fast']: float(os.getenv("TEXT_MODEL_FAST_RPM", "1000")),
+    IMAGE_MODEL: IMAGE_REQUESTS_PER_MINUTE,
+}
+model_rate_limiters = {
+    model: SharedRateLimiter(RATE_LIMIT_DB, model, rpm, burst=IMAGE_MAX_CONCURRENCY if model == IMAGE_MODEL else max(1, TEXT_MAX_CONCURRENCY))
+    for model, rpm in MODEL_REQUESTS_PER_MINUTE.items()
+}
+image_rate_limiter = model_rate_limiters[IMAGE_MODEL]
+
+# 429s a call may wait out before giving up; they don't use up its ordinary retries
+RATE_LIMITED_MAX_RETRIES = int(os.getenv("RATE_LIMITED_MAX_RETRIES", "6"))
+
+# Which tier each operation uses. Override per operation with e.g.
+# MODEL_TIER_OVERRIDES="narrationGenerate=pro,PromptGenerate=fast"
+OPERATION_TIERS = {
+    'suggestionGenerate': 'fast',
+    'narrationGenerate': 'fast',
+    'storyGenerate': 'pro',
+    'storylineGenerate': 'pro',
+    'characterGenerate': 'pro',
+    'locationGenerate': 'pro',
+    'PromptGenerate': 'pro',
+}
+
+
+def apply_tier_overrides(operation_tiers, overrides):
+    """
+    Set the tiers in a MODEL_TIER_OVERRIDES string ("call=tier,...") on
+    operation_tiers. An unknown tier or operation (likely a typo) raises
+    ValueError rather than being ignored.
+    """
+    for override in filter(None, overrides.split(",")):
+        operation, tier = (part.strip() for part in override.split("=", 1))
+        if tier not in MODEL_TIERS:
+            raise ValueError(f"Unknown model tier {tier!r} for {operation}")
+        if operation not in operation_tiers:
+            raise ValueError(f"Unknown operation {operation!r} in MODEL_TIER_OVERRIDES")
+        operation_tiers[operation] = tier
+    return operation_tiers
+
+
+apply_tier_overrides(OPERATION_TIERS, os.getenv("MODEL_TIER_OVERRIDES", ""))
+
+# USD per million (input, output) tokens, for the cost metric
+TIER_PRICES = {
+    'fast': (float(os.getenv("TEXT_MODEL_FAST_INPUT_PRICE", "0.30")), float(os.getenv("TEXT_MODEL_FAST_OUTPUT_PRICE", "2.50"))),
+    'pro': (float(os.getenv("TEXT_MODEL_PRO_INPUT_PRICE", "1.25")), float(os.getenv("TEXT_MODEL_PRO_OUTPUT_PRICE", "10.00"))),
+}
+
+# Any repeat (model, aspect ratio, enhanced prompt) is served from disk
+image_cache = ImageCache(
+    os.getenv("IMAGE_CACHE_DIR", str(settings.BASE_DIR / "image_cache")),
+    max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(500 * 1024 * 1024))),
+    max_entries=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "2000")),
+)
+
+# Text responses can be reused too, but only where it is safe: see
+# TEXT_CACHE_POLICIES. Off unless TEXT_CACHE=1.
+TEXT_CACHE_ENABLED = os.getenv("TEXT_CACHE", "0") == "1"
+text_cache = TextCache(
+    os.getenv("TEXT_CACHE_DIR", str(settings.BASE_DIR / "text_cache")),
+    max_bytes=int(os.getenv("TEXT_CACHE_MAX_BYTES", str(50 * 1024 * 1024))),
+    max_entries=int(os.getenv("TEXT_CACHE_MAX_ENTRIES", "5000")),
+)
+
+# Per operation: seconds a cached response stays usable (0: never cached),
+# and whether it is only cached when the caller passes a seed. Fresh-start
+# generation is creative, so the same idea gets a new story unless a seed
+# asks for a repeatable one. A seed only names a cached variant: the text
+# SDK's GenerationConfig has no seed field, so the model never sees it.
+# Edits are keyed on the story they edit, so a hit is a double-submitted or
+# resubmitted form. Override the TTL with e.g.
+# TEXT_CACHE_TTLS="narrationGenerate=0,storylineGenerate=3600"
+TEXT_CACHE_POLICIES = {
+    'suggestionGenerate': {'ttl': 24 * 60 * 60, 'seeded_only': True},
+    'storyGenerate': {'ttl': 24 * 60 * 60, 'seeded_only': True},
+    'storylineGenerate': {'ttl': 15 * 60, 'seeded_only': False},
+    'characterGenerate': {'ttl': 15 * 60, 'seeded_only': False},
+    'locationGenerate': {'ttl': 15 * 60, 'seeded_only': False},
+    'narrationGenerate': {'ttl': 15 * 60, 'seeded_only': False},
+    'PromptGenerate': {'ttl': 15 * 60, 'seeded_only': False},
+}
+
+
+def apply_text_cache_ttls(policies, overrides):
+    """Set the TTLs in a TEXT_CACHE_TTLS string ("call=seconds,...") on policies, adding unseeded policies for new calls."""
+    for override in filter(None, overrides.split(",")):
+        operation, ttl = (part.strip() for part in override.split("=", 1))
+        policies.setdefault(operation, {'seeded_only': False})['ttl'] = int(ttl)
+    return policies
+
+
+apply_text_cache_ttls(TEXT_CACHE_POLICIES, os.getenv("TEXT_CACHE_TTLS", ""))
+
+# Every scene image in this process goes through one priority queue
+image_scheduler = ImageScheduler(IMAGE_MAX_CONCURRENCY)
+
+FALLBACK_IMAGE = "main/images/exampleImage.png"
+
 
 story_schema = {
     "type": "object",
@@ -72,7 +213,153 @@ story_schema = {
     "required": ["storyline", "persona_description", "setting_description", "scenes"]
 }
 
-def suggestionGenerate():
+# Edits ask for only the parts of the story they touch. Every field is
+# optional; omitted parts are left as they are.
+story_patch_schema = {
+    "type": "object",
+    "properties": {
+        "storyline": story_schema["properties"]["storyline"],
+        "persona_description": story_schema["properties"]["persona_description"],
+        "setting_description": story_schema["properties"]["setting_description"],
+        "scenes": story_schema["properties"]["scenes"],
+    },
+    "required": ["scenes"]
+}
+
+suggestion_schema = {
+    "type": "object",
+    "properties": {
+        "suggestions": {
+            "type": "array",
+            "items": {"type": "string"}
+        }
+    },
+    "required": ["suggestions"]
+}
+
+def route_model(call):
+    """Return (tier, model name) for an operation listed in OPERATION_TIERS."""
+    tier = OPERATION_TIERS.get(call)
+    if tier is None:
+        raise ValueError(f"No model tier for {call!r}; add it to OPERATION_TIERS")
+    return tier, MODEL_TIERS[tier]
+
+def rate_limited_wait(error, attempt):
+    """
+    Seconds to pause a model after a 429: the API's Retry-After hint, else
+    exponential backoff with full jitter so callers don't retry in lockstep.
+    """
+    if error.retry_after is not None:
+        return error.retry_after
+    return random.uniform(0, min(60, 2 ** (attempt + 1)))
+
+@contextmanager
+def text_slot(model_name):
+    """Hold one of the text_slots for a text call, paced by the model's rate limiter."""
+    slots = text_slots
+    limiter = model_rate_limiters.get(model_name)
+    with span("text_rate_limit_wait"):
+        if slots is not None:
+            slots.acquire()
+        try:
+            if limiter is not None:
+                limiter.acquire()
+        except BaseException:
+            # e.g. the shared quota database stayed locked: don't keep the slot
+            if slots is not None:
+                slots.release()
+            raise
+    try:
+        yield
+    finally:
+        if slots is not None:
+            slots.release()
+
+def text_cache_ttl(call, seed=None):
+    """Seconds call's responses may be reused for under TEXT_CACHE_POLICIES, or 0 when they aren't cached."""
+    policy = TEXT_CACHE_POLICIES.get(call)
+    if not TEXT_CACHE_ENABLED or policy is None or (policy['seeded_only'] and seed is None):
+        return 0
+    return policy['ttl']
+
+def generate_text(prompt, call, schema=None, seed=None):
+    """
+    Send a prompt to the model tier routed for call.
+
+    Latency, tokens and estimated cost are recorded per tier: see
+    story_stage_seconds{stage="text_model"} and model_cost_usd_total in /metrics.
+    Where call's cache policy allows, an identical earlier request (same
+    model, schema, prompt and seed) is answered from text_cache instead;
+    hits and misses are counted in text_cache_total. seed is only part of
+    the cache key and is not sent to the model, so a miss is an ordinary,
+    unseeded generation.
+    """
+    tier, model_name = route_model(call)
+    with span("prompt_build", call=call):
+        prompt = prepare_prompt(call, prompt)
+
+    ttl = text_cache_ttl(call, seed)
+    if ttl:
+        cache_key = TextCache.make_key(model_name, schema, prompt, seed)
+        with span("text_cache", call=call):
+            cached = text_cache.get_text(cache_key, ttl)
+        registry.inc('text_cache_total', call=call, result='hit' if cached is not None else 'miss')
+        if cached is not None:
+            logger.info(f"Served {call} from the text cache")
+            return cached
+
+    for attempt in range(RATE_LIMITED_MAX_RETRIES + 1):
+        try:
+            with text_slot(model_name), span("text_model", call=call, tier=tier) as model_span:
+                text = get_backend().generate_text(model_name, prompt, schema)
+            break
+        except RateLimited as e:
+            if attempt == RATE_LIMITED_MAX_RETRIES or model_name not in model_rate_limiters:
+                raise
+            model_rate_limiters[model_name].penalize(rate_limited_wait(e, attempt))
+
+    input_price, output_price = TIER_PRICES[tier]
+    cost = (model_span.counts.get('prompt_tokens', 0) * input_price + model_span.counts.get('output_tokens', 0) * output_price) / 1e6
+    registry.inc('model_cost_usd_total', cost, tier=tier, model=model_name)
+
+    if ttl:
+        try:
+            # Never keep a response the caller can't parse
+            if schema is not None:
+                json.loads(text)
+            text_cache.put_text(cache_key, text, call=call, model=model_name)
+        except ValueError:
+            logger.warning(f"Not caching unparseable {call} response")
+        except OSError as e:
+            logger.warning(f"Could not cache {call} response: {e}")
+    return text
+
+def superseding_check(token):
+    """
+    Stop an edit a newer one has superseded, before it queues any images.
+
+    Returns:
+        str: The image job group of the edit's story, or None outside an edit
+    """
+    if token is None:
+        return None
+    token.check()
+    return token.group
+
+def generate_json(prompt, schema, call, seed=None):
+    """Call a text model for schema-constrained JSON, timing the call and the parse separately."""
+    text = generate_text(prompt, call, schema, seed=seed)
+    with span("json_parse", call=call):
+        return json.loads(text)
+
+def suggestionGenerate(seed=None):
+    """
+    Four story ideas for the idea page.
+
+    Args:
+        seed (int): Cache variant to reuse; only seeded calls are cached.
+            Not sent to the model
+    """
     prompt = """
     You are a helpful tool that suggests story ideas.
     
@@ -87,37 +374,26 @@ def suggestionGenerate():
     """
     
     try:
-        model = genai.GenerativeModel(
-            'models/gemini-2.5-flash',
-            generation_config={
-                "response_mime_type": "application/json",
-                "response_schema": {
-                    "type": "object",
-                    "properties": {
-                        "suggestions": {
-                            "type": "array",
-                            "items": {"type": "string"}
-                        }
-                    },
-                    "required": ["suggestions"]
-                }
-            }
-        )
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
+        result = generate_json(prompt, suggestion_schema, 'suggestionGenerate', seed=seed)
         
         return result
     except Exception as e:
         logger.error(f"Error in suggestionGenerate: {e}")
         raise
 
-def storylineGenerate(story_data, feedback):
+def storylineGenerate(story_data, feedback, token=None, wait_for_images=True):
     """
     Regenerate the entire story with an updated storyline.
     
     Args:
         story_data (dict): Complete story data
         feedback (str): User feedback on storyline
+        token (EditToken): This edit, from store.begin_edit(); a newer edit of
+            the story cancels its image jobs, and it stops with Superseded
+            before queueing images of its own
+        wait_for_images (bool): False returns as soon as the text is ready, with
+            changed scenes' images queued speculatively and image_path left empty
+            (see ensure_scene_images)
         
     Returns:
         dict: Complete regenerated story with updated storyline
@@ -129,13 +405,13 @@ def storylineGenerate(story_data, feedback):
     Storyline: {story_data['storyline']}
     
     Characters:
-    {json.dumps(story_data['persona_description'], indent=2)}
+    {context_json(story_data['persona_description'])}
     
     Locations:
-    {json.dumps(story_data['setting_description'], indent=2)}
+    {context_json(story_data['setting_description'])}
     
     Current Scenes:
-    {json.dumps(story_data['scenes'], indent=2)}
+    {context_json(story_data['scenes'])}
     
     User Feedback for Storyline: {feedback}
     
@@ -147,27 +423,39 @@ def storylineGenerate(story_data, feedback):
     """
     
     try:
-        model = genai.GenerativeModel(
-            'models/gemini-2.5-pro',
-            generation_config={
-                "response_mime_type": "application/json",
-                "response_schema": story_schema
-            }
-        )
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
+        result = generate_json(prompt, story_schema, 'storylineGenerate')
         logger.warning(f"storylineGenerate result: {result}")
         
         # Regenerate images for updated scenes
-        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'))
+        group = superseding_check(token)
+        if wait_for_images:
+            result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'), group=group)
+        else:
+            schedule_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'), group=group)
         
         return result
+    except Superseded:
+        raise
     except Exception as e:
         logger.error(f"Error in storylineGenerate: {e}")
         raise
 
 
-def storyGenerate(idea):
+def storyGenerate(idea, on_story=None, on_scene=None, seed=None):
+    """
+    Generate a complete story, including scene images, from a raw idea.
+
+    Args:
+        idea (str): The user's story idea
+        on_story (callable): Called with the story dict as soon as the text model returns, before any images exist
+        on_scene (callable): Called with each scene dict as its image completes
+        seed (int): Cache variant: the same idea and seed give the same story
+            while it is in the text cache; unseeded calls are never cached.
+            Not sent to the model, so a cache miss is a fresh story
+
+    Returns:
+        dict: Complete story with image_path set on every scene
+    """
     prompt = f"""
     You are a helpful tool to create a story based off this story idea: {idea}. The story should be in a 1 minute-long shortform video style."""
     prompt += f"""
@@ -188,26 +476,17 @@ def storyGenerate(idea):
     """
     
     try:
-        model = genai.GenerativeModel(
-            'models/gemini-2.5-pro',
-            generation_config={
-                "response_mime_type": "application/json",
-                "response_schema": story_schema
-            }
-        )
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
+        result = generate_json(prompt, story_schema, 'storyGenerate', seed=seed)
         logger.info(f"storyGenerate result: {result}")
-        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=None)
+        if on_story:
+            on_story(result)
+        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=None, on_scene=on_scene)
         return result
     except Exception as e:
         logger.error(f"Error in storyGenerate: {e}")
         raise
 
 
-import time
-import re
-
 # def generate_scene_image(image_prompt, emotional_tones, scene_id, story_data, max_retries=3):
 #     # Replace character names with full descriptions
 #     enhanced_prompt = image_prompt
@@ -226,81 +505,103 @@ import re
 #     tone_text = ", ".join(emotional_tones)
 #     enhanced_prompt += f". The image should reflect the emotional tones: {tone_text}."
 
+def save_derivatives(image_path, data):
+    """Write WebP/AVIF thumbnails for a saved scene image; failures only cost page weight."""
+    try:
+        make_derivatives(image_path, data)
+    except Exception as e:
+        logger.warning(f"Could not write derivatives for {image_path}: {e}")
+
+
 def generate_scene_image(image_prompt, emotional_tones, scene_id, story_data, max_retries=3):
-    # Replace character names with full descriptions
-    enhanced_prompt = image_prompt
-    
-    for persona in story_data.get('persona_description', []):
-        name = persona['name']
-        description = f"{persona['name']}, {persona['age']} years old, with {persona['hair']} hair, {persona['skin']} skin, wearing {persona['clothing']}"
-        enhanced_prompt = re.sub(r'\b' + re.escape(name) + r'\b', description, enhanced_prompt, flags=re.IGNORECASE)
-    
-    for location in story_data.get('setting_description', []):
-        name = location['name']
-        description = location['description']
-        enhanced_prompt = re.sub(r'\b' + re.escape(name) + r'\b', description, enhanced_prompt, flags=re.IGNORECASE)
-    
-    tone_text = ", ".join(emotional_tones)
-    enhanced_prompt += f". The image should reflect the emotional tones: {tone_text}."
+    # Replace character and location names with full descriptions
+    with span("prompt_build", call='generate_scene_image'):
+        enhanced_prompt = get_prompt_expander(story_data).expand(image_prompt, emotional_tones)
+
+    return generate_image_for_prompt(enhanced_prompt, scene_id, max_retries), enhanced_prompt
+
 
-    print(f"Enhanced prompt for scene {scene_id}: {enhanced_prompt}")
-    for attempt in range(max_retries):
+def read_cached_image(cache_key):
+    """Cached image bytes, or None on a miss or when another process evicted the blob after the lookup."""
+    cached_path = image_cache.get(cache_key)
+    if cached_path is None:
+        return None
+    try:
+        return cached_path.read_bytes()
+    except OSError as e:
+        logger.info(f"Cached image {cache_key} went away before it was read: {e}")
+        image_cache.discard(cache_key)
+        return None
+
+
+def generate_image_for_prompt(enhanced_prompt, scene_id, max_retries=3):
+    """Image for an already expanded scene prompt, from the cache or the model; returns its storage name."""
+    logger.debug(f"Enhanced prompt for scene {scene_id}: {enhanced_prompt}")
+
+    cache_key = ImageCache.make_key(IMAGE_MODEL, IMAGE_ASPECT_RATIO, enhanced_prompt)
+    data = read_cached_image(cache_key)
+    if data is not None:
+        with span("image_save", source='cache'):
+            # Same bytes, same content-hash name: usually already in storage
+            image_path = get_storage().save(content_name(data), data)
+            save_derivatives(image_path, data)
+        logger.info(f"Served image for scene {scene_id} from cache")
+        return image_path
+
+    attempt = 0
+    throttled = 0
+    while attempt < max_retries:
         try:
-            from google import genai as google_genai
-            from google.genai import types
-            # Create client with API key
-            client = google_genai.Client(api_key=api_key)
-            
-            # Generate image flash
-            # response = client.models.generate_content(
-            #     model="gemini-2.5-flash-image",
-            #     contents=[enhanced_prompt],
-            # )
-
-            #Generate image pro
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=[enhanced_prompt],
-                config=types.GenerateContentConfig(
-                    image_config=types.ImageConfig(
-                        aspect_ratio="9:16"
-                    )
-                )
-            )
-            
-            # Extract and save image
-            for part in response.parts:
-                if part.inline_data is not None:
-                    image = part.as_image()
-                    
-                    image_dir = Path("main/static/main/images/generated")
-                    image_dir.mkdir(parents=True, exist_ok=True)
-                    
-                    timestamp = int(time.time())
-                    image_path = image_dir / f"scene_{scene_id}_{timestamp}.png"
-                    image.save(str(image_path))
+            with span("rate_limit_wait"):
+                image_rate_limiter.acquire()
+            with span("image_attempt") as attempt_span:
+                # Every attempt after the first is a retry
+                attempt_span.set(retries=min(attempt + throttled, 1))
+                data = get_backend().generate_image(IMAGE_MODEL, enhanced_prompt, IMAGE_ASPECT_RATIO)
+
+            if data is not None:
+                with span("image_save", source='model'):
+                    # Content-hash names never collide between sessions and never change
+                    image_path = get_storage().save(content_name(data), data)
                     logger.info(f"Generated image for scene {scene_id} on attempt {attempt + 1}")
-                    
-                    # Return path 
-                    return f"main/images/generated/scene_{scene_id}_{timestamp}.png", enhanced_prompt
-            
+                    try:
+                        image_cache.put(cache_key, data, model=IMAGE_MODEL, aspect_ratio=IMAGE_ASPECT_RATIO)
+                    except OSError as e:
+                        logger.warning(f"Could not cache image for scene {scene_id}: {e}")
+                    save_derivatives(image_path, data)
+
+                # Return storage name (also the static path for local storage)
+                return image_path
+
             logger.warning(f"No image generated for scene {scene_id} on attempt {attempt + 1}")
-            
+
+        except RateLimited as e:
+            # Out of quota is not a failed attempt: pause the model for every
+            # process and wait with them, without spending a retry
+            if throttled == RATE_LIMITED_MAX_RETRIES:
+                logger.error(f"Still rate limited generating image for scene {scene_id} after {throttled} waits")
+                return FALLBACK_IMAGE
+            image_rate_limiter.penalize(rate_limited_wait(e, throttled))
+            throttled += 1
+            continue
+
         except Exception as e:
             logger.warning(f"Error generating image for scene {scene_id} (attempt {attempt + 1}/{max_retries}): {e}")
             
             if attempt < max_retries - 1:
-                # Exponential backoff: wait 2^attempt seconds
-                wait_time = 2 ** attempt
-                logger.info(f"Retrying in {wait_time} seconds...")
+                # Exponential backoff with full jitter, so failed calls don't retry together
+                wait_time = random.uniform(0, 2 ** attempt)
+                logger.info(f"Retrying in {wait_time:.1f} seconds...")
                 time.sleep(wait_time)
             else:
                 # All retries failed
                 logger.error(f"Failed to generate image for scene {scene_id} after {max_retries} attempts")
-                return f"main/images/generated/scene_{scene_id}.png"
+                return FALLBACK_IMAGE
+
+        attempt += 1
     
     # Fallback if loop completes without returning
-    return "main/images/exampleImage.png", enhanced_prompt
+    return FALLBACK_IMAGE
 
 
 # def generate_all_scene_images(scenes, story_data, old_scenes=None):
@@ -348,63 +649,128 @@ def generate_scene_image(image_prompt, emotional_tones, scene_id, story_data, ma
     
 #     return updated_scenes
 
-def generate_all_scene_images(scenes, story_data, old_scenes=None):
-    """Only regenerate images for scenes with changed enhanced prompts."""
-    updated_scenes = []
-    
-    for i, scene in enumerate(scenes):
+def schedule_scene_images(scenes, story_data, old_scenes=None, priority=SPECULATIVE, group=None, visible_ids=()):
+    """
+    Queue image generation for scenes whose enhanced prompt changed.
+
+    Scenes whose enhanced prompt matches an old scene reuse its image right
+    away. The rest get their enhanced_prompt and an empty image_path, and a
+    job on image_scheduler: scene 1 first, except that visible_ids go ahead
+    of everything. With a group (a story), that group's queued jobs the new
+    scenes no longer need are cancelled.
+
+    Returns:
+        dict: {scene id: Future resolving to the image's storage name}
+    """
+    expander = get_prompt_expander(story_data)
+    old_scenes_by_id = {s['id']: s for s in old_scenes or []}
+    futures = {}
+    keys = set()
+
+    for order, scene in enumerate(scenes):
+        with span("prompt_build", call='generate_scene_image'):
+            enhanced_prompt = expander.expand(scene.get('image_prompt', ''), scene['emotional_tones'])
+        old_scene = old_scenes_by_id.get(scene['id'])
+        if old_scene and old_scene.get('enhanced_prompt') == enhanced_prompt and old_scene.get('image_path'):
+            scene['image_path'] = old_scene['image_path']
+            scene['enhanced_prompt'] = enhanced_prompt
+            logger.info(f"Reusing image for scene {scene['id']} - enhanced prompt unchanged")
+            continue
+
+        scene['image_path'] = ''
+        scene['enhanced_prompt'] = enhanced_prompt  # Store for future comparisons
+        key = ImageCache.make_key(IMAGE_MODEL, IMAGE_ASPECT_RATIO, enhanced_prompt)
+        keys.add(key)
+        futures[scene['id']] = image_scheduler.submit(
+            key,
+            functools.partial(generate_image_for_prompt, enhanced_prompt, scene['id']),
+            priority=(VISIBLE if scene['id'] in visible_ids else priority) + order,
+            group=group,
+        )
+
+    if group is not None:
+        image_scheduler.supersede(group, keys)
+    return futures
+
+
+def cancel_superseded_images(group, pending_prompts):
+    """
+    Cancel a story's queued image jobs when a new edit starts, except those
+    for pending_prompts: the enhanced prompts of the current version's
+    scenes still waiting for a speculative image.
+    """
+    keep_keys = {ImageCache.make_key(IMAGE_MODEL, IMAGE_ASPECT_RATIO, prompt) for prompt in pending_prompts}
+    return image_scheduler.supersede(group, keep_keys)
+
+
+def generate_all_scene_images(scenes, story_data, old_scenes=None, on_scene=None, group=None, visible_ids=()):
+    """
+    Only regenerate images for scenes with changed enhanced prompts.
+
+    Scenes are rendered on image_scheduler (scene 1 first, at most
+    IMAGE_MAX_CONCURRENCY in flight, paced by image_rate_limiter) and
+    returned in their original order once all are done. A scene whose
+    generation fails or is superseded falls back to the example image. If
+    on_scene is given it is called on this thread with each scene as soon as
+    its image is ready.
+    """
+    futures = schedule_scene_images(
+        scenes, story_data, old_scenes=old_scenes, priority=VISIBLE, group=group, visible_ids=visible_ids
+    )
+    return wait_for_scene_images(scenes, futures, on_scene=on_scene)
+
+
+def wait_for_scene_images(scenes, futures, on_scene=None):
+    """Fill in image_path from futures as they finish (see schedule_scene_images)."""
+    scenes_by_id = {scene['id']: scene for scene in scenes}
+    if on_scene:
+        for scene in scenes:
+            if scene['id'] not in futures:
+                on_scene(scene)
+
+    scene_ids = {future: scene_id for scene_id, future in futures.items()}
+    for future in as_completed(scene_ids):
+        scene = scenes_by_id[scene_ids[future]]
         try:
-            should_generate = True
-            
-            if old_scenes:
-                old_scene = next((s for s in old_scenes if s['id'] == scene['id']), None)
-                if old_scene and 'enhanced_prompt' in old_scene:
-                    # Generate the new enhanced prompt for comparison
-                    test_enhanced = scene.get('image_prompt', '')
-                    for persona in story_data.get('persona_description', []):
-                        name = persona['name']
-                        description = f"{persona['name']}, {persona['age']} years old, with {persona['hair']} hair, {persona['skin']} skin, wearing {persona['clothing']}"
-                        test_enhanced = re.sub(r'\b' + re.escape(name) + r'\b', description, test_enhanced, flags=re.IGNORECASE)
-                    
-                    for location in story_data.get('setting_description', []):
-                        name = location['name']
-                        description = location['description']
-                        test_enhanced = re.sub(r'\b' + re.escape(name) + r'\b', description, test_enhanced, flags=re.IGNORECASE)
-                    
-                    tone_text = ", ".join(scene['emotional_tones'])
-                    test_enhanced += f". The image should reflect the emotional tones: {tone_text}."
-                    
-                    # Compare enhanced prompts
-                    if test_enhanced == old_scene.get('enhanced_prompt') and 'image_path' in old_scene:
-                        should_generate = False
-                        scene['image_path'] = old_scene['image_path']
-                        scene['enhanced_prompt'] = old_scene['enhanced_prompt']
-                        logger.info(f"Reusing image for scene {scene['id']} - enhanced prompt unchanged")
-            
-            if should_generate:
-                if i > 0:
-                    time.sleep(1)
-                
-                image_path, enhanced_prompt = generate_scene_image(
-                    scene['image_prompt'],
-                    scene['emotional_tones'],
-                    scene['id'],
-                    story_data
-                )
-                scene['image_path'] = image_path
-                scene['enhanced_prompt'] = enhanced_prompt  # Store for future comparisons
-                logger.info(f"Generated NEW image for scene {scene['id']}")
-            
-            updated_scenes.append(scene)
-            
+            scene['image_path'] = future.result()
+            logger.info(f"Generated NEW image for scene {scene['id']}")
+        except CancelledError:
+            logger.warning(f"Image for scene {scene['id']} was superseded by a newer edit")
+            scene['image_path'] = FALLBACK_IMAGE
         except Exception as e:
             logger.error(f"Failed to generate image for scene {scene['id']}: {e}")
-            scene['image_path'] = "main/images/exampleImage.png"
-            updated_scenes.append(scene)
-    
-    return updated_scenes
+            scene['image_path'] = FALLBACK_IMAGE
+        if on_scene:
+            on_scene(scene)
+
+    # Scenes are updated in place, so the original ordering is preserved
+    return list(scenes)
+
+
+def ensure_scene_images(scenes, visible_ids=(), group=None):
+    """
+    Finish scenes left with an empty image_path by a speculative schedule.
+
+    Their jobs are usually running or done by now; asking again moves the
+    visible ones to the front and the image cache turns finished ones into a
+    lookup.
 
-def characterGenerate(story_data, character_id, feedback):
+    Returns:
+        list: The scenes that were missing an image, now filled in
+    """
+    pending = [scene for scene in scenes if not scene.get('image_path') and scene.get('enhanced_prompt')]
+    futures = {}
+    for order, scene in enumerate(pending):
+        key = ImageCache.make_key(IMAGE_MODEL, IMAGE_ASPECT_RATIO, scene['enhanced_prompt'])
+        futures[scene['id']] = image_scheduler.submit(
+            key,
+            functools.partial(generate_image_for_prompt, scene['enhanced_prompt'], scene['id']),
+            priority=(VISIBLE if scene['id'] in visible_ids else SPECULATIVE) + order,
+            group=group,
+        )
+    return wait_for_scene_images(pending, futures)
+
+def characterGenerate(story_data, character_id, feedback, token=None):
     current_character = next(
         (char for char in story_data['persona_description'] if char['id'] == character_id),
         None
@@ -414,6 +780,10 @@ def characterGenerate(story_data, character_id, feedback):
         raise ValueError(f"Character with id {character_id} not found")
     
     other_characters = [c for c in story_data['persona_description'] if c['id'] != character_id]
+
+    # Only scenes that reference this character can need changes
+    affected_ids = build_dependency_index(story_data)['personas'][character_id]
+    affected_scenes = [scene for scene in story_data['scenes'] if scene['id'] in affected_ids]
     
     prompt = f"""
     You are updating a character in a story and must edit any part of the story necessary to reflect this change consistently throughout.
@@ -422,48 +792,49 @@ def characterGenerate(story_data, character_id, feedback):
     Storyline: {story_data['storyline']}
     
     Character Being Updated (ID {character_id}):
-    {json.dumps(current_character, indent=2)}
+    {context_json(current_character)}
     
     User Feedback for This Character: {feedback}
     
     Other Characters (keep these the same):
-    {json.dumps(other_characters, indent=2)}
+    {context_json(other_characters)}
     
     Settings (keep these the same):
-    {json.dumps(story_data['setting_description'], indent=2)}
+    {context_json(story_data['setting_description'])}
     
-    Current Scenes:
-    {json.dumps(story_data['scenes'], indent=2)}
+    Scenes That Feature This Character:
+    {context_json(affected_scenes)}
     
-    IMPORTANT:
     IMPORTANT:
     1. Update character {character_id} based on the user feedback.
-    2. Regenerate only the parts of the storyline and all 6 scenes that need to be changed to reflect the updated character naturally (updating apperance, name, etc.), leave the rest exactly the same.
+    2. Regenerate only the parts of the storyline and the scenes above that need to be changed to reflect the updated character naturally (updating apperance, name, etc.), leave the rest exactly the same.
     3. Maintain the same story flow, structure, and scene ordering.
     4. Minimize changes to unaffected parts of the story. Do not change anything that does not need to be changed in order to guarantee consistency.
+    
+    Return ONLY what changed:
+    - persona_description: just the updated character {character_id}
+    - scenes: just the scenes above, complete, with their same ids
+    - storyline: only if it needs to change, otherwise omit it
     """
     
     try:
-        model = genai.GenerativeModel(
-            'models/gemini-2.5-pro',
-            generation_config={
-                "response_mime_type": "application/json",
-                "response_schema": story_schema
-            }
-        )
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
-        logger.info(f"characterGenerate result: {result}")
+        patch = generate_json(prompt, story_patch_schema, 'characterGenerate')
+        logger.info(f"characterGenerate patch: {patch}")
 
-        logger.info("Regenerating all scene images with updated character...")
-        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'))
+        result = merge_story_patch(story_data, patch, affected_ids, persona_ids=[character_id], location_ids=[])
+
+        logger.info(f"Regenerating images for scenes {affected_ids} with updated character...")
+        group = superseding_check(token)
+        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'), group=group)
         return result
+    except Superseded:
+        raise
     except Exception as e:
         logger.error(f"Error in characterGenerate: {e}")
         raise
 
 
-def locationGenerate(story_data, location_id, feedback):
+def locationGenerate(story_data, location_id, feedback, token=None):
 
     current_location = next(
         (loc for loc in story_data['setting_description'] if loc['id'] == location_id),
@@ -478,6 +849,10 @@ def locationGenerate(story_data, location_id, feedback):
         if loc['id'] != location_id
     ]
 
+    # Only scenes that take place at or mention this location can need changes
+    affected_ids = build_dependency_index(story_data)['locations'][location_id]
+    affected_scenes = [scene for scene in story_data['scenes'] if scene['id'] in affected_ids]
+
     prompt = f"""
     You are updating a location in a story and must minimally regenerate any parts of the story 
     that need changes to reflect this environmental change consistently throughout.
@@ -486,45 +861,46 @@ def locationGenerate(story_data, location_id, feedback):
     Storyline: {story_data['storyline']}
 
     Location Being Updated (ID {location_id}):
-    {json.dumps(current_location, indent=2)}
+    {context_json(current_location)}
 
     User Feedback for This Location:
     {feedback}
 
     Other Locations (keep these the same):
-    {json.dumps(other_locations, indent=2)}
+    {context_json(other_locations)}
 
     Characters (keep these the same):
-    {json.dumps(story_data['persona_description'], indent=2)}
+    {context_json(story_data['persona_description'])}
 
-    Current Scenes:
-    {json.dumps(story_data['scenes'], indent=2)}
+    Scenes That Use This Location:
+    {context_json(affected_scenes)}
 
     IMPORTANT:
     1. Update location {location_id} based on the user feedback.
-    2. Regenerate only the parts of the storyline and all 6 scenes that need to be changed to reflect the updated location naturally (updating description, name, etc.), leave the rest exactly the same.
+    2. Regenerate only the parts of the storyline and the scenes above that need to be changed to reflect the updated location naturally (updating description, name, etc.), leave the rest exactly the same.
     3. Maintain the same story flow, structure, and scene ordering.
     4. Minimize changes to unaffected parts of the story. Do not change anything that does not need to be changed in order to guarantee consistency.
+
+    Return ONLY what changed:
+    - setting_description: just the updated location {location_id}
+    - scenes: just the scenes above, complete, with their same ids
+    - storyline: only if it needs to change, otherwise omit it
     """
 
     try:
-        model = genai.GenerativeModel(
-            "models/gemini-2.5-pro",
-            generation_config={
-                "response_mime_type": "application/json",
-                "response_schema": story_schema  
-            }
-        )
+        patch = generate_json(prompt, story_patch_schema, 'locationGenerate')
 
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
+        logger.info(f"locationGenerate patch: {patch}")
 
-        logger.info(f"locationGenerate result: {result}")
+        result = merge_story_patch(story_data, patch, affected_ids, persona_ids=[], location_ids=[location_id])
 
-        logger.info("Regenerating all scene images with updated character...")
-        result['scenes'] = generate_all_scene_images(result['scenes'], result, story_data=story_data.get('scenes'))
+        logger.info(f"Regenerating images for scenes {affected_ids} with updated location...")
+        group = superseding_check(token)
+        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'), group=group)
         return result
 
+    except Superseded:
+        raise
     except Exception as e:
         logger.error(f"Error in locationGenerate: {e}")
         raise
@@ -565,9 +941,7 @@ def narrationGenerate(story_data, scene_id, narration_feedback):
     """
     
     try:
-        model = genai.GenerativeModel('models/gemini-2.5-pro')
-        response = model.generate_content(prompt)
-        updated_narration = response.text.strip()
+        updated_narration = generate_text(prompt, 'narrationGenerate').strip()
         logger.info(f"narrationGenerate for scene {scene_id}: updated")
         return updated_narration
     except Exception as e:
@@ -575,7 +949,7 @@ def narrationGenerate(story_data, scene_id, narration_feedback):
         raise
 
 
-def PromptGenerate(story_data, scene_id, image_prompt_feedback):
+def PromptGenerate(story_data, scene_id, image_prompt_feedback, token=None):
     current_scene = next(
         (scene for scene in story_data['scenes'] if scene['id'] == scene_id),
         None
@@ -583,6 +957,11 @@ def PromptGenerate(story_data, scene_id, image_prompt_feedback):
     
     if not current_scene:
         raise ValueError(f"Scene with id {scene_id} not found")
+
+    # A visual change can only spread through the characters and locations
+    # this scene shares with others
+    affected_ids = scenes_sharing_entities(story_data, scene_id)
+    affected_scenes = [scene for scene in story_data['scenes'] if scene['id'] in affected_ids]
     
     prompt = f"""
     A user is editing the image prompt for Scene {scene_id}. This change may affect character descriptions, 
@@ -593,17 +972,17 @@ def PromptGenerate(story_data, scene_id, image_prompt_feedback):
     Storyline: {story_data['storyline']}
     
     Characters:
-    {json.dumps(story_data['persona_description'], indent=2)}
+    {context_json(story_data['persona_description'])}
     
     Locations:
-    {json.dumps(story_data['setting_description'], indent=2)}
+    {context_json(story_data['setting_description'])}
     
     Current Scene {scene_id}:
     Image Prompt: {current_scene['image_prompt']}
     Narration: {current_scene['narration']}
     
-    All Scenes:
-    {json.dumps(story_data['scenes'], indent=2)}
+    Scenes That Share Characters or Locations With Scene {scene_id}:
+    {context_json(affected_scenes)}
     
     User's Change to Scene {scene_id} Image Prompt: {image_prompt_feedback}
     
@@ -612,31 +991,33 @@ def PromptGenerate(story_data, scene_id, image_prompt_feedback):
        update that character in persona_description
     2. Only if the feedback changes a location's details, update that location in setting_description
     3. Update the storyline only if the change affects the narrative to guarantee consistency.
-    4. Regenerate the parts of all 6 scenes that need to be changed to reflect the updated image prompt naturally.
+    4. Regenerate the parts of the scenes above that need to be changed to reflect the updated image prompt naturally.
     5. Maintain the same story flow, structure, and scene ordering.
     6. Make minimal changes necessary to ensure consistency after making the user's changes. For example, if the user feedback is that a character should be doing a certain action or the camera angle should be different, only this scene's image prompt and narration need to be changed, nothing else.
     
     The goal is complete consistency: if something changes visually in one scene, 
     it must be reflected everywhere in the story.
+
+    Return ONLY what changed:
+    - persona_description / setting_description: only characters or locations you updated, otherwise omit
+    - scenes: only the scenes above that you changed, complete, with their same ids
+    - storyline: only if it needs to change, otherwise omit it
     """
     
     try:
-        model = genai.GenerativeModel(
-            'models/gemini-2.5-pro',
-            generation_config={
-                "response_mime_type": "application/json",
-                "response_schema": story_schema
-            }
-        )
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
-        logger.info(f"sceneImagePromptGenerate: full story regenerated from scene {scene_id} edit")
+        patch = generate_json(prompt, story_patch_schema, 'PromptGenerate')
+        logger.info(f"sceneImagePromptGenerate: patched scenes {[s.get('id') for s in patch.get('scenes', [])]} from scene {scene_id} edit")
+
+        result = merge_story_patch(story_data, patch, affected_ids)
         
-        # Regenerate ALL images with updated prompts
-        logger.info("Regenerating all scene images...")
-        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'))
+        # Only scenes whose enhanced prompt changed get new images
+        logger.info("Regenerating changed scene images...")
+        group = superseding_check(token)
+        result['scenes'] = generate_all_scene_images(result['scenes'], result, old_scenes=story_data.get('scenes'), group=group, visible_ids=[scene_id])
         
         return result
+    except Superseded:
+        raise
     except Exception as e:
         logger.error(f"Error in sceneImagePromptGenerate: {e}")
-        raise
\ No newline at end of file
+        raise
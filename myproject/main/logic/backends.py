@@ -0,0 +1,388 @@
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+from .clients import get_image_client, get_text_model
+from .files import atomic_write
+from .metrics import record_tokens
+
+
+
+class BackendError(Exception):
+    """A model call failed (raised by the fake backend to simulate outages)."""
+
+
+class RateLimited(BackendError):
+    """
+    The model's quota is exhausted (HTTP 429 / RESOURCE_EXHAUSTED).
+
+    Attributes:
+        retry_after (float): Seconds the API asked callers to wait, or None without a hint
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _seconds(value):
+    """Seconds in a Retry-After header, an RPC duration ("23s", "1.5s") or a Duration message."""
+    if hasattr(value, "seconds"):
+        return value.seconds + getattr(value, "nanos", 0) / 1e9
+    value = str(value).strip()
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)s?", value)
+    if match:
+        return float(match.group(1))
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_delay(details):
+    """Find a RetryInfo delay anywhere in an error's details (dicts from google.genai, protos from api_core)."""
+    if isinstance(details, dict):
+        if "retryDelay" in details:
+            return _seconds(details["retryDelay"])
+        details = details.values()
+    elif hasattr(details, "retry_delay"):
+        return _seconds(details.retry_delay)
+    if isinstance(details, (list, tuple, type({}.values()))):
+        for item in details:
+            delay = _retry_delay(item)
+            if delay is not None:
+                return delay
+    return None
+
+
+def as_rate_limited(error):
+    """A RateLimited for a Gemini quota error (either client library), or None for any other error."""
+    code = getattr(error, "code", None)
+    code = code() if callable(code) else code
+    if code not in (429, "RESOURCE_EXHAUSTED") and type(error).__name__ not in ("ResourceExhausted", "TooManyRequests"):
+        return None
+    retry_after = None
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("retry-after"):
+        retry_after = _seconds(headers.get("retry-after"))
+    if retry_after is None:
+        retry_after = _retry_delay(getattr(error, "details", None))
+    return RateLimited(str(error), retry_after)
+
+
+@contextmanager
+def quota_errors():
+    """Re-raise Gemini quota errors as RateLimited, carrying their Retry-After hint."""
+    try:
+        yield
+    except BackendError:
+        raise
+    except Exception as e:
+        limited = as_rate_limited(e)
+        if limited is None:
+            raise
+        raise limited from e
+
+
+class GeminiBackend:
+    """Talks to Gemini through the shared clients in main.logic.clients."""
+
+    def generate_text(self, model, prompt, schema=None):
+        """Return the model's text (a JSON document when schema is given)."""
+        with quota_errors():
+            response = get_text_model(model, schema).generate_content(prompt)
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            record_tokens(usage.prompt_token_count, usage.candidates_token_count)
+        return response.text
+
+    def generate_image(self, model, prompt, aspect_ratio):
+        """Return the generated image's bytes, or None if the model returned no image."""
+        from google.genai import types
+
+        with quota_errors():
+            response = get_image_client().models.generate_content(
+                model=model,
+                contents=[prompt],
+                config=types.GenerateContentConfig(
+                    image_config=types.ImageConfig(
+                        aspect_ratio=aspect_ratio
+                    )
+                )
+            )
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            record_tokens(usage.prompt_token_count, usage.candidates_token_count)
+        for part in response.parts:
+            if part.inline_data is not None:
+                return part.inline_data.data
+        return None
+
+
+def placeholder_png(width, height, rgb):
+    """A solid-colour PNG, built without Pillow."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+FAKE_NAMES = ["Mara", "Theo", "Ines", "Caleb", "Juno", "Ravi"]
+FAKE_PLACES = ["Harbor Market", "Old Lighthouse", "Glass Greenhouse", "Night Train", "Rooftop Garden"]
+FAKE_TONES = ["hopeful", "tense", "warm", "melancholic", "joyful", "curious"]
+# How many items the fake puts in each story list
+FAKE_LIST_SIZES = {"scenes": 6, "persona_description": 2, "setting_description": 2, "suggestions": 4}
+
+
+class FakeBackend:
+    """
+    Deterministic local stand-in for Gemini.
+
+    Text calls return schema-valid JSON (stories whose scenes reference their
+    own personas and locations by name), and image calls return placeholder
+    PNGs. Output depends only on the prompt, so runs are reproducible.
+
+    Args:
+        text_latency (float): Seconds each text call takes
+        image_latency (float): Seconds each image call takes
+        failure_rate (float): Probability (0-1) that a call raises BackendError
+        seed (int): Seed for latency jitter and failures
+        model_latency (dict): Per-model text latency overriding text_latency
+        quota_rpm (float): Calls per model per rolling minute before calls are
+            refused with RateLimited (and a Retry-After hint), like Gemini's quota
+    """
+
+    def __init__(self, text_latency=0.0, image_latency=0.0, failure_rate=0.0, seed=0, model_latency=None, quota_rpm=None):
+        self.text_latency = text_latency
+        self.model_latency = model_latency or {}
+        self.image_latency = image_latency
+        self.failure_rate = failure_rate
+        self.quota_rpm = quota_rpm
+        self.calls = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def _check_quota(self, model):
+        if not self.quota_rpm:
+            return
+        with self.lock:
+            now = time.monotonic()
+            calls = self.calls.setdefault(model, deque())
+            while calls and calls[0] <= now - 60:
+                calls.popleft()
+            if len(calls) >= self.quota_rpm:
+                raise RateLimited(f"Simulated quota exhausted for {model}", retry_after=calls[0] + 60 - now)
+            calls.append(now)
+
+    def _simulate(self, latency, what):
+        with self.lock:
+            jitter = self.random.uniform(0.8, 1.2)
+            fail = self.random.random() < self.failure_rate
+        time.sleep(latency * jitter)
+        if fail:
+            raise BackendError(f"Simulated {what} failure")
+
+    @staticmethod
+    def _rng(*parts):
+        digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def _fake_value(self, schema, rng, key=None, index=0):
+        kind = schema.get("type")
+        if kind == "object":
+            return {
+                prop: self._fake_value(prop_schema, rng, key=prop, index=index)
+                for prop, prop_schema in schema.get("properties", {}).items()
+            }
+        if kind == "array":
+            size = FAKE_LIST_SIZES.get(key, 2)
+            return [self._fake_value(schema["items"], rng, key=key, index=i) for i in range(size)]
+        if kind == "integer":
+            return index + 1
+        if key == "emotional_tones":
+            return rng.choice(FAKE_TONES)
+        if key == "suggestions":
+            return f"A {rng.choice(FAKE_TONES)} story about {rng.choice(FAKE_NAMES)} at the {rng.choice(FAKE_PLACES)}"
+        return f"{key or 'text'} {rng.randrange(10000)}"
+
+    def _fake_story(self, story, rng):
+        """Make a generated story internally consistent, like a real one."""
+        personas = story.get("persona_description", [])
+        settings = story.get("setting_description", [])
+        for i, persona in enumerate(personas):
+            persona.update(name=FAKE_NAMES[i % len(FAKE_NAMES)], age=str(20 + 7 * i),
+                           clothing="a weathered denim jacket", skin="warm brown", hair="short curly black")
+        for i, setting in enumerate(settings):
+            setting.update(name=FAKE_PLACES[i % len(FAKE_PLACES)],
+                           description=f"the {FAKE_PLACES[i % len(FAKE_PLACES)].lower()}, lit by lanterns at dusk")
+        for scene in story.get("scenes", []):
+            character = rng.choice(personas)["name"] if personas else "Someone"
+            location = rng.choice(settings)["name"] if settings else "somewhere"
+            scene.update(
+                characters=[character],
+                location=location,
+                image_prompt=f"{character} waiting in {location}, cinematic wide shot, scene {scene['id']}",
+                narration=f"{character} arrives at the {location} and everything changes.",
+            )
+        if personas and settings:
+            story["storyline"] = f"{personas[0]['name']} meets a stranger at the {settings[0]['name']}."
+        return story
+
+    @staticmethod
+    def _counted(prompt, text):
+        # Roughly four characters per token, close enough for load tests
+        record_tokens(len(prompt) // 4, len(text) // 4)
+        return text
+
+    def generate_text(self, model, prompt, schema=None):
+        self._check_quota(model)
+        self._simulate(self.model_latency.get(model, self.text_latency), "text")
+        rng = self._rng("text", model, prompt)
+        if schema is None:
+            return self._counted(prompt, f"{rng.choice(FAKE_NAMES)} pauses, then steps forward into the {rng.choice(FAKE_PLACES).lower()}.")
+        value = self._fake_value(schema, rng)
+        if "scenes" in value:
+            value = self._fake_story(value, rng)
+        return self._counted(prompt, json.dumps(value))
+
+    def generate_image(self, model, prompt, aspect_ratio):
+        self._check_quota(model)
+        self._simulate(self.image_latency, "image")
+        rng = self._rng("image", model, prompt, aspect_ratio)
+        width, height = (int(n) * 10 for n in aspect_ratio.split(":"))
+        return placeholder_png(width, height, [rng.randrange(256) for _ in range(3)])
+
+
+def recording_key(kind, model, prompt, schema=None, aspect_ratio=None):
+    payload = json.dumps([kind, model, prompt, schema, aspect_ratio], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RecordingBackend:
+    """Passes calls through to another backend and saves each response under recordings_dir."""
+
+    def __init__(self, inner, recordings_dir):
+        self.inner = inner
+        self.recordings_dir = Path(recordings_dir)
+
+    def _write(self, name, data):
+        self.recordings_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.recordings_dir / name, data)
+
+    def generate_text(self, model, prompt, schema=None):
+        text = self.inner.generate_text(model, prompt, schema)
+        self._write(f"{recording_key('text', model, prompt, schema)}.txt", text.encode("utf-8"))
+        return text
+
+    def generate_image(self, model, prompt, aspect_ratio):
+        data = self.inner.generate_image(model, prompt, aspect_ratio)
+        if data is not None:
+            self._write(f"{recording_key('image', model, prompt, aspect_ratio=aspect_ratio)}.bin", data)
+        return data
+
+
+class ReplayBackend:
+    """
+    Answers from responses saved by RecordingBackend.
+
+    A call that was never recorded goes to fallback, or raises BackendError
+    when there is none.
+    """
+
+    def __init__(self, recordings_dir, fallback=None):
+        self.recordings_dir = Path(recordings_dir)
+        self.fallback = fallback
+
+    def _read(self, name):
+        try:
+            with open(self.recordings_dir / name, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def generate_text(self, model, prompt, schema=None):
+        data = self._read(f"{recording_key('text', model, prompt, schema)}.txt")
+        if data is not None:
+            return data.decode("utf-8")
+        if self.fallback is None:
+            raise BackendError(f"No recorded {model} response for this prompt")
+        return self.fallback.generate_text(model, prompt, schema)
+
+    def generate_image(self, model, prompt, aspect_ratio):
+        data = self._read(f"{recording_key('image', model, prompt, aspect_ratio=aspect_ratio)}.bin")
+        if data is not None:
+            return data
+        if self.fallback is None:
+            raise BackendError(f"No recorded {model} image for this prompt")
+        return self.fallback.generate_image(model, prompt, aspect_ratio)
+
+
+def fake_backend_from_env():
+    return FakeBackend(
+        text_latency=float(os.getenv("AI_FAKE_TEXT_LATENCY", "0")),
+        image_latency=float(os.getenv("AI_FAKE_IMAGE_LATENCY", "0")),
+        failure_rate=float(os.getenv("AI_FAKE_FAILURE_RATE", "0")),
+        seed=int(os.getenv("AI_FAKE_SEED", "0")),
+        quota_rpm=float(os.getenv("AI_FAKE_QUOTA_RPM", "0")) or None,
+    )
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    The model backend for this process, chosen by AI_BACKEND:
+
+    - gemini (default): real API calls
+    - fake: FakeBackend configured by AI_FAKE_* variables
+    - record: real API calls, saved to AI_RECORDINGS_DIR
+    - replay: saved responses only (AI_REPLAY_FALLBACK=fake fills gaps with the fake)
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = build_backend(os.getenv("AI_BACKEND", "gemini"))
+    return _backend
+
+
+def build_backend(name):
+    recordings_dir = os.getenv("AI_RECORDINGS_DIR", str(settings.BASE_DIR / "ai_recordings"))
+    if name == "fake":
+        return fake_backend_from_env()
+    if name == "record":
+        return RecordingBackend(GeminiBackend(), recordings_dir)
+    if name == "replay":
+        fallback = fake_backend_from_env() if os.getenv("AI_REPLAY_FALLBACK") == "fake" else None
+        return ReplayBackend(recordings_dir, fallback=fallback)
+    if name != "gemini":
+        raise ValueError(f"Unknown AI_BACKEND {name!r}")
+    return GeminiBackend()
+
+
+def set_backend(backend):
+    """Swap the process-wide backend (benchmarks and load tests use this)."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
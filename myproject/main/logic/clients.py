@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+
+import google.generativeai as genai
+
+# One Gemini image client and one GenerativeModel per (model, schema) for the
+# whole process. They are created lazily on first use and shared by every
+# request and worker thread, so the HTTP connection pool and the converted
+# response schemas are reused instead of rebuilt on every call.
+IMAGE_CLIENT_MAX_CONNECTIONS = int(os.getenv("IMAGE_CLIENT_MAX_CONNECTIONS", "10"))
+
+_lock = threading.Lock()
+_image_client = None
+_text_models = {}
+
+
+def get_image_client():
+    """Return the shared google.genai Client used for image generation."""
+    global _image_client
+    if _image_client is None:
+        with _lock:
+            if _image_client is None:
+                import httpx
+                from google import genai as google_genai
+                from google.genai import types
+
+                _image_client = google_genai.Client(
+                    api_key=os.getenv("GEMINI_API_KEY"),
+                    http_options=types.HttpOptions(
+                        client_args={
+                            "limits": httpx.Limits(
+                                max_connections=IMAGE_CLIENT_MAX_CONNECTIONS,
+                                max_keepalive_connections=IMAGE_CLIENT_MAX_CONNECTIONS,
+                            )
+                        }
+                    )
+                )
+    return _image_client
+
+
+def get_text_model(model_name, response_schema=None):
+    """
+    Return the shared GenerativeModel for this model and response schema.
+
+    Args:
+        model_name (str): e.g. 'models/gemini-2.5-pro'
+        response_schema (dict): JSON schema for structured output, or None for plain text
+
+    Returns:
+        genai.GenerativeModel
+    """
+    key = (model_name, json.dumps(response_schema, sort_keys=True) if response_schema else None)
+    model = _text_models.get(key)
+    if model is None:
+        with _lock:
+            model = _text_models.get(key)
+            if model is None:
+                if response_schema:
+                    model = genai.GenerativeModel(
+                        model_name,
+                        generation_config={
+                            "response_mime_type": "application/json",
+                            "response_schema": response_schema
+                        }
+                    )
+                else:
+                    model = genai.GenerativeModel(model_name)
+                _text_models[key] = model
+    return model
@@ -0,0 +1,68 @@
+import inspect
+import json
+import logging
+import os
+
+from .metrics import record_tokens, registry
+
+logger = logging.getLogger(__name__)
+
+# Scene fields the app derives from model output; the text model never needs
+# them back, and enhanced_prompt alone is longer than the rest of the scene
+DERIVED_FIELDS = ('image_path', 'enhanced_prompt')
+
+# Estimated input tokens each call site is expected to stay under, for a
+# six-scene story with two or three characters and locations. Going over
+# is logged and counted, not blocked.
+PROMPT_TOKEN_BUDGETS = {
+    'suggestionGenerate': 300,
+    'storyGenerate': 600,
+    'storylineGenerate': 2000,
+    'characterGenerate': 1600,
+    'locationGenerate': 1600,
+    'narrationGenerate': 600,
+    'PromptGenerate': 2000,
+}
+PROMPT_TOKEN_BUDGET_SCALE = float(os.getenv("PROMPT_TOKEN_BUDGET_SCALE", "1"))
+
+
+def strip_derived(value):
+    """Copy of value without DERIVED_FIELDS in any dict."""
+    if isinstance(value, dict):
+        return {key: strip_derived(item) for key, item in value.items() if key not in DERIVED_FIELDS}
+    if isinstance(value, list):
+        return [strip_derived(item) for item in value]
+    return value
+
+
+def context_json(value):
+    """Story parts as prompt context: compact JSON without derived fields."""
+    return json.dumps(strip_derived(value), separators=(',', ':'), ensure_ascii=False)
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English and JSON)."""
+    return len(text) // 4
+
+
+def prepare_prompt(call, prompt):
+    """
+    Final form of a text prompt: strip the indentation prompts inherit from
+    the source, then measure it against the call site's token budget.
+
+    Args:
+        call (str): Name of the ai.py function building the prompt
+        prompt (str): The prompt as written
+
+    Returns:
+        str: The prompt to send
+    """
+    prompt = inspect.cleandoc(prompt)
+    tokens = estimate_tokens(prompt)
+    record_tokens(prompt_tokens=tokens)
+
+    budget = PROMPT_TOKEN_BUDGETS.get(call)
+    if budget is not None and tokens > budget * PROMPT_TOKEN_BUDGET_SCALE:
+        registry.inc('story_prompt_over_budget_total', call=call)
+        logger.warning(f"{call} prompt is ~{tokens} tokens, over its budget of {budget * PROMPT_TOKEN_BUDGET_SCALE:.0f}")
+    return prompt
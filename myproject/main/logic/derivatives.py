@@ -0,0 +1,152 @@
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# Widths (px) written for every generated image. The storyboard grid shows
+# tiles around 250-450px wide, so the full-size PNG is rarely needed.
+DERIVATIVE_WIDTHS = (256, 384, 512, 768)
+DERIVATIVE_QUALITY = int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80"))
+DERIVATIVE_AVIF = os.getenv("IMAGE_DERIVATIVE_AVIF", "0") == "1"
+
+# Which derivatives exist is remembered per process for up to
+# DERIVATIVE_LOOKUP_CACHE_SIZE images, so pages don't check storage for every
+# width. An image missing a format (not written yet, or written by another
+# process) is looked up again after DERIVATIVE_MISS_TTL seconds, one with
+# every format after DERIVATIVE_LOOKUP_TTL (gc_images may have removed them).
+DERIVATIVE_LOOKUP_CACHE_SIZE = int(os.getenv("IMAGE_DERIVATIVE_LOOKUP_CACHE_SIZE", "4096"))
+DERIVATIVE_MISS_TTL = float(os.getenv("IMAGE_DERIVATIVE_MISS_TTL", "60"))
+DERIVATIVE_LOOKUP_TTL = float(os.getenv("IMAGE_DERIVATIVE_LOOKUP_TTL", "300"))
+
+_lookups = OrderedDict()
+_lookups_lock = threading.Lock()
+
+
+def derivative_formats():
+    formats = ["webp"]
+    if DERIVATIVE_AVIF:
+        formats.insert(0, "avif")
+    return formats
+
+
+def derivative_name(image_path, width, fmt):
+    """Storage name of one derivative, e.g. main/images/generated/3fa2..._512w.webp"""
+    base, _ = os.path.splitext(image_path)
+    return f"{base}_{width}w.{fmt}"
+
+
+def _complete(found):
+    return all(fmt in found for fmt in derivative_formats())
+
+
+def _cached_lookup(image_path):
+    """The remembered derivatives of image_path, or None if it must be looked up in storage."""
+    with _lookups_lock:
+        entry = _lookups.get(image_path)
+        if entry is None:
+            return None
+        found, checked_at = entry
+        ttl = DERIVATIVE_LOOKUP_TTL if _complete(found) else DERIVATIVE_MISS_TTL
+        if time.monotonic() - checked_at > ttl:
+            del _lookups[image_path]
+            return None
+        _lookups.move_to_end(image_path)
+        return found
+
+
+def _remember(image_path, found):
+    with _lookups_lock:
+        _lookups[image_path] = (found, time.monotonic())
+        _lookups.move_to_end(image_path)
+        while len(_lookups) > DERIVATIVE_LOOKUP_CACHE_SIZE:
+            _lookups.popitem(last=False)
+
+
+def make_derivatives(image_path, data, storage=None):
+    """
+    Write compressed, downscaled copies of a generated image to storage.
+
+    Each derivative is checked in storage, not in the per-process lookup
+    cache, so ones gc_images removed are written again. Only the image
+    header is read until a derivative turns out to be missing, so an image
+    whose derivatives all exist (a cache hit) is never decoded. What exists
+    afterwards is remembered for available_derivatives.
+
+    Args:
+        image_path (str): Storage name of the original image
+        data (bytes): The original image
+        storage: Storage to write to; defaults to get_storage()
+
+    Returns:
+        list: Storage names of the files written
+    """
+    try:
+        from PIL import Image, features
+    except ImportError:
+        logger.warning("Pillow is not installed; skipping image derivatives")
+        return []
+
+    storage = storage or get_storage()
+    formats = []
+    for fmt in derivative_formats():
+        if fmt == "avif" and not features.check("avif"):
+            logger.warning("Pillow was built without AVIF support; skipping AVIF derivatives")
+            continue
+        formats.append(fmt)
+
+    written = []
+    found = {}
+    # Image.open only parses the header; the pixels are decoded on the first resize or save
+    with Image.open(io.BytesIO(data)) as image:
+        missing = []
+        for fmt in formats:
+            for width in DERIVATIVE_WIDTHS:
+                if width > image.width:
+                    continue
+                name = derivative_name(image_path, width, fmt)
+                if storage.exists(name):
+                    found.setdefault(fmt, []).append((name, width))
+                else:
+                    missing.append((fmt, width, name))
+
+        for fmt, width, name in missing:
+            height = round(image.height * width / image.width)
+            resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, format=fmt.upper(), quality=DERIVATIVE_QUALITY)
+            written.append(storage.save(name, buffer.getvalue()))
+            found.setdefault(fmt, []).append((name, width))
+
+    _remember(image_path, {fmt: sorted(files, key=lambda item: item[1]) for fmt, files in found.items()})
+    if written:
+        logger.info(f"Wrote {len(written)} derivatives for {image_path}")
+    return written
+
+
+def available_derivatives(image_path):
+    """
+    The derivatives that exist for an image. Lookups are remembered per
+    process (see DERIVATIVE_LOOKUP_TTL), so rendering a page doesn't check
+    storage for every width of every image.
+
+    Returns:
+        dict: {fmt: [(derivative storage name, width), ...]} for each format with files in storage
+    """
+    found = _cached_lookup(image_path)
+    if found is not None:
+        return found
+    storage = get_storage()
+    found = {}
+    for fmt in derivative_formats():
+        for width in DERIVATIVE_WIDTHS:
+            name = derivative_name(image_path, width, fmt)
+            if storage.exists(name):
+                found.setdefault(fmt, []).append((name, width))
+    _remember(image_path, found)
+    return found
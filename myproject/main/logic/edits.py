@@ -0,0 +1,94 @@
+import copy
+
+from .linkify import get_linker
+
+
+def build_dependency_index(story_data):
+    """
+    Map every persona and location to the scenes that depend on it.
+
+    A scene depends on a persona or location when it lists it in
+    scene['characters'] / scene['location'], or mentions its name in the
+    image prompt or narration. Mentions are found with the story's cached
+    linkify matcher, so they agree with the names the pages link.
+
+    Returns:
+        dict: {'personas': {persona_id: [scene_id, ...]}, 'locations': {location_id: [scene_id, ...]}}
+    """
+    index = {'personas': {}, 'locations': {}}
+    scenes = story_data.get('scenes', [])
+    linker = get_linker(story_data)
+    mentioned = {
+        scene['id']: linker.mentions(scene.get('image_prompt')) | linker.mentions(scene.get('narration'))
+        for scene in scenes
+    }
+
+    for persona in story_data.get('persona_description', []):
+        name = persona['name']
+        index['personas'][persona['id']] = [
+            scene['id'] for scene in scenes
+            if any(character.lower() == name.lower() for character in scene.get('characters', []))
+            or name.casefold() in mentioned[scene['id']]
+        ]
+
+    for location in story_data.get('setting_description', []):
+        name = location['name']
+        index['locations'][location['id']] = [
+            scene['id'] for scene in scenes
+            if (scene.get('location') or '').lower() == name.lower()
+            or name.casefold() in mentioned[scene['id']]
+        ]
+
+    return index
+
+
+def scenes_sharing_entities(story_data, scene_id):
+    """Scene ids that share a persona or location with scene_id (including scene_id itself)."""
+    index = build_dependency_index(story_data)
+    affected = {scene_id}
+    for scene_ids in list(index['personas'].values()) + list(index['locations'].values()):
+        if scene_id in scene_ids:
+            affected.update(scene_ids)
+    return sorted(affected)
+
+
+def merge_story_patch(story_data, patch, scene_ids, persona_ids=None, location_ids=None):
+    """
+    Apply a structured patch from the text model to a copy of story_data.
+
+    Only the scenes, personas and locations the edit was allowed to touch are
+    replaced (matched by id); anything else in the patch is ignored. The
+    storyline is replaced only when the patch includes one.
+
+    Args:
+        story_data (dict): The story before the edit
+        patch (dict): Model output following story_patch_schema
+        scene_ids (list): Scene ids the patch may replace
+        persona_ids (list): Persona ids the patch may replace, or None for any
+        location_ids (list): Location ids the patch may replace, or None for any
+
+    Returns:
+        dict: The merged story
+    """
+    merged = copy.deepcopy(story_data)
+
+    if patch.get('storyline'):
+        merged['storyline'] = patch['storyline']
+
+    def replace_by_id(items, updates, allowed_ids):
+        positions = {item['id']: i for i, item in enumerate(items)}
+        for update in updates:
+            if update.get('id') in positions and (allowed_ids is None or update['id'] in allowed_ids):
+                items[positions[update['id']]] = update
+
+    replace_by_id(merged.get('persona_description', []), patch.get('persona_description', []), persona_ids)
+    replace_by_id(merged.get('setting_description', []), patch.get('setting_description', []), location_ids)
+
+    # Scenes are merged field by field so derived fields (image_path,
+    # enhanced_prompt) survive for the image-reuse check
+    scenes_by_id = {scene['id']: scene for scene in merged.get('scenes', [])}
+    for update in patch.get('scenes', []):
+        if update.get('id') in scenes_by_id and update['id'] in scene_ids:
+            scenes_by_id[update['id']].update(update)
+
+    return merged
@@ -0,0 +1,47 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def atomic_write(path, data):
+    """
+    Write bytes to path so readers see the old file or the new one, never
+    half of it: the data goes to a hidden temp file in the same directory,
+    which then replaces path.
+
+    Args:
+        path (str | Path): File to write; its directory must exist
+        data (bytes): The new contents
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on path (created if missing) for the block, across
+    every process on the host. Without fcntl (Windows) this only serialises
+    callers that share a threading lock of their own.
+    """
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
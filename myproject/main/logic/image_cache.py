@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from .files import atomic_write, file_lock
+
+logger = logging.getLogger(__name__)
+
+# Temp files older than this were left by a writer that died mid-write
+STALE_TMP_SECONDS = 60 * 60
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of generated images.
+
+    Entries are keyed on a hash of (model, aspect ratio, enhanced prompt) so any
+    repeat prompt - from another session, another scene id or an earlier story
+    version - is served without calling the image model. Blobs are named after
+    their key and live next to an index.json of each entry's size and last
+    access.
+
+    Every process using root shares the index. Lookups never write it: a hit
+    only updates this process's access time, which reaches the index with its
+    next put. A put rewrites the index under a lock file, merged with what
+    other processes wrote since, so the least recently used entries of the
+    whole cache are evicted once max_bytes or max_entries is exceeded. Blobs
+    no entry references (left by a crash, or evicted by another process) are
+    removed at the same time. Hit and miss counts are per process.
+
+    Args:
+        root (str | Path): Directory holding the blobs and index
+        max_bytes (int): Total blob size to keep before evicting
+        max_entries (int): Number of blobs to keep before evicting
+    """
+
+    INDEX_NAME = "index.json"
+    LOCK_NAME = ".lock"
+    # What the blobs are, for log messages
+    KIND = "image"
+
+    def __init__(self, root, max_bytes=500 * 1024 * 1024, max_entries=2000):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = self._read_index()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, aspect_ratio, prompt):
+        payload = json.dumps([model, aspect_ratio, prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _blob_path(self, key):
+        return self.root / key
+
+    def _read_index(self):
+        index_path = self.root / self.INDEX_NAME
+        try:
+            with open(index_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable {self.KIND} cache index {index_path}: {e}")
+            return {}
+        return data.get("entries", {})
+
+    def _save_index(self):
+        atomic_write(
+            self.root / self.INDEX_NAME,
+            json.dumps({"entries": self.entries}, separators=(",", ":")).encode("utf-8"),
+        )
+
+    def get(self, key):
+        """Return the cached blob path for key, or None on a miss."""
+        with self.lock:
+            blob_path = self._blob_path(key)
+            try:
+                size = blob_path.stat().st_size
+            except FileNotFoundError:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            # Adopts entries other processes wrote since we read the index
+            entry = self.entries.setdefault(key, {"size": size})
+            entry["last_access"] = time.time()
+            self.hits += 1
+            return blob_path
+
+    def discard(self, key):
+        """Forget key after its blob could not be read (evicted by another process); the lookup counts as a miss."""
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.hits -= 1
+                self.misses += 1
+
+    def put(self, key, data, **metadata):
+        """Store image bytes in the cache under key and evict if over budget."""
+        with self.lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with file_lock(self.root / self.LOCK_NAME):
+                self._sync()
+                blob_path = self._blob_path(key)
+                atomic_write(blob_path, data)
+                self.entries[key] = {
+                    "size": len(data),
+                    "last_access": time.time(),
+                    **metadata,
+                }
+                self._evict()
+                self._save_index()
+
+    def _sync(self):
+        """
+        Merge the index on disk into ours and sweep orphaned blobs. Call
+        holding the lock file.
+
+        Entries come from either index, with the later access time, as long
+        as their blob still exists; blobs no entry references are deleted.
+        """
+        on_disk = self._read_index()
+        names = {self._blob_path(key).name: key for key in {**self.entries, **on_disk}}
+        now = time.time()
+        blobs = {}
+        for item in os.scandir(self.root):
+            if not item.is_file() or item.name == self.INDEX_NAME:
+                continue
+            if item.name.startswith("."):
+                if item.name.endswith(".tmp") and item.stat().st_mtime < now - STALE_TMP_SECONDS:
+                    os.unlink(item.path)
+                continue
+            if item.name not in names:
+                os.unlink(item.path)
+                logger.info(f"Removed unindexed {self.KIND} cache file {item.name}")
+                continue
+            blobs[names[item.name]] = item.stat().st_size
+
+        entries = {}
+        for key, size in blobs.items():
+            ours = self.entries.get(key, {})
+            theirs = on_disk.get(key, {})
+            entries[key] = {
+                **ours,
+                **theirs,
+                "size": size,
+                "last_access": max(ours.get("last_access", 0), theirs.get("last_access", 0)),
+            }
+        self.entries = entries
+
+    def _evict(self):
+        total_bytes = sum(entry.get("size", 0) for entry in self.entries.values())
+        by_age = sorted(self.entries.items(), key=lambda item: item[1].get("last_access", 0))
+        for key, entry in by_age:
+            if total_bytes <= self.max_bytes and len(self.entries) <= self.max_entries:
+                break
+            self._blob_path(key).unlink(missing_ok=True)
+            del self.entries[key]
+            total_bytes -= entry.get("size", 0)
+            logger.info(f"Evicted cached {self.KIND} {key}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": sum(entry.get("size", 0) for entry in self.entries.values()),
+            }
@@ -0,0 +1,98 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+from django.contrib.sessions.models import Session
+from django.db.models import F
+from django.utils import timezone
+
+from ..models import Scene, StoryJob
+from .derivatives import derivative_formats, derivative_name, DERIVATIVE_WIDTHS
+from .interaction_log import iter_interactions
+from .storage import GENERATED_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+def _scene_paths(story):
+    if not isinstance(story, dict):
+        return set()
+    return {scene.get('image_path') for scene in story.get('scenes', []) if scene.get('image_path')}
+
+
+def referenced_image_paths(log_dir=None, current_only=False):
+    """
+    Every image_path something still points at: story versions, story jobs,
+    live sessions (older sessions stored the whole story) and interaction logs.
+
+    With current_only, only each story's current version counts and the
+    interaction logs (which record every version) are not read. Story job
+    results still count, so a story's first version keeps its images until
+    its job is deleted.
+    """
+    referenced = set()
+
+    scenes = Scene.objects.all()
+    if current_only:
+        scenes = scenes.filter(version__story__current_version=F('version'))
+    referenced.update(p for p in scenes.values_list('image_path', flat=True) if p)
+
+    for result in StoryJob.objects.exclude(result=None).values_list('result', flat=True).iterator():
+        referenced |= _scene_paths(result)
+
+    for session in Session.objects.filter(expire_date__gt=timezone.now()).iterator():
+        referenced |= _scene_paths(session.get_decoded().get('story'))
+
+    if log_dir is not None and not current_only:
+        log_dir = Path(log_dir)
+        for entry in iter_interactions(log_dir):
+            referenced |= _scene_paths(entry.get('story'))
+        # Per-action JSON files written before the JSON Lines logger
+        for legacy in log_dir.glob("interaction_*.json"):
+            try:
+                with open(legacy) as f:
+                    referenced |= _scene_paths(json.load(f).get('output_data'))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable log {legacy}: {e}")
+
+    # Derivatives live and die with their original
+    for image_path in list(referenced):
+        for fmt in derivative_formats():
+            for width in DERIVATIVE_WIDTHS:
+                referenced.add(derivative_name(image_path, width, fmt))
+    return referenced
+
+
+def collect_garbage(storage, referenced, grace_seconds, dry_run=False, archive_dir=None):
+    """
+    Remove (or move to archive_dir) generated images nothing references that
+    are older than grace_seconds. Storage save() refreshes the modification
+    time of a file it is asked to save again, so an image reused from the
+    image cache, or one a page is about to record on a scene, is not
+    collected before its scene row points at it.
+
+    Returns:
+        dict: {'scanned', 'removed', 'bytes_reclaimed', 'files'}
+    """
+    cutoff = time.time() - grace_seconds
+    report = {'scanned': 0, 'removed': 0, 'bytes_reclaimed': 0, 'files': []}
+
+    for name, size, modified in list(storage.listdir(GENERATED_PREFIX)):
+        report['scanned'] += 1
+        if name in referenced or modified > cutoff:
+            continue
+        report['removed'] += 1
+        report['bytes_reclaimed'] += size
+        report['files'].append(name)
+        if dry_run:
+            continue
+        if archive_dir is not None:
+            target = Path(archive_dir) / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(storage.read(name))
+        storage.delete(name)
+        logger.info(f"{'Archived' if archive_dir else 'Deleted'} unreferenced image {name}")
+
+    return report
@@ -0,0 +1,245 @@
+import atexit
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+
+from .files import atomic_write, file_lock
+from .metrics import span
+
+logger = logging.getLogger(__name__)
+
+STORY_LIST_FIELDS = ('persona_description', 'setting_description', 'scenes')
+# Diff entry listing the top-level keys new no longer has
+REMOVED_KEYS = '_removed'
+
+
+def story_diff(old, new):
+    """
+    Describe how new differs from old.
+
+    Top-level values are included when they changed, and keys new dropped
+    are listed under REMOVED_KEYS. For personas, locations and scenes only
+    the items (matched by id) that changed are included, plus the ids that
+    were removed.
+    """
+    diff = {}
+    for key, value in new.items():
+        if key in STORY_LIST_FIELDS:
+            continue
+        if key not in old or old[key] != value:
+            diff[key] = value
+    removed_keys = sorted(key for key in old if key not in new)
+    if removed_keys:
+        diff[REMOVED_KEYS] = removed_keys
+
+    for field in STORY_LIST_FIELDS:
+        if field not in new:
+            continue
+        old_items = {item['id']: item for item in old.get(field, [])}
+        new_items = new.get(field, [])
+        changed = [item for item in new_items if old_items.get(item['id']) != item]
+        removed = sorted(set(old_items) - {item['id'] for item in new_items})
+        order = [item['id'] for item in new_items]
+        if changed or removed or order != list(old_items):
+            diff[field] = {'changed': changed, 'removed': removed, 'order': order}
+    return diff
+
+
+def apply_story_diff(old, diff):
+    """Rebuild the story that story_diff(old, new) was computed from."""
+    story = copy.deepcopy(old)
+    for key in diff.get(REMOVED_KEYS, []):
+        story.pop(key, None)
+    for key, value in diff.items():
+        if key not in STORY_LIST_FIELDS and key != REMOVED_KEYS:
+            story[key] = value
+    for field in STORY_LIST_FIELDS:
+        if field not in diff:
+            continue
+        items = {item['id']: item for item in story.get(field, [])}
+        for item in diff[field]['changed']:
+            items[item['id']] = item
+        for item_id in diff[field]['removed']:
+            items.pop(item_id, None)
+        story[field] = [items[item_id] for item_id in diff[field]['order'] if item_id in items]
+    return story
+
+
+class InteractionLogger:
+    """
+    Appends interactions as compact JSON Lines from a background thread.
+
+    Requests only enqueue an entry. A flusher thread batches entries every
+    flush_interval seconds into <log_dir>/interactions.jsonl, rotating it once
+    it passes max_bytes (rotated files are gzip-compressed when compress is
+    set). Each entry stores a diff against the previous version of the same
+    story logged by this process; the first entry for a story in each file
+    stores it in full.
+
+    Processes may share log_dir: each append and rotation (compression
+    included) holds a lock file in it, and a process that finds the current
+    file was rotated by another starts its stories over in full, so every
+    file reads on its own.
+    """
+
+    CURRENT_NAME = "interactions.jsonl"
+    LOCK_NAME = ".lock"
+    # Name of the last rotated file, so other processes notice the rotation
+    ROTATION_NAME = ".rotation"
+
+    def __init__(self, log_dir, max_bytes=10 * 1024 * 1024, compress=True, flush_interval=1.0):
+        self.log_dir = Path(log_dir)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.last_story = {}
+        # The last rotation this process has seen (see ROTATION_NAME)
+        self.rotation = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _ensure_thread(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="interaction-log", daemon=True)
+                    self.thread.start()
+                    atexit.register(self.flush)
+
+    def log(self, action_type, user_input, story, story_id=None, **extra):
+        """Queue an interaction; returns immediately."""
+        self._ensure_thread()
+        with span("log_write", phase="enqueue"):
+            self.queue.put({
+                'timestamp': datetime.now().isoformat(),
+                'action_type': action_type,
+                'user_input': user_input,
+                'story_id': story_id,
+                'story': copy.deepcopy(story),
+                **extra,
+            })
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush interaction log: {e}")
+
+    def flush(self):
+        """Write every queued entry to disk."""
+        with self.lock:
+            entries = []
+            while True:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not entries:
+                return
+
+            with span("log_write", phase="flush"):
+                self.log_dir.mkdir(parents=True, exist_ok=True)
+                current = self.log_dir / self.CURRENT_NAME
+                with file_lock(self.log_dir / self.LOCK_NAME):
+                    rotation = self._last_rotation()
+                    if rotation != self.rotation:
+                        # Rotated by another process: this file must start with full stories
+                        self.last_story.clear()
+                        self.rotation = rotation
+                    lines = ''.join(
+                        json.dumps(self._compact(entry), separators=(',', ':'), ensure_ascii=False) + '\n'
+                        for entry in entries
+                    )
+                    with open(current, 'a', encoding='utf-8') as f:
+                        f.write(lines)
+                    if current.stat().st_size >= self.max_bytes:
+                        rotated = self._rotate(current)
+                        # Under the lock, so another rotation can't reuse the name mid-gzip
+                        if self.compress:
+                            self._compress(rotated)
+
+    def _last_rotation(self):
+        try:
+            return (self.log_dir / self.ROTATION_NAME).read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return ''
+
+    def _compact(self, entry):
+        # Diffs chain per process, so the reader keys stories on (pid, story_id)
+        entry['pid'] = os.getpid()
+        story = entry.pop('story')
+        key = entry['story_id']
+        previous = self.last_story.get(key) if key is not None else None
+        if previous is None:
+            entry['story'] = story
+        else:
+            entry['diff'] = story_diff(previous, story)
+        if key is not None:
+            self.last_story[key] = story
+        return entry
+
+    def _rotate(self, current):
+        """Move the current file aside; call holding the lock file."""
+        rotated = self.log_dir / f"interactions-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.jsonl"
+        os.replace(current, rotated)
+        atomic_write(self.log_dir / self.ROTATION_NAME, rotated.name.encode('utf-8'))
+        # The next file must be readable on its own, so start it with full stories
+        self.last_story.clear()
+        self.rotation = rotated.name
+        logger.info(f"Rotated interaction log {rotated}")
+        return rotated
+
+    def _compress(self, rotated):
+        with open(rotated, 'rb') as src, gzip.open(f"{rotated}.gz", 'wb') as dst:
+            dst.writelines(src)
+        rotated.unlink()
+
+
+def log_files(log_dir):
+    """Interaction log files in the order they were written."""
+    log_dir = Path(log_dir)
+    rotated = sorted(log_dir.glob("interactions-*.jsonl*"))
+    current = log_dir / InteractionLogger.CURRENT_NAME
+    return rotated + ([current] if current.exists() else [])
+
+
+def iter_interactions(log_dir):
+    """
+    Stream logged interactions back, oldest first, with the full story rebuilt.
+
+    Yields:
+        dict: The logged entry with 'story' set to the complete story after the interaction
+    """
+    stories = {}
+    for path in log_files(log_dir):
+        opener = gzip.open if path.suffix == '.gz' else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = (entry.get('pid'), entry.get('story_id'))
+                if 'diff' in entry:
+                    entry['story'] = apply_story_diff(stories.get(key, {}), entry.pop('diff'))
+                if entry.get('story_id') is not None:
+                    stories[key] = entry['story']
+                yield entry
+
+
+interaction_logger = InteractionLogger(
+    os.getenv("INTERACTION_LOG_DIR", str(settings.BASE_DIR / "user_logs")),
+    max_bytes=int(os.getenv("INTERACTION_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    compress=os.getenv("INTERACTION_LOG_COMPRESS", "1") == "1",
+)
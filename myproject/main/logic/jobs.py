@@ -0,0 +1,129 @@
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from ..models import StoryJob
+from .ai import storyGenerate
+
+logger = logging.getLogger(__name__)
+
+# Story generation runs here instead of on the request thread, so a few web
+# workers can serve many creators while Gemini is busy.
+STORY_JOB_WORKERS = int(os.getenv("STORY_JOB_WORKERS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=STORY_JOB_WORKERS, thread_name_prefix="story-job")
+
+# Jobs only live in this process's executor, so a restart loses them. While
+# a job is queued or running here its updated_at is bumped every
+# STORY_JOB_HEARTBEAT_SECONDS; one not bumped for STORY_JOB_STALE_SECONDS
+# was lost and is marked failed (see fail_if_stale).
+STORY_JOB_HEARTBEAT_SECONDS = float(os.getenv("STORY_JOB_HEARTBEAT_SECONDS", "30"))
+STORY_JOB_STALE_SECONDS = float(os.getenv("STORY_JOB_STALE_SECONDS", "120"))
+STALE_JOB_ERROR = "Story generation was interrupted by a server restart"
+
+_live_jobs = set()
+_live_lock = threading.Lock()
+_heartbeat = None
+
+
+def _ensure_heartbeat():
+    global _heartbeat
+    with _live_lock:
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_beat, name="story-job-heartbeat", daemon=True)
+            _heartbeat.start()
+
+
+def _beat():
+    while True:
+        time.sleep(STORY_JOB_HEARTBEAT_SECONDS)
+        with _live_lock:
+            job_ids = list(_live_jobs)
+        if not job_ids:
+            continue
+        try:
+            close_old_connections()
+            StoryJob.objects.filter(
+                id__in=job_ids, status__in=[StoryJob.QUEUED, StoryJob.RUNNING]
+            ).update(updated_at=timezone.now())
+        except Exception as e:
+            logger.error(f"Story job heartbeat failed: {e}")
+
+
+def fail_if_stale(job_id, status, updated_at):
+    """
+    Mark a queued or running job failed if its heartbeat stopped, i.e. the
+    process running it went away.
+
+    Returns:
+        bool: True if the job was marked failed
+    """
+    if status not in (StoryJob.QUEUED, StoryJob.RUNNING):
+        return False
+    cutoff = timezone.now() - timedelta(seconds=STORY_JOB_STALE_SECONDS)
+    if updated_at >= cutoff:
+        return False
+    marked = StoryJob.objects.filter(id=job_id, status=status, updated_at__lt=cutoff).update(
+        status=StoryJob.FAILED, error=STALE_JOB_ERROR, updated_at=timezone.now()
+    )
+    if marked:
+        logger.warning(f"Story job {job_id} lost its worker; marked failed")
+    return bool(marked)
+
+
+def submit_story_job(idea):
+    """Queue a story generation for this idea and return the StoryJob row."""
+    job = StoryJob.objects.create(idea=idea)
+    with _live_lock:
+        _live_jobs.add(job.id)
+    _ensure_heartbeat()
+    _executor.submit(run_story_job, job.id)
+    logger.info(f"Queued story job {job.id}")
+    return job
+
+
+def run_story_job(job_id):
+    """Generate the story for a queued job and record the result on its row."""
+    close_old_connections()
+    try:
+        # Claim the job atomically so it only ever runs once
+        claimed = StoryJob.objects.filter(id=job_id, status=StoryJob.QUEUED).update(status=StoryJob.RUNNING, updated_at=timezone.now())
+        if not claimed:
+            return
+
+        progress = {}
+
+        def save_progress(story=None):
+            # Partial results are what the storyboard streams while images render
+            if story is not None:
+                progress['story'] = story
+            StoryJob.objects.filter(id=job_id).update(result=progress['story'], updated_at=timezone.now())
+
+        try:
+            result = storyGenerate(
+                StoryJob.objects.values_list('idea', flat=True).get(id=job_id),
+                on_story=save_progress,
+                on_scene=lambda scene: save_progress()
+            )
+        except Exception as e:
+            logger.error(f"Story job {job_id} failed: {e}")
+            StoryJob.objects.filter(id=job_id).update(
+                status=StoryJob.FAILED, error=str(e), updated_at=timezone.now()
+            )
+            return
+
+        job = StoryJob.objects.get(id=job_id)
+        job.result = result
+        job.status = StoryJob.DONE
+        job.save(update_fields=['result', 'status', 'updated_at'])
+        logger.info(f"Story job {job_id} finished")
+    finally:
+        with _live_lock:
+            _live_jobs.discard(job_id)
+        close_old_connections()
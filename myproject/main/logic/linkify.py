@@ -0,0 +1,97 @@
+import functools
+import os
+import re
+
+from django.utils.html import escape
+from django.utils.safestring import SafeData, mark_safe
+
+# Compiled linkers kept for recently rendered story versions
+LINKIFY_CACHE_SIZE = int(os.getenv("LINKIFY_CACHE_SIZE", "256"))
+
+LOCATION_LINK = ('/locations/?location={}', 'text-success fw-bold')
+CHARACTER_LINK = ('/personas/?character={}', 'text-primary fw-bold')
+
+
+def names_key(story_data):
+    """
+    Cache key for a story version's linker: its location and persona names.
+
+    Versions are immutable, so two renders of the same version always agree,
+    and versions that only changed scenes or the storyline share one linker.
+    """
+    return (
+        tuple(location['name'] for location in story_data.get('setting_description', [])),
+        tuple(persona['name'] for persona in story_data.get('persona_description', [])),
+    )
+
+
+class Linker:
+    """
+    Links every persona and location name in a text in one regex pass.
+
+    Names are tried longest first, so "Old Mill Road" wins over "Old Mill";
+    a location wins over a persona with the same name. Text that isn't
+    already marked safe is HTML-escaped, links included, so model output
+    can't inject markup.
+
+    Args:
+        location_names (tuple): Names linked to the locations page
+        character_names (tuple): Names linked to the personas page
+    """
+
+    def __init__(self, location_names, character_names):
+        self.links = {}
+        names = []
+        for link, group in ((LOCATION_LINK, location_names), (CHARACTER_LINK, character_names)):
+            for name in group:
+                # An empty name would match between every two characters
+                if name and name.casefold() not in self.links:
+                    self.links[name.casefold()] = (escape(link[0].format(name)), link[1])
+                    names.append(name)
+        names.sort(key=len, reverse=True)
+        self.pattern = None
+        if names:
+            self.pattern = re.compile(r'\b(?:' + '|'.join(map(re.escape, names)) + r')\b', re.IGNORECASE)
+
+    def _link(self, text, quote):
+        link = self.links.get(text.casefold())
+        text = quote(text)
+        if link is None:
+            return text
+        return f'<a href="{link[0]}" class="{link[1]}">{text}</a>'
+
+    def mentions(self, text):
+        """The names text mentions, casefolded."""
+        if self.pattern is None or not text:
+            return set()
+        return {match.group(0).casefold() for match in self.pattern.finditer(text)}
+
+    def linkify(self, text):
+        quote = str if isinstance(text, SafeData) else escape
+        if self.pattern is None:
+            return mark_safe(quote(text))
+        pieces = []
+        end = 0
+        for match in self.pattern.finditer(text):
+            pieces.append(quote(text[end:match.start()]))
+            pieces.append(self._link(match.group(0), quote))
+            end = match.end()
+        pieces.append(quote(text[end:]))
+        return mark_safe(''.join(pieces))
+
+
+@functools.lru_cache(maxsize=LINKIFY_CACHE_SIZE)
+def _cached_linker(key):
+    return Linker(*key)
+
+
+def get_linker(story_data):
+    """The compiled Linker for story_data's names, built once per version."""
+    return _cached_linker(names_key(story_data))
+
+
+def linkify(text, story_data):
+    """text with persona and location names linked, marked safe."""
+    if not text or not story_data:
+        return text
+    return get_linker(story_data).linkify(text)
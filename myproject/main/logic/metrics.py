@@ -0,0 +1,156 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the stage duration histogram buckets; image calls
+# take tens of seconds, template renders a few milliseconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Spans finished on the current request's thread, for the Server-Timing header
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+# The innermost open span, so backends can attach token counts to it
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Registry:
+    """
+    In-process store of stage metrics, rendered in the Prometheus text format.
+
+    Every metric is keyed by name and a sorted tuple of label pairs. Counts are
+    per process; scrape each worker, or sum them in Prometheus.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @staticmethod
+    def _labels(pairs, extra=()):
+        pairs = list(pairs) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: {**value, "buckets": list(value["buckets"])} for key, value in self.histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Span:
+    """One timed stage. Attach counts with set(); they become counters when the span ends."""
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.counts = {}
+        self.duration = 0.0
+
+    def set(self, **counts):
+        self.counts.update(counts)
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Time a pipeline stage, e.g. `with span("text_model", call="storyGenerate") as s:`.
+
+    Records story_stage_seconds{stage=...}, story_stage_errors_total when the
+    block raises, and story_stage_tokens_total / story_stage_retries_total
+    from counts set on the span.
+    """
+    current = Span(stage, labels)
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        registry.inc("story_stage_errors_total", stage=stage, **labels)
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        registry.observe("story_stage_seconds", current.duration, stage=stage, **labels)
+        for kind in ("prompt_tokens", "output_tokens"):
+            if current.counts.get(kind):
+                registry.inc("story_stage_tokens_total", current.counts[kind], stage=stage, kind=kind.split("_")[0], **labels)
+        if current.counts.get("retries"):
+            registry.inc("story_stage_retries_total", current.counts["retries"], stage=stage, **labels)
+        finished = _request_spans.get()
+        if finished is not None:
+            finished.append(current)
+
+
+def record_tokens(prompt_tokens=0, output_tokens=0):
+    """Add token counts to the innermost open span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.add(prompt_tokens=prompt_tokens or 0, output_tokens=output_tokens or 0)
+
+
+@contextmanager
+def collect_request_spans():
+    """Collect the spans finished during a request; yields the list they land in."""
+    finished = []
+    token = _request_spans.set(finished)
+    try:
+        yield finished
+    finally:
+        _request_spans.reset(token)
+
+
+def server_timing(spans, total=None):
+    """Server-Timing header value: total milliseconds per stage, e.g. `text_model;dur=812.4;desc="x1"`."""
+    per_stage = {}
+    for finished in spans:
+        duration, count = per_stage.get(finished.stage, (0.0, 0))
+        per_stage[finished.stage] = (duration + finished.duration, count + 1)
+    entries = [f'{stage};dur={duration * 1000:.1f};desc="x{count}"' for stage, (duration, count) in per_stage.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
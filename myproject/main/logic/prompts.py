@@ -0,0 +1,63 @@
+import json
+import re
+from functools import lru_cache
+
+
+def persona_image_description(persona):
+    return f"{persona['name']}, {persona['age']} years old, with {persona['hair']} hair, {persona['skin']} skin, wearing {persona['clothing']}"
+
+
+class PromptExpander:
+    """
+    Expands persona and location names in a scene image prompt into their full
+    descriptions in a single regex pass.
+
+    All names are compiled into one case-insensitive alternation (longest name
+    first, so "Anna Lee" wins over "Anna"). Because the whole prompt is scanned
+    once, text that was just substituted in is never matched again by a later
+    name.
+    """
+
+    def __init__(self, persona_description, setting_description):
+        self.descriptions = {}
+        for persona in persona_description:
+            self.descriptions.setdefault(persona['name'].lower(), persona_image_description(persona))
+        for location in setting_description:
+            self.descriptions.setdefault(location['name'].lower(), location['description'])
+
+        names = sorted((name for name in self.descriptions if name), key=len, reverse=True)
+        if names:
+            self.pattern = re.compile(
+                r'\b(?:' + '|'.join(re.escape(name) for name in names) + r')\b',
+                flags=re.IGNORECASE
+            )
+        else:
+            self.pattern = None
+
+    def _replace(self, match):
+        return self.descriptions.get(match.group(0).lower(), match.group(0))
+
+    def expand_names(self, text):
+        if self.pattern is None or not text:
+            return text
+        return self.pattern.sub(self._replace, text)
+
+    def expand(self, image_prompt, emotional_tones):
+        """Build the enhanced prompt sent to the image model for one scene."""
+        tone_text = ", ".join(emotional_tones)
+        return f"{self.expand_names(image_prompt)}. The image should reflect the emotional tones: {tone_text}."
+
+
+@lru_cache(maxsize=128)
+def _expander_for_fingerprint(fingerprint):
+    personas, settings = json.loads(fingerprint)
+    return PromptExpander(personas, settings)
+
+
+def get_prompt_expander(story_data):
+    """Return the PromptExpander for this story version, building it only once."""
+    fingerprint = json.dumps(
+        [story_data.get('persona_description', []), story_data.get('setting_description', [])],
+        sort_keys=True
+    )
+    return _expander_for_fingerprint(fingerprint)
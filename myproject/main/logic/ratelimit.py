@@ -0,0 +1,205 @@
+import contextvars
+import logging
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Rate classes. Interactive calls (someone is waiting on a page) take tokens
+# before batch calls (batch_generate) whenever both are queued on a model.
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+_rate_class = contextvars.ContextVar("rate_class", default=INTERACTIVE)
+
+
+@contextmanager
+def rate_class(name):
+    """Run the block's model calls in a rate class, e.g. `with rate_class(BATCH):`."""
+    token = _rate_class.set(name)
+    try:
+        yield
+    finally:
+        _rate_class.reset(token)
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket used to pace calls to the Gemini APIs.
+
+    Args:
+        rate_per_minute (float): Sustained number of calls allowed per minute
+        burst (int): Number of calls that may start back-to-back before pacing kicks in
+    """
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, int(burst))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        # Nothing accrues while blocked, so a lifted block doesn't release a burst
+        elapsed = max(0.0, now - max(self.updated, self.blocked_until))
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait_time = self.blocked_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def penalize(self, retry_after):
+        """The API said slow down: hand out nothing for retry_after seconds, then start from an empty bucket."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.blocked_until = max(self.blocked_until, self.updated + retry_after)
+            self.tokens = 0.0
+
+
+class SharedRateLimiter:
+    """
+    Token bucket for one model, shared by every process on the host through a
+    SQLite file: gunicorn workers, story jobs and batch_generate all draw on
+    the same quota, so together they stay at the ceiling instead of each
+    assuming it has the whole of it.
+
+    A 429's Retry-After (see penalize) blocks the model for every process at
+    once. When the block lifts the bucket starts empty, so callers resume at
+    the sustained rate rather than all at once. Batch callers wait while an
+    interactive caller is waiting for a token.
+
+    Processes sharing a file should agree on each model's rate.
+
+    Args:
+        path (str | Path): SQLite file holding the buckets
+        key (str): Bucket name, the model name
+        rate_per_minute (float): Sustained calls per minute; 0 only honours penalize()
+        burst (int): Calls that may start back-to-back
+    """
+
+    def __init__(self, path, key, rate_per_minute, burst=1):
+        self.path = str(path)
+        self.key = key
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, int(burst))
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+                "blocked_until REAL NOT NULL, interactive_until REAL NOT NULL)"
+            )
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _bucket(self):
+        """Yield the bucket as a dict under the database write lock, then store it."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated, blocked_until, interactive_until FROM buckets WHERE key = ?", (self.key,)
+            ).fetchone()
+            now = time.time()
+            if row is None:
+                bucket = {"tokens": float(self.capacity), "updated": now, "blocked_until": 0.0, "interactive_until": 0.0}
+            else:
+                bucket = dict(zip(("tokens", "updated", "blocked_until", "interactive_until"), row))
+            # Nothing accrues while blocked, so a lifted block doesn't release a burst
+            elapsed = max(0.0, now - max(bucket["updated"], bucket["blocked_until"]))
+            bucket["tokens"] = min(self.capacity, bucket["tokens"] + elapsed * self.rate)
+            bucket["updated"] = now
+            yield bucket
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                (self.key, bucket["tokens"], bucket["updated"], bucket["blocked_until"], bucket["interactive_until"]),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _take(self, interactive):
+        """Take a token if one is free to this caller; returns 0, or seconds to wait before trying again."""
+        with self._bucket() as bucket:
+            now = bucket["updated"]
+            if now < bucket["blocked_until"]:
+                wait_time = bucket["blocked_until"] - now
+            elif not interactive and now < bucket["interactive_until"]:
+                wait_time = bucket["interactive_until"] - now
+            elif self.rate <= 0:
+                return 0
+            elif bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return 0
+            else:
+                wait_time = (1 - bucket["tokens"]) / self.rate
+            if interactive:
+                # Hold the next token (and one after it) back from batch callers
+                hold = wait_time + (1 / self.rate if self.rate > 0 else 0)
+                bucket["interactive_until"] = max(bucket["interactive_until"], now + hold)
+            return wait_time
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        interactive = _rate_class.get() != BATCH
+        while True:
+            wait_time = self._take(interactive)
+            if wait_time <= 0:
+                return
+            # Jitter, so processes woken by the same refill don't collide on the lock
+            time.sleep(wait_time * random.uniform(1.0, 1.1))
+
+    def penalize(self, retry_after):
+        """The API said slow down: block the model for every process for retry_after seconds."""
+        with self._bucket() as bucket:
+            bucket["blocked_until"] = max(bucket["blocked_until"], bucket["updated"] + retry_after)
+            bucket["tokens"] = 0.0
+        logger.warning(f"Rate limited on {self.key}; pausing it for {retry_after:.1f}s")
+
+
+class CappedRateLimiter:
+    """
+    A shared limiter under a lower ceiling of this process's own: a call
+    waits for a local token, then for a shared one. Lets one process (a
+    batch) use less than the quota without changing the rate the shared
+    bucket refills at for everyone else.
+
+    Args:
+        shared (SharedRateLimiter): The model's quota, shared across processes
+        cap (RateLimiter): This process's ceiling
+    """
+
+    def __init__(self, shared, cap):
+        self.shared = shared
+        self.cap = cap
+
+    def acquire(self):
+        self.cap.acquire()
+        self.shared.acquire()
+
+    def penalize(self, retry_after):
+        self.shared.penalize(retry_after)
@@ -0,0 +1,126 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Priorities: lower runs sooner. Someone is looking at these scenes right now
+VISIBLE = 0
+# Generated ahead of time while the user reads text; scene order is added on top
+SPECULATIVE = 100
+
+
+class _Job:
+    __slots__ = ('key', 'fn', 'context', 'priority', 'groups', 'future', 'started')
+
+    def __init__(self, key, fn, context, priority):
+        self.key = key
+        self.fn = fn
+        self.context = context
+        self.priority = priority
+        # Who still wants this image; None stands for callers outside any group
+        self.groups = set()
+        self.future = Future()
+        self.started = False
+
+
+class ImageScheduler:
+    """
+    Priority queue of image generations shared by every request and story job.
+
+    Jobs are keyed (by image cache key) so the same image is generated once no
+    matter how many callers ask for it; asking again with a lower priority
+    moves the job up. Callers name the group (a story) they want a job for;
+    supersede() drops a group's claim on queued jobs its latest edit no longer
+    needs, and cancels those nobody else wants. Jobs already running finish,
+    and their images land in the image cache.
+
+    Args:
+        workers (int): Jobs that may run at once
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.heap = []
+        self.jobs = {}
+        self.counter = itertools.count()
+        self.threads = []
+
+    def _ensure_threads(self):
+        if not self.threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"scene-image-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, key, fn, priority=SPECULATIVE, group=None):
+        """
+        Queue fn() under key unless it is already queued or running.
+
+        Returns:
+            Future: Resolves to fn's return value
+        """
+        with self.lock:
+            self._ensure_threads()
+            job = self.jobs.get(key)
+            if job is None or job.future.done():
+                # The worker runs fn in the submitter's context so spans reach its request
+                job = self.jobs[key] = _Job(key, fn, contextvars.copy_context(), priority)
+                heapq.heappush(self.heap, (priority, next(self.counter), job))
+                self.wakeup.notify()
+            elif not job.started and priority < job.priority:
+                job.priority = priority
+                heapq.heappush(self.heap, (priority, next(self.counter), job))
+            job.groups.add(group)
+            return job.future
+
+    def supersede(self, group, keep_keys):
+        """Withdraw group from queued jobs not in keep_keys, cancelling any left unwanted; returns how many."""
+        cancelled = 0
+        with self.lock:
+            for key, job in list(self.jobs.items()):
+                if group not in job.groups or key in keep_keys or job.started:
+                    continue
+                job.groups.discard(group)
+                if not job.groups:
+                    job.future.cancel()
+                    del self.jobs[key]
+                    cancelled += 1
+        if cancelled:
+            logger.info(f"Cancelled {cancelled} queued image jobs superseded in {group}")
+        return cancelled
+
+    def pending(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if not job.started)
+
+    def _next_job(self):
+        with self.lock:
+            while True:
+                while self.heap:
+                    priority, _, job = heapq.heappop(self.heap)
+                    # Skip entries left behind by a re-prioritisation or cancellation
+                    if job.started or job.future.cancelled() or priority != job.priority:
+                        continue
+                    job.started = True
+                    job.future.set_running_or_notify_cancel()
+                    return job
+                self.wakeup.wait()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            try:
+                job.future.set_result(job.context.run(job.fn))
+            except BaseException as e:
+                job.future.set_exception(e)
+            finally:
+                with self.lock:
+                    if self.jobs.get(job.key) is job:
+                        del self.jobs[job.key]
+
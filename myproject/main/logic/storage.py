@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.core.exceptions import ImproperlyConfigured
+from django.templatetags.static import static
+from django.urls import reverse
+
+from .files import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Where generated images live inside the storage, and the static path prefix
+# scenes store in image_path
+GENERATED_PREFIX = "main/images/generated/"
+
+# Generated files are named after their content, so they never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# How often S3Storage refreshes an object it is asked to save again, so
+# gc_images' grace period (counted from the last modification) covers reuse,
+# and how long it trusts that an object it has seen still exists
+S3_TOUCH_INTERVAL_SECONDS = 60 * 60
+
+CONTENT_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+}
+
+
+def image_extension(data):
+    """File extension for image bytes, from their magic number."""
+    if data.startswith(b"\x89PNG"):
+        return ".png"
+    if data.startswith(b"\xff\xd8"):
+        return ".jpg"
+    if data[8:12] == b"WEBP":
+        return ".webp"
+    return ".png"
+
+
+def content_name(data, ext=None, prefix=GENERATED_PREFIX):
+    """Name a file after the sha256 of its bytes, e.g. main/images/generated/3fa2....png"""
+    return f"{prefix}{hashlib.sha256(data).hexdigest()[:32]}{ext or image_extension(data)}"
+
+
+class LocalStorage:
+    """
+    Stores files under a local directory, by default this app's static
+    directory so names double as static paths.
+
+    Without a base_url, generated images are served by the generated_image
+    view, which marks them cacheable forever; static file serving (runserver
+    or a web server) sends no such header.
+
+    Args:
+        root (str | Path): Absolute directory that names are relative to
+        base_url (str): URL the root is served from, or None to serve it from this app
+    """
+
+    def __init__(self, root, base_url=None):
+        self.root = Path(root)
+        self.base_url = base_url.rstrip("/") if base_url else None
+
+    def path(self, name):
+        return self.root / name
+
+    def exists(self, name):
+        return self.path(name).exists()
+
+    def save(self, name, data):
+        """
+        Atomically write data under name. Names are content hashes, so an
+        existing file is only touched: reusing it restarts gc_images' grace
+        period, as writing it did.
+        """
+        target = self.path(name)
+        try:
+            os.utime(target)
+            return name
+        except FileNotFoundError:
+            pass
+        target.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(target, data)
+        return name
+
+    def read(self, name):
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def delete(self, name):
+        self.path(name).unlink(missing_ok=True)
+
+    def listdir(self, prefix=GENERATED_PREFIX):
+        """Yield (name, size, modified timestamp) for every file under prefix."""
+        directory = self.path(prefix)
+        if not directory.exists():
+            return
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                yield f"{prefix}{entry.name}", stat.st_size, stat.st_mtime
+
+    def url(self, name):
+        if self.base_url:
+            return f"{self.base_url}/{name}"
+        if name.startswith(GENERATED_PREFIX):
+            return reverse('generated_image', args=[name[len(GENERATED_PREFIX):]])
+        return static(name)
+
+
+class S3Storage:
+    """
+    Stores files in an S3-compatible bucket (AWS S3, MinIO, or a local
+    stand-in such as moto's server via endpoint_url). Needs boto3, which is
+    not in requirements.txt since local storage is the default.
+
+    Objects are uploaded with far-future, immutable Cache-Control so a CDN in
+    front of public_url can cache them indefinitely. Saving an object that
+    exists copies it onto itself (at most every S3_TOUCH_INTERVAL_SECONDS),
+    which refreshes the LastModified gc_images' grace period is counted from.
+
+    Args:
+        bucket (str): Bucket name
+        public_url (str): Base URL objects are served from, e.g. a CDN origin
+        endpoint_url (str): S3 API endpoint, or None for AWS
+    """
+
+    def __init__(self, bucket, public_url, endpoint_url=None):
+        try:
+            import boto3
+        except ImportError:
+            raise ImproperlyConfigured("IMAGE_STORAGE=s3 needs boto3, which is not installed (pip install boto3)")
+
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        # When this process last saw each object; objects are immutable, so
+        # they only go away when gc_images removes them
+        self.known = {}
+        # When this process last refreshed each object's LastModified
+        self.touched = {}
+
+    def exists(self, name):
+        if time.monotonic() - self.known.get(name, float("-inf")) < S3_TOUCH_INTERVAL_SECONDS:
+            return True
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError:
+            self.known.pop(name, None)
+            return False
+        self.known[name] = time.monotonic()
+        return True
+
+    def save(self, name, data):
+        if self.exists(name) and self._touch(name):
+            return name
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=name,
+            Body=data,
+            ContentType=self._content_type(name),
+            CacheControl=IMMUTABLE_CACHE_CONTROL,
+        )
+        self.known[name] = self.touched[name] = time.monotonic()
+        return name
+
+    @staticmethod
+    def _content_type(name):
+        return CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+
+    def _touch(self, name):
+        """Refresh an existing object's LastModified; False if it has gone."""
+        from botocore.exceptions import ClientError
+
+        now = time.monotonic()
+        if now - self.touched.get(name, float("-inf")) < S3_TOUCH_INTERVAL_SECONDS:
+            return True
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=name,
+                CopySource={"Bucket": self.bucket, "Key": name},
+                MetadataDirective="REPLACE",
+                ContentType=self._content_type(name),
+                CacheControl=IMMUTABLE_CACHE_CONTROL,
+            )
+        except ClientError:
+            # Collected since we saw it
+            self.known.pop(name, None)
+            self.touched.pop(name, None)
+            return False
+        self.known[name] = self.touched[name] = now
+        return True
+
+    def read(self, name):
+        return self.client.get_object(Bucket=self.bucket, Key=name)["Body"].read()
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+        self.known.pop(name, None)
+        self.touched.pop(name, None)
+
+    def listdir(self, prefix=GENERATED_PREFIX):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"], obj["Size"], obj["LastModified"].timestamp()
+
+    def url(self, name):
+        return f"{self.public_url}/{name}"
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """The configured image storage (IMAGE_STORAGE=local|s3), created once per process."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if os.getenv("IMAGE_STORAGE", "local") == "s3":
+                    _storage = S3Storage(
+                        os.environ["IMAGE_S3_BUCKET"],
+                        os.environ["IMAGE_S3_PUBLIC_URL"],
+                        endpoint_url=os.getenv("IMAGE_S3_ENDPOINT_URL"),
+                    )
+                else:
+                    default_root = Path(__file__).resolve().parent.parent / "static"
+                    _storage = LocalStorage(
+                        os.getenv("IMAGE_STORAGE_ROOT", str(default_root)),
+                        base_url=os.getenv("IMAGE_STORAGE_URL"),
+                    )
+    return _storage
+
+
+def image_url(image_path):
+    """URL for a scene's image_path: generated images come from storage, bundled ones from static."""
+    if image_path.startswith(GENERATED_PREFIX):
+        return get_storage().url(image_path)
+    return static(image_path)
@@ -0,0 +1,128 @@
+import logging
+
+from django.db import transaction
+from django.db.models import F
+
+from ..models import Scene, Story, StoryVersion
+from .metrics import span
+
+logger = logging.getLogger(__name__)
+
+# The session only remembers which story the user is editing; the story
+# itself lives in Story/StoryVersion rows.
+SESSION_KEY = 'story_id'
+
+
+def group_name(story_id):
+    """Name a story's image jobs are scheduled under (see main.logic.scheduler)."""
+    return f"story-{story_id}"
+
+
+def story_group(request):
+    """group_name() of this user's story, or None before they have one."""
+    story_id = request.session.get(SESSION_KEY)
+    return group_name(story_id) if story_id is not None else None
+
+
+class Superseded(Exception):
+    """A newer edit of the same story started; this edit's result must not be saved."""
+
+
+class EditToken:
+    """
+    Ticket for one edit of a story, from begin_edit().
+
+    Attributes:
+        story_id (int): The story being edited
+        generation (int): Story.generation when the edit started
+        group (str): Name the story's image jobs are scheduled under
+    """
+
+    def __init__(self, story_id, generation):
+        self.story_id = story_id
+        self.generation = generation
+        self.group = group_name(story_id)
+
+    def is_current(self):
+        return Story.objects.filter(id=self.story_id, generation=self.generation).exists()
+
+    def check(self):
+        """Raise Superseded if a newer edit of the story has started."""
+        if not self.is_current():
+            raise Superseded(f"Edit {self.generation} of story {self.story_id} was superseded")
+
+
+def begin_edit(request):
+    """
+    Start an edit of the user's story, superseding any edit still in flight.
+
+    Returns:
+        EditToken: Pass to the ai edit function and save_story, or None if the
+        user has no story yet
+    """
+    story_id = request.session.get(SESSION_KEY)
+    if story_id is None:
+        return None
+    with transaction.atomic():
+        updated = Story.objects.filter(id=story_id).update(generation=F('generation') + 1)
+        if not updated:
+            return None
+        generation = Story.objects.values_list('generation', flat=True).get(id=story_id)
+    return EditToken(story_id, generation)
+
+
+def current_version(request):
+    """Return the StoryVersion the user is editing, or None."""
+    story_id = request.session.get(SESSION_KEY)
+    if story_id is None:
+        return None
+    return StoryVersion.objects.filter(story_id=story_id, story__current_version=F('id')).first()
+
+
+def load_story(request):
+    """Return the full story dict for this user, or {} if they have not started one."""
+    version = current_version(request)
+    return version.to_dict() if version else {}
+
+
+@span("session_write")
+@transaction.atomic
+def save_story(request, story_data, action, new_story=False, token=None):
+    """
+    Store story_data as a new version of the user's story.
+
+    Args:
+        request: The current request; its session is pointed at the story
+        story_data (dict): Complete story as returned by main.logic.ai
+        action (str): What produced this version, e.g. 'persona_regenerate'
+        new_story (bool): Start a new story instead of adding a version
+        token (EditToken): The edit that produced story_data, from begin_edit()
+
+    Returns:
+        StoryVersion: The version that was created
+
+    Raises:
+        Superseded: token is no longer the story's latest edit
+    """
+    story = None
+    if not new_story and request.session.get(SESSION_KEY) is not None:
+        story = Story.objects.filter(id=request.session[SESSION_KEY]).first()
+    if story is None:
+        story = Story.objects.create()
+    elif token is not None:
+        # The transaction holds the write lock, so no newer edit can start in between
+        token.check()
+
+    version = StoryVersion.create_from_dict(story, story_data, action=action)
+    story.current_version = version
+    story.save(update_fields=['current_version'])
+
+    request.session[SESSION_KEY] = story.id
+    logger.info(f"Saved {version}")
+    return version
+
+
+def update_scene_images(version, scenes):
+    """Record images that finished after version was saved (see main.logic.ai.ensure_scene_images)."""
+    for scene in scenes:
+        Scene.objects.filter(version=version, scene_id=scene['id']).update(image_path=scene['image_path'])
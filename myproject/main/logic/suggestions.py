@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+from .ai import suggestionGenerate
+from .files import atomic_write, file_lock
+
+logger = logging.getLogger(__name__)
+
+
+class SuggestionPool:
+    """
+    A local pool of pre-generated story ideas for the idea page.
+
+    take() pops ideas from a JSON file instead of calling Gemini on the
+    request. When the pool drops below low_watermark a background thread
+    refills it up to target_size; ideas older than ttl seconds are discarded.
+    Every read-modify-write of the file holds a lock file next to it, so
+    web workers sharing the pool never hand out or drop the same idea twice.
+
+    Args:
+        path (str | Path): JSON file holding the pool
+        ttl (int): Seconds an idea stays servable
+        low_watermark (int): Pool size that triggers a background refill
+        target_size (int): Pool size a refill stops at
+    """
+
+    def __init__(self, path, ttl=24 * 60 * 60, low_watermark=12, target_size=32):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(f".{self.path.name}.lock")
+        self.ttl = ttl
+        self.low_watermark = low_watermark
+        self.target_size = target_size
+        self.lock = threading.Lock()
+        self.refilling = threading.Event()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                pool = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable suggestion pool {self.path}: {e}")
+            return []
+        now = time.time()
+        return [item for item in pool if now - item['created'] < self.ttl]
+
+    def _write(self, pool):
+        atomic_write(self.path, json.dumps(pool).encode('utf-8'))
+
+    @contextmanager
+    def _locked(self):
+        """Hold the pool for a read-modify-write, against this process's threads and other processes."""
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with file_lock(self.lock_path):
+                yield
+
+    def _add(self, suggestions):
+        now = time.time()
+        with self._locked():
+            pool = self._read()
+            known = {item['text'] for item in pool}
+            pool.extend({'text': text, 'created': now} for text in suggestions if text not in known)
+            self._write(pool)
+            return len(pool)
+
+    def take(self, count=4):
+        """Pop count ideas, generating synchronously only when the pool is empty."""
+        with self._locked():
+            pool = self._read()
+            taken = [item['text'] for item in pool[:count]]
+            pool = pool[count:]
+            self._write(pool)
+            remaining = len(pool)
+
+        if len(taken) < count:
+            # Cold start: nothing pre-generated yet
+            fresh = suggestionGenerate().get('suggestions', [])
+            taken.extend(text for text in fresh if text not in taken)
+            self._add(taken[count:])
+            taken = taken[:count]
+
+        if remaining < self.low_watermark:
+            self.refill_in_background()
+        return taken
+
+    def refill_in_background(self):
+        if self.refilling.is_set():
+            return
+        self.refilling.set()
+        threading.Thread(target=self._refill, name="suggestion-refill", daemon=True).start()
+
+    def _refill(self):
+        try:
+            size = len(self._read())
+            # Bounded in case the model keeps repeating ideas already pooled
+            for _ in range(self.target_size):
+                if size >= self.target_size:
+                    break
+                size = self._add(suggestionGenerate().get('suggestions', []))
+            logger.info(f"Refilled suggestion pool to {size}")
+        except Exception as e:
+            logger.error(f"Failed to refill suggestion pool: {e}")
+        finally:
+            self.refilling.clear()
+
+
+suggestion_pool = SuggestionPool(
+    os.getenv("SUGGESTION_POOL_PATH", str(settings.BASE_DIR / "suggestion_pool.json")),
+    ttl=int(os.getenv("SUGGESTION_POOL_TTL", str(24 * 60 * 60))),
+    low_watermark=int(os.getenv("SUGGESTION_POOL_LOW_WATERMARK", "12")),
+    target_size=int(os.getenv("SUGGESTION_POOL_TARGET", "32")),
+)
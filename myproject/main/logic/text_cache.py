@@ -0,0 +1,55 @@
+import hashlib
+import json
+import time
+
+from .image_cache import ImageCache
+
+
+class TextCache(ImageCache):
+    """
+    On-disk cache of text model responses, for calls whose policy allows it
+    (see ai.TEXT_CACHE_POLICIES).
+
+    Entries are keyed on (model, response schema, whitespace-normalised
+    prompt, seed) and share ImageCache's cross-process LRU index, size
+    bounds and hit counts. The seed only separates variants of the same
+    request; it is never sent to the model. Each lookup also says how old an
+    entry may be; older entries are dropped and count as misses.
+    """
+
+    KIND = "text response"
+
+    @staticmethod
+    def make_key(model, schema, prompt, seed=None):
+        normalized = " ".join(prompt.split())
+        payload = json.dumps([model, schema, normalized, seed], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _blob_path(self, key):
+        return self.root / f"{key}.txt"
+
+    def get_text(self, key, ttl):
+        """Return the cached response for key if it is under ttl seconds old, else None."""
+        blob_path = self._blob_path(key)
+        try:
+            expired = time.time() - blob_path.stat().st_mtime > ttl
+        except FileNotFoundError:
+            expired = False
+        if expired:
+            with self.lock:
+                blob_path.unlink(missing_ok=True)
+                self.entries.pop(key, None)
+
+        cached_path = self.get(key)
+        if cached_path is None:
+            return None
+        try:
+            return cached_path.read_text(encoding="utf-8")
+        except OSError:
+            # Evicted by another process between the lookup and the read
+            self.discard(key)
+            return None
+
+    def put_text(self, key, text, **metadata):
+        """Store a response under key and evict if over budget."""
+        self.put(key, text.encode("utf-8"), **metadata)
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.logic import ai
+from main.logic.files import atomic_write
+from main.logic.ratelimit import BATCH, CappedRateLimiter, RateLimiter, rate_class
+from main.logic.scheduler import ImageScheduler
+from main.logic.storage import GENERATED_PREFIX, get_storage
+
+logger = logging.getLogger(__name__)
+
+# Checkpoint states of an idea
+TEXT = 'text'        # story text saved in the bundle, images not all done
+PARTIAL = 'partial'  # bundle written, but some scenes fell back to the example image
+DONE = 'done'
+FAILED = 'failed'    # the text model failed; nothing usable saved
+
+
+def read_ideas(path):
+    """
+    Ideas from a text file (one per line; blank lines and # comments skipped)
+    or a .jsonl file of {"idea": ...} objects.
+    """
+    ideas = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                line = json.loads(line)["idea"].strip()
+            ideas.append(line)
+    return ideas
+
+
+def idea_key(index, idea):
+    """Bundle directory name: position in the file, a slug and a hash, e.g. 0003-a-robot-learns-7f3a9c2e."""
+    slug = re.sub(r"[^a-z0-9]+", "-", idea.lower()).strip("-")[:40].rstrip("-")
+    return f"{index:04d}-{slug}-{hashlib.sha256(idea.encode('utf-8')).hexdigest()[:8]}"
+
+
+def write_json(path, data):
+    """Write JSON atomically, so an interrupted batch never leaves half a file."""
+    atomic_write(path, json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8"))
+
+
+class Checkpoint:
+    """
+    Progress of a batch, kept in <output>/checkpoint.json and rewritten after
+    every change so a rerun picks up where the last one stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+
+    def get(self, key):
+        with self.lock:
+            return dict(self.entries.get(key, {}))
+
+    def update(self, key, **fields):
+        with self.lock:
+            self.entries.setdefault(key, {}).update(fields)
+            write_json(self.path, self.entries)
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a story bundle (story.json plus scene images) for every idea in a file, "
+        "with separate concurrency and rate limits for text and image models. "
+        "Progress is checkpointed; rerunning the same command resumes the batch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("ideas", help="Text file with one idea per line, or .jsonl of {\"idea\": ...}")
+        parser.add_argument("--output", default="batch_output", help="Directory for bundles and checkpoint.json")
+        parser.add_argument("--text-concurrency", type=int, default=4, help="Text calls in flight at once")
+        parser.add_argument("--text-rpm", type=float, default=None,
+                            help="Cap this batch's calls per minute per text model, within the shared "
+                                 "TEXT_MODEL_PRO_RPM / TEXT_MODEL_FAST_RPM quota (default: no cap of its own)")
+        parser.add_argument("--image-concurrency", type=int, default=ai.IMAGE_MAX_CONCURRENCY,
+                            help="Image calls in flight at once")
+        parser.add_argument("--image-rpm", type=float, default=None,
+                            help="Cap this batch's image calls per minute, within the shared "
+                                 "IMAGE_REQUESTS_PER_MINUTE quota (default: no cap of its own)")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Stories in progress at once (default: text + image concurrency)")
+        parser.add_argument("--skip-failed", action="store_true", help="Don't retry ideas that failed in an earlier run")
+        parser.add_argument("--seed", type=int, default=None,
+                            help="With TEXT_CACHE=1, reuse the text cached for the same idea and seed. "
+                                 "The model never sees the seed, so uncached ideas still get a fresh story")
+
+    def configure_limits(self, options):
+        # Concurrency is this process's own. Rates are the per-model quotas
+        # shared with the web workers, where batch calls yield to interactive
+        # ones; --text-rpm/--image-rpm only add a local cap beneath them, so
+        # every process still agrees on how fast the shared buckets refill.
+        ai.text_slots = threading.BoundedSemaphore(options["text_concurrency"])
+        ai.image_scheduler = ImageScheduler(options["image_concurrency"])
+        for model, shared in list(ai.model_rate_limiters.items()):
+            is_image = model == ai.IMAGE_MODEL
+            cap = options["image_rpm"] if is_image else options["text_rpm"]
+            if cap is not None:
+                burst = options["image_concurrency"] if is_image else options["text_concurrency"]
+                ai.model_rate_limiters[model] = CappedRateLimiter(shared, RateLimiter(cap, burst=burst))
+        ai.image_rate_limiter = ai.model_rate_limiters[ai.IMAGE_MODEL]
+
+    def write_bundle(self, bundle, key, idea, story):
+        """Copy the story's images into the bundle and write story.json; returns scenes left on the fallback image."""
+        images = bundle / "images"
+        images.mkdir(exist_ok=True)
+        storage = get_storage()
+        missing = []
+        for scene in story["scenes"]:
+            image_path = scene.get("image_path", "")
+            if not image_path.startswith(GENERATED_PREFIX):
+                missing.append(scene["id"])
+                scene["bundle_image"] = None
+                continue
+            name = f"scene-{scene['id']}{Path(image_path).suffix}"
+            (images / name).write_bytes(storage.read(image_path))
+            scene["bundle_image"] = f"images/{name}"
+        write_json(bundle / "story.json", {"key": key, "idea": idea, "story": story})
+        return missing
+
+    def generate(self, key, idea):
+        """Run one idea to a bundle in the batch rate class; returns (state, seconds)."""
+        with rate_class(BATCH):
+            return self.generate_bundle(key, idea)
+
+    def generate_bundle(self, key, idea):
+        """Run one idea to a bundle, resuming from its checkpoint; returns (state, seconds)."""
+        start = time.perf_counter()
+        bundle = self.output / key
+        bundle.mkdir(exist_ok=True)
+        entry = self.checkpoint.get(key)
+
+        if entry.get("state") in (TEXT, PARTIAL):
+            # The text is paid for; only redo images that never landed
+            story = json.loads((bundle / "story.json").read_text(encoding="utf-8"))["story"]
+            finished = [
+                dict(scene) for scene in story["scenes"]
+                if scene.get("image_path", "").startswith(GENERATED_PREFIX)
+            ]
+            story["scenes"] = ai.generate_all_scene_images(story["scenes"], story, old_scenes=finished)
+        else:
+            def save_text(story):
+                write_json(bundle / "story.json", {"key": key, "idea": idea, "story": story})
+                self.checkpoint.update(key, state=TEXT, idea=idea)
+
+            try:
+                story = ai.storyGenerate(idea, on_story=save_text, seed=self.seed)
+            except Exception as e:
+                if self.checkpoint.get(key).get("state") != TEXT:
+                    self.checkpoint.update(key, state=FAILED, idea=idea, error=str(e))
+                    return FAILED, time.perf_counter() - start
+                raise
+
+        missing = self.write_bundle(bundle, key, idea, story)
+        state = PARTIAL if missing else DONE
+        self.checkpoint.update(key, state=state, idea=idea, missing_images=missing, error="")
+        return state, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        try:
+            ideas = read_ideas(options["ideas"])
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Could not read ideas from {options['ideas']}: {e}")
+
+        self.output = Path(options["output"])
+        self.output.mkdir(parents=True, exist_ok=True)
+        self.checkpoint = Checkpoint(self.output / "checkpoint.json")
+        self.seed = options["seed"]
+        self.configure_limits(options)
+
+        todo = []
+        for index, idea in enumerate(ideas, 1):
+            key = idea_key(index, idea)
+            state = self.checkpoint.get(key).get("state")
+            if state == DONE or (state == FAILED and options["skip_failed"]):
+                continue
+            todo.append((key, idea))
+        self.stdout.write(f"{len(ideas)} ideas, {len(ideas) - len(todo)} already finished, {len(todo)} to generate")
+        if not todo:
+            return
+
+        workers = options["workers"] or options["text_concurrency"] + options["image_concurrency"]
+        counts = {DONE: 0, PARTIAL: 0, FAILED: 0}
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-story")
+        try:
+            futures = {executor.submit(self.generate, key, idea): key for key, idea in todo}
+            for finished, future in enumerate(as_completed(futures), 1):
+                key = futures[future]
+                try:
+                    state, seconds = future.result()
+                except Exception as e:
+                    # Images failed after the text was saved: resumable as is
+                    logger.error(f"Batch story {key} stopped after its text: {e}")
+                    state, seconds = FAILED, 0.0
+                counts[state] += 1
+                self.stdout.write(f"[{finished}/{len(todo)}] {key}: {state} ({seconds:.1f}s)")
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.stderr.write("Interrupted; finishing stories in flight. Rerun the same command to resume.")
+            raise
+        executor.shutdown()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"{counts[DONE]} done, {counts[PARTIAL]} with missing images, {counts[FAILED]} failed "
+            f"in {elapsed:.1f}s ({len(todo) / elapsed * 60:.1f} stories/min); bundles in {self.output}"
+        )
+        if ai.TEXT_CACHE_ENABLED:
+            stats = ai.text_cache.stats()
+            self.stdout.write(f"text cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_ratio']:.0%})")
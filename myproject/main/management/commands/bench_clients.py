@@ -0,0 +1,54 @@
+import os
+import time
+
+import google.generativeai as genai
+from django.core.management.base import BaseCommand
+
+from main.logic import clients
+from main.logic.ai import story_schema
+
+
+def legacy_image_client():
+    """What generate_scene_image did on every attempt before the client registry."""
+    from google import genai as google_genai
+    return google_genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+
+
+def legacy_text_model():
+    """What every text function did on every call before the client registry."""
+    return genai.GenerativeModel(
+        'models/gemini-2.5-pro',
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": story_schema
+        }
+    )
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-call Gemini client/model setup overhead with and without the shared registry (no network calls)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200)
+
+    def time_per_call(self, fn, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return (time.perf_counter() - start) / iterations
+
+    def handle(self, *args, **options):
+        # Clients can be built offline; no request is sent
+        os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+        iterations = options["iterations"]
+
+        rows = [
+            ("image client", legacy_image_client, clients.get_image_client),
+            ("text model", legacy_text_model, lambda: clients.get_text_model('models/gemini-2.5-pro', story_schema)),
+        ]
+        self.stdout.write(f"{'':<14} {'per-call us':>12} {'registry us':>12} {'saved':>8}")
+        for name, legacy, shared in rows:
+            shared()  # first use builds the shared instance
+            before = self.time_per_call(legacy, iterations)
+            after = self.time_per_call(shared, iterations)
+            self.stdout.write(f"{name:<14} {before * 1e6:>12.1f} {after * 1e6:>12.1f} {before / after:>7.0f}x")
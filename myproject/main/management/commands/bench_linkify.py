@@ -0,0 +1,120 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand
+from django.template import Context, Template
+from django.utils.safestring import mark_safe
+
+from main.logic import linkify
+from main.templatetags import scene_filters
+
+# Roughly what video.html and scene.html run the filter over
+TEMPLATE = """
+<p>{{ story_data.storyline|linkify_characters_and_locations:story_data }}</p>
+{% for persona in story_data.persona_description %}<strong>{{ persona.name|linkify_characters_and_locations:story_data }}</strong>{% endfor %}
+{% for location in story_data.setting_description %}<strong>{{ location.name|linkify_characters_and_locations:story_data }}</strong>{% endfor %}
+{% for scene in scenes %}<p>{{ scene.narration|linkify_characters_and_locations:story_data }}</p><p>{{ scene.image_prompt|linkify_characters_and_locations:story_data }}</p>{% endfor %}
+"""
+
+WORDS = "the a quiet storm over river under lantern glass smoke silver morning bell letter shadow".split()
+
+
+def legacy_linkify(text, story_data):
+    """The filter as it was: one re.sub per name, then a placeholder pass."""
+    if not text or not story_data:
+        return text
+
+    character_names = [persona['name'] for persona in story_data.get('persona_description', [])]
+    location_names = [location['name'] for location in story_data.get('setting_description', [])]
+    character_names.sort(key=len, reverse=True)
+    location_names.sort(key=len, reverse=True)
+
+    placeholders = {}
+    placeholder_counter = 0
+
+    def replace_with_placeholder(match, url_template, css_class):
+        nonlocal placeholder_counter
+        placeholder = f"___PLACEHOLDER_{placeholder_counter}___"
+        placeholders[placeholder] = f'<a href="{url_template}" class="{css_class}">{match.group(0)}</a>'
+        placeholder_counter += 1
+        return placeholder
+
+    for loc_name in location_names:
+        pattern = r'\b' + re.escape(loc_name) + r'\b'
+        text = re.sub(pattern, lambda m: replace_with_placeholder(m, f"/locations/?location={loc_name}", "text-success fw-bold"), text, flags=re.IGNORECASE)
+    for char_name in character_names:
+        pattern = r'\b' + re.escape(char_name) + r'\b'
+        text = re.sub(pattern, lambda m: replace_with_placeholder(m, f"/personas/?character={char_name}", "text-primary fw-bold"), text, flags=re.IGNORECASE)
+    for placeholder, html in placeholders.items():
+        text = text.replace(placeholder, html)
+    return mark_safe(text)
+
+
+def large_story(rng, personas, locations, scenes, words):
+    """Linkify context for a big story whose names don't overlap, so both filters must agree."""
+    persona_names = [f"Persona{i} Vale" for i in range(personas)]
+    location_names = [f"Harbor{i} Point" for i in range(locations)]
+    names = persona_names + location_names
+
+    def paragraph():
+        return " ".join(rng.choice(names) if rng.random() < 0.08 else rng.choice(WORDS) for _ in range(words))
+
+    story_data = {
+        'storyline': paragraph(),
+        'persona_description': [{'id': i, 'name': name} for i, name in enumerate(persona_names, 1)],
+        'setting_description': [{'id': i, 'name': name} for i, name in enumerate(location_names, 1)],
+    }
+    scene_list = [{'id': i, 'narration': paragraph(), 'image_prompt': paragraph()} for i in range(1, scenes + 1)]
+    return story_data, scene_list
+
+
+class Command(BaseCommand):
+    help = "Time rendering linkified story pages with the per-name legacy filter vs the compiled, cached linker."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--personas", type=int, default=30)
+        parser.add_argument("--locations", type=int, default=30)
+        parser.add_argument("--scenes", type=int, default=60)
+        parser.add_argument("--words", type=int, default=120, help="Words per storyline, narration and image prompt")
+        parser.add_argument("--renders", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def time_renders(self, template, context, renders):
+        start = time.perf_counter()
+        for _ in range(renders):
+            output = template.render(Context(context))
+        return (time.perf_counter() - start) / renders, output
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        story_data, scenes = large_story(rng, options["personas"], options["locations"], options["scenes"], options["words"])
+        context = {'story_data': story_data, 'scenes': scenes}
+        renders = options["renders"]
+
+        # Filters are looked up when a template is parsed, so each gets its own template
+        filters = scene_filters.register.filters
+        try:
+            filters['linkify_characters_and_locations'] = legacy_linkify
+            template = Template("{% load scene_filters %}" + TEMPLATE)
+        finally:
+            filters['linkify_characters_and_locations'] = scene_filters.linkify_characters_and_locations
+        legacy, legacy_output = self.time_renders(template, context, renders)
+
+        template = Template("{% load scene_filters %}" + TEMPLATE)
+        linkify._cached_linker.cache_clear()
+        start = time.perf_counter()
+        template.render(Context(context))
+        cold = time.perf_counter() - start
+        warm, output = self.time_renders(template, context, renders)
+
+        calls = len(scenes) * 2 + len(story_data['persona_description']) + len(story_data['setting_description']) + 1
+        self.stdout.write(
+            f"{len(story_data['persona_description'])} personas, {len(story_data['setting_description'])} locations, "
+            f"{len(scenes)} scenes, {calls} filter calls per render"
+        )
+        self.stdout.write(f"legacy   {legacy * 1000:9.1f} ms/render")
+        self.stdout.write(f"compiled {cold * 1000:9.1f} ms first render (builds the linker)")
+        self.stdout.write(f"compiled {warm * 1000:9.1f} ms/render cached ({legacy / warm:.1f}x faster)")
+        self.stdout.write(f"linker cache: {linkify._cached_linker.cache_info()}")
+        self.stdout.write(f"output identical: {output == legacy_output}")
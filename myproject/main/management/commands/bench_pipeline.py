@@ -0,0 +1,296 @@
+import json
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+from django.urls import resolve
+
+from main.logic import ai, storage
+from main.logic.backends import FakeBackend, set_backend
+from main.logic.image_cache import ImageCache
+from main.logic.interaction_log import interaction_logger
+from main.logic.metrics import registry
+from main.logic.ratelimit import RateLimiter
+from main.logic.scheduler import ImageScheduler
+from main.logic.suggestions import suggestion_pool
+from main.logic.text_cache import TextCache
+from main.models import StoryJob
+
+JOB_POLL_SECONDS = 0.05
+JOB_TIMEOUT_SECONDS = 300
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def directory_bytes(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    """Collects request latencies per view from every simulated user."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.requests = 0
+
+    def request(self, client, method, path, data=None, **extra):
+        start = time.perf_counter()
+        response = getattr(client, method)(path, data, **extra)
+        elapsed = time.perf_counter() - start
+        key = f"{method.upper()} {resolve(path.split('?')[0]).url_name}"
+        with self.lock:
+            self.latencies.setdefault(key, []).append(elapsed)
+            self.requests += 1
+        if response.status_code >= 400:
+            raise RuntimeError(f"{key} returned {response.status_code}")
+        return response
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the full idea -> draft -> personas -> locations -> scene -> video flow "
+        "through the Django test client against the fake model backend, and report JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=4, help="Concurrent simulated users")
+        parser.add_argument("--iterations", type=int, default=2, help="Stories each user creates")
+        parser.add_argument("--text-latency", type=float, default=0.2, help="Seconds per fake pro-tier text call")
+        parser.add_argument("--fast-text-latency", type=float, default=0.05, help="Seconds per fake fast-tier text call")
+        parser.add_argument("--image-latency", type=float, default=0.5, help="Seconds per fake image call")
+        parser.add_argument("--failure-rate", type=float, default=0.0, help="Fake model call failure probability")
+        parser.add_argument("--image-rpm", type=float, default=0,
+                            help="Image rate limit during the run (0 = unlimited)")
+        parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+        parser.add_argument("--baseline", help="Earlier results JSON to compare p50/p95 against")
+
+    def handle(self, *args, **options):
+        set_backend(FakeBackend(
+            text_latency=options["text_latency"],
+            image_latency=options["image_latency"],
+            failure_rate=options["failure_rate"],
+            model_latency={ai.MODEL_TIERS['fast']: options["fast_text_latency"]},
+        ))
+
+        with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as workdir:
+            workdir = Path(workdir)
+            with self.isolate_writes(workdir, options["image_rpm"]):
+                setup_test_environment()
+                connections.databases["default"].setdefault("TEST", {})["NAME"] = str(workdir / "db.sqlite3")
+                old_config = setup_databases(verbosity=0, interactive=False)
+                try:
+                    results = self.run_users(options["users"], options["iterations"])
+                    results["model_tiers"] = self.tier_summary()
+                    results["text_cache"] = ai.text_cache.stats() if ai.TEXT_CACHE_ENABLED else None
+                    interaction_logger.flush()
+                    results["bytes_written"] = {
+                        "database": directory_bytes(workdir) - sum(
+                            directory_bytes(workdir / name) for name in ("storage", "image_cache", "text_cache", "user_logs")
+                        ),
+                        "images": directory_bytes(workdir / "storage"),
+                        "image_cache": directory_bytes(workdir / "image_cache"),
+                        "interaction_logs": directory_bytes(workdir / "user_logs"),
+                    }
+                    results["bytes_written"]["total"] = directory_bytes(workdir)
+                finally:
+                    teardown_databases(old_config, verbosity=0)
+
+        results["commit"] = current_commit()
+        results["config"] = {
+            key: options[key]
+            for key in ("users", "iterations", "text_latency", "fast_text_latency", "image_latency", "failure_rate", "image_rpm")
+        }
+
+        report = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report + "\n")
+        else:
+            self.stdout.write(report)
+        if options["baseline"]:
+            self.compare(results, options["baseline"])
+
+    @contextmanager
+    def isolate_writes(self, workdir, image_rpm):
+        """
+        Point every file writer at workdir so the run leaves no trace and its
+        bytes can be counted, and give it an image scheduler of its own;
+        everything is put back afterwards.
+        """
+        saved = (
+            storage._storage, ai.image_cache, ai.text_cache, ai.image_rate_limiter,
+            dict(ai.model_rate_limiters), ai.image_scheduler,
+            interaction_logger.log_dir, suggestion_pool.path, suggestion_pool.lock_path,
+        )
+        storage._storage = storage.LocalStorage(workdir / "storage", base_url="/bench-images")
+        ai.image_cache = ImageCache(workdir / "image_cache")
+        ai.text_cache = TextCache(workdir / "text_cache")
+        ai.image_rate_limiter = RateLimiter(image_rpm, burst=ai.IMAGE_MAX_CONCURRENCY)
+        # Text calls are only paced by the fake's latency, and shared quota files stay untouched
+        for model in ai.model_rate_limiters:
+            ai.model_rate_limiters[model] = RateLimiter(0)
+        ai.image_scheduler = ImageScheduler(ai.IMAGE_MAX_CONCURRENCY)
+        interaction_logger.log_dir = workdir / "user_logs"
+        suggestion_pool.path = workdir / "suggestion_pool.json"
+        suggestion_pool.lock_path = workdir / ".suggestion_pool.json.lock"
+        try:
+            yield
+        finally:
+            # A refill still running would write its ideas to the real pool
+            while suggestion_pool.refilling.is_set():
+                time.sleep(JOB_POLL_SECONDS)
+            (
+                storage._storage, ai.image_cache, ai.text_cache, ai.image_rate_limiter,
+                model_rate_limiters, ai.image_scheduler,
+                interaction_logger.log_dir, suggestion_pool.path, suggestion_pool.lock_path,
+            ) = saved
+            ai.model_rate_limiters.update(model_rate_limiters)
+
+    def run_users(self, users, iterations):
+        recorder = Recorder()
+        story_seconds = []
+        session_bytes = []
+        errors = []
+
+        def user(number):
+            client = Client()
+            for iteration in range(iterations):
+                try:
+                    story_seconds.append(self.create_story(recorder, client, f"bench user {number} story {iteration}"))
+                    self.edit_story(recorder, client)
+                except Exception as e:
+                    errors.append(f"user {number} story {iteration}: {e}")
+            session = client.session
+            session_bytes.append(len(session.encode(dict(session.items()))))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=users) as pool:
+            list(pool.map(user, range(users)))
+        wall_seconds = time.perf_counter() - start
+
+        return {
+            "wall_seconds": round(wall_seconds, 3),
+            "requests": recorder.requests,
+            "requests_per_second": round(recorder.requests / wall_seconds, 2),
+            "errors": errors,
+            "story_generation_seconds": self.summary(story_seconds),
+            "session_bytes": {"max": max(session_bytes), "mean": sum(session_bytes) / len(session_bytes)},
+            "views": {key: self.summary(values) for key, values in sorted(recorder.latencies.items())},
+        }
+
+    @staticmethod
+    def tier_summary():
+        """Text model calls, mean latency, tokens and estimated cost per tier, from the metrics registry."""
+        tiers = {}
+        with registry.lock:
+            for (name, labels), histogram in registry.histograms.items():
+                labels = dict(labels)
+                if name == "story_stage_seconds" and labels.get("stage") == "text_model":
+                    tier = tiers.setdefault(labels["tier"], {"calls": 0, "seconds": 0.0, "tokens": 0, "cost_usd": 0.0})
+                    tier["calls"] += histogram["count"]
+                    tier["seconds"] += histogram["sum"]
+            for (name, labels), value in registry.counters.items():
+                labels = dict(labels)
+                if labels.get("tier") not in tiers:
+                    continue
+                if name == "story_stage_tokens_total":
+                    tiers[labels["tier"]]["tokens"] += value
+                elif name == "model_cost_usd_total":
+                    tiers[labels["tier"]]["cost_usd"] += value
+        return {
+            name: {
+                "calls": tier["calls"],
+                "mean_ms": round(tier["seconds"] / tier["calls"] * 1000, 2),
+                "tokens": tier["tokens"],
+                "cost_usd": round(tier["cost_usd"], 6),
+            }
+            for name, tier in sorted(tiers.items())
+        }
+
+    @staticmethod
+    def summary(values):
+        if not values:
+            return {"count": 0}
+        return {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "max_ms": round(max(values) * 1000, 2),
+        }
+
+    def create_story(self, recorder, client, idea):
+        """Idea page through to an adopted story; returns seconds until the job finished."""
+        recorder.request(client, "get", "/")
+        recorder.request(client, "get", "/", HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        response = recorder.request(client, "post", "/", {"story_prompt": idea})
+        start = time.perf_counter()
+        recorder.request(client, "get", response.url)
+        job_id = response.url.split("job=")[1]
+
+        deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            status = recorder.request(client, "get", f"/story/{job_id}/status/").json()
+            if status["status"] == StoryJob.DONE:
+                return time.perf_counter() - start
+            if status["status"] == StoryJob.FAILED:
+                raise RuntimeError(f"story job failed: {status.get('error')}")
+            time.sleep(JOB_POLL_SECONDS)
+        raise RuntimeError(f"story job {job_id} timed out")
+
+    def edit_story(self, recorder, client):
+        """One edit on every page of the flow, then the finished storyboard."""
+        recorder.request(client, "get", "/draft/")
+        recorder.request(client, "post", "/draft/", {"action": "regenerate", "feedback": "make it darker"})
+        recorder.request(client, "get", "/personas/")
+        recorder.request(client, "post", "/personas/", {"action": "regenerate", "persona_id": 1, "feedback": "older"})
+        recorder.request(client, "get", "/locations/")
+        recorder.request(client, "post", "/locations/", {"action": "regenerate", "location_id": 1, "feedback": "at night"})
+        recorder.request(client, "get", "/scene/")
+        recorder.request(client, "post", "/scene/", {
+            "action": "regenerate_narration", "scene_id": 1, "narration_feedback": "shorter",
+        })
+        recorder.request(client, "post", "/scene/", {
+            "action": "regenerate_image", "scene_id": 2, "image_prompt_feedback": "closer shot",
+        })
+        recorder.request(client, "get", "/video/")
+
+    def compare(self, results, baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        self.stderr.write(f"Compared with {baseline_path} (commit {baseline.get('commit')}):")
+        self.stderr.write(f"{'view':<32} {'p50 ms':>16} {'p95 ms':>16}")
+        for key, summary in results["views"].items():
+            before = baseline.get("views", {}).get(key)
+            if not before or not summary.get("count"):
+                continue
+            self.stderr.write(
+                f"{key:<32} {before['p50_ms']:>7} -> {summary['p50_ms']:<7} {before['p95_ms']:>7} -> {summary['p95_ms']:<7}"
+            )
+        self.stderr.write(
+            f"{'requests/sec':<32} {baseline.get('requests_per_second')} -> {results['requests_per_second']}"
+        )
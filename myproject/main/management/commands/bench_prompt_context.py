@@ -0,0 +1,102 @@
+import json
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+
+from main.logic import ai
+from main.logic.backends import FakeBackend, set_backend
+from main.logic.context import PROMPT_TOKEN_BUDGETS, estimate_tokens
+from main.logic.prompts import get_prompt_expander
+
+
+class CapturingBackend(FakeBackend):
+    """Fake backend that records every text prompt it is sent."""
+
+    def __init__(self):
+        super().__init__()
+        self.prompts = []
+
+    def generate_text(self, model, prompt, schema=None):
+        self.prompts.append((model, prompt))
+        return super().generate_text(model, prompt, schema)
+
+
+@contextmanager
+def legacy_context():
+    """Build prompts the way ai.py did before main.logic.context: indent=2 dumps of whole scenes."""
+    context_json, prepare_prompt = ai.context_json, ai.prepare_prompt
+    ai.context_json = lambda value: json.dumps(value, indent=2)
+    ai.prepare_prompt = lambda call, prompt: prompt
+    try:
+        yield
+    finally:
+        ai.context_json, ai.prepare_prompt = context_json, prepare_prompt
+
+
+@contextmanager
+def no_images():
+    generate_all_scene_images = ai.generate_all_scene_images
+    ai.generate_all_scene_images = lambda scenes, *args, **kwargs: scenes
+    try:
+        yield
+    finally:
+        ai.generate_all_scene_images = generate_all_scene_images
+
+
+class Command(BaseCommand):
+    help = "Compare edit prompt sizes built with indent=2 story dumps vs the compact prompt context (no network calls by default)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count-tokens", action="store_true",
+                            help="Also count exact tokens with Gemini's count_tokens (needs GEMINI_API_KEY)")
+
+    def story(self, backend):
+        story = json.loads(backend.generate_text('models/gemini-2.5-pro', 'benchmark story', ai.story_schema))
+        # Scenes as stored after image generation, with their derived fields
+        expander = get_prompt_expander(story)
+        for scene in story['scenes']:
+            scene['enhanced_prompt'] = expander.expand(scene['image_prompt'], scene['emotional_tones'])
+            scene['image_path'] = f"main/images/generated/{'0' * 32}.png"
+        return story
+
+    def edits(self, story):
+        scene_id = story['scenes'][1]['id']
+        return [
+            ('storylineGenerate', lambda: ai.storylineGenerate(story, "make it a mystery")),
+            ('characterGenerate', lambda: ai.characterGenerate(story, 1, "make them older")),
+            ('locationGenerate', lambda: ai.locationGenerate(story, 1, "set it at night")),
+            ('narrationGenerate', lambda: ai.narrationGenerate(story, scene_id, "shorter")),
+            ('PromptGenerate', lambda: ai.PromptGenerate(story, scene_id, "closer shot")),
+        ]
+
+    def capture(self, backend, edit):
+        backend.prompts.clear()
+        edit()
+        return backend.prompts[-1]
+
+    def count_tokens(self, model, prompt):
+        from main.logic.clients import get_text_model
+        return get_text_model(model).count_tokens(prompt).total_tokens
+
+    def handle(self, *args, **options):
+        backend = CapturingBackend()
+        set_backend(backend)
+        story = self.story(backend)
+
+        header = f"{'call':<18} {'legacy chars':>12} {'compact chars':>13} {'legacy tok':>10} {'compact tok':>11} {'budget':>6} {'saved':>6}"
+        if options["count_tokens"]:
+            header += f" {'legacy exact':>12} {'compact exact':>13}"
+        self.stdout.write(header)
+        with no_images():
+            for call, edit in self.edits(story):
+                with legacy_context():
+                    model, legacy = self.capture(backend, edit)
+                _, compact = self.capture(backend, edit)
+                row = (
+                    f"{call:<18} {len(legacy):>12} {len(compact):>13} "
+                    f"{estimate_tokens(legacy):>10} {estimate_tokens(compact):>11} "
+                    f"{PROMPT_TOKEN_BUDGETS.get(call, '-'):>6} {1 - len(compact) / len(legacy):>6.0%}"
+                )
+                if options["count_tokens"]:
+                    row += f" {self.count_tokens(model, legacy):>12} {self.count_tokens(model, compact):>13}"
+                self.stdout.write(row)
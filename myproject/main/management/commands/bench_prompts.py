@@ -0,0 +1,78 @@
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.logic.prompts import PromptExpander, persona_image_description
+
+
+def legacy_expand(image_prompt, emotional_tones, story_data):
+    """The per-name re.sub loop generate_scene_image used before PromptExpander."""
+    enhanced_prompt = image_prompt
+    for persona in story_data['persona_description']:
+        name = persona['name']
+        enhanced_prompt = re.sub(r'\b' + re.escape(name) + r'\b', persona_image_description(persona), enhanced_prompt, flags=re.IGNORECASE)
+    for location in story_data['setting_description']:
+        name = location['name']
+        enhanced_prompt = re.sub(r'\b' + re.escape(name) + r'\b', location['description'], enhanced_prompt, flags=re.IGNORECASE)
+    tone_text = ", ".join(emotional_tones)
+    return enhanced_prompt + f". The image should reflect the emotional tones: {tone_text}."
+
+
+def synthetic_story(size):
+    personas = [
+        {"id": i, "name": f"Character{i}", "age": "30", "clothing": "a long grey coat",
+         "skin": "olive", "hair": "short black"}
+        for i in range(1, size + 1)
+    ]
+    settings = [
+        {"id": i, "name": f"Place{i}", "description": f"a quiet harbour town number {i} at dusk"}
+        for i in range(1, size + 1)
+    ]
+    scenes = [
+        {"id": i, "emotional_tones": ["tense", "hopeful"],
+         "image_prompt": f"Character{i % size + 1} walks through Place{i % size + 1} looking for "
+                         f"Character{(i + 1) % size + 1}, the streets of Place{(i + 2) % size + 1} behind them."}
+        for i in range(1, 7)
+    ]
+    return {"persona_description": personas, "setting_description": settings, "scenes": scenes}
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark scene prompt expansion: per-name re.sub loop vs compiled PromptExpander."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="3,10,50,200",
+                            help="Comma-separated number of personas (and locations) per story")
+        parser.add_argument("--repeat", type=int, default=200,
+                            help="How many times each story's six scenes are expanded")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        repeat = options["repeat"]
+
+        self.stdout.write(f"{'entities':>8} {'legacy us/scene':>16} {'compiled us/scene':>18} {'build us':>9} {'speedup':>8}")
+        for size in sizes:
+            story = synthetic_story(size)
+            scenes = story["scenes"]
+            calls = repeat * len(scenes)
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for scene in scenes:
+                    legacy_expand(scene["image_prompt"], scene["emotional_tones"], story)
+            legacy = (time.perf_counter() - start) / calls
+
+            start = time.perf_counter()
+            expander = PromptExpander(story["persona_description"], story["setting_description"])
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for scene in scenes:
+                    expander.expand(scene["image_prompt"], scene["emotional_tones"])
+            compiled = (time.perf_counter() - start) / calls
+
+            self.stdout.write(
+                f"{size:>8} {legacy * 1e6:>16.1f} {compiled * 1e6:>18.1f} {build * 1e6:>9.1f} {legacy / compiled:>7.1f}x"
+            )
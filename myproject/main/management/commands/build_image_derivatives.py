@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from main.logic.derivatives import DERIVATIVE_WIDTHS, make_derivatives
+from main.logic.storage import get_storage
+
+
+class Command(BaseCommand):
+    help = "Write WebP (and optionally AVIF) derivatives for generated scene images that are missing them."
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        original_bytes = 0
+        derivative_bytes = 0
+        built = 0
+
+        derivative_suffixes = tuple(f"_{width}w" for width in DERIVATIVE_WIDTHS)
+        originals = [
+            (name, size) for name, size, _ in storage.listdir()
+            if not name.rsplit(".", 1)[0].endswith(derivative_suffixes)
+        ]
+
+        for name, size in sorted(originals):
+            written = make_derivatives(name, storage.read(name), storage=storage)
+            if not written:
+                continue
+            original_bytes += size
+            derivative_bytes += sum(len(storage.read(path)) for path in written)
+            built += 1
+
+        self.stdout.write(f"Built derivatives for {built} images")
+        if built:
+            self.stdout.write(
+                f"Originals: {original_bytes / 1e6:.1f} MB, new derivatives: {derivative_bytes / 1e6:.1f} MB"
+            )
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.logic.image_gc import collect_garbage, referenced_image_paths
+from main.logic.interaction_log import interaction_logger
+from main.logic.storage import get_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete or archive generated images that no story, job, session or "
+        "interaction log references and that are older than the grace period."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+        parser.add_argument("--grace-hours", type=float, default=24,
+                            help="Never remove files modified more recently than this (default 24)")
+        parser.add_argument("--archive", metavar="DIR", help="Move unreferenced files into DIR instead of deleting them")
+        parser.add_argument("--current-only", action="store_true",
+                            help="Only keep images of each story's current version, not its history; "
+                                 "interaction logs are ignored, finished story jobs still count")
+        parser.add_argument("--log-dir", default=str(interaction_logger.log_dir),
+                            help="Interaction log directory to scan for references (unused with --current-only)")
+        parser.add_argument("--every", type=float, metavar="SECONDS",
+                            help="Keep running, collecting garbage every SECONDS")
+
+    def handle(self, *args, **options):
+        while True:
+            self.collect(options)
+            if not options["every"]:
+                break
+            time.sleep(options["every"])
+
+    def collect(self, options):
+        referenced = referenced_image_paths(log_dir=options["log_dir"], current_only=options["current_only"])
+        report = collect_garbage(
+            get_storage(),
+            referenced,
+            grace_seconds=options["grace_hours"] * 3600,
+            dry_run=options["dry_run"],
+            archive_dir=options["archive"],
+        )
+
+        verb = "Would remove" if options["dry_run"] else ("Archived" if options["archive"] else "Removed")
+        if options["verbosity"] > 1:
+            for name in report["files"]:
+                self.stdout.write(f"  {name}")
+        self.stdout.write(
+            f"{verb} {report['removed']} of {report['scanned']} files, "
+            f"{report['bytes_reclaimed'] / 1e6:.1f} MB reclaimed"
+        )
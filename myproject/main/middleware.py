@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+
+from .logic.metrics import collect_request_spans, registry, server_timing
+
+
+class RequestTimingMiddleware:
+    """
+    Time every request and the pipeline stages it runs (see main.logic.metrics).
+
+    Request durations go to http_request_seconds{view,method,status}. With
+    SERVER_TIMING enabled the response also gets a Server-Timing header
+    summing each stage, which browser dev tools show under Timing.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'SERVER_TIMING', False)
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with collect_request_spans() as spans:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unresolved'
+        registry.observe('http_request_seconds', elapsed, view=view, method=request.method, status=response.status_code)
+        if self.server_timing:
+            response['Server-Timing'] = server_timing(spans, total=elapsed)
+        return response
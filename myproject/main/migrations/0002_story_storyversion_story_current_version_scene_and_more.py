@@ -0,0 +1,82 @@
+# Generated by Django 5.2.7 on 2026-10-18 16:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Story',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StoryVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('action', models.CharField(blank=True, max_length=32)),
+                ('storyline', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='main.story')),
+            ],
+            options={
+                'ordering': ['story', 'number'],
+            },
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='current_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.storyversion'),
+        ),
+        migrations.CreateModel(
+            name='Scene',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scene_id', models.PositiveIntegerField()),
+                ('image_prompt', models.TextField(blank=True)),
+                ('narration', models.TextField(blank=True)),
+                ('emotional_tones', models.JSONField(default=list)),
+                ('characters', models.JSONField(default=list)),
+                ('location', models.CharField(blank=True, max_length=200)),
+                ('image_path', models.CharField(blank=True, max_length=300)),
+                ('enhanced_prompt', models.TextField(blank=True)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scenes', to='main.storyversion')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Persona',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('persona_id', models.PositiveIntegerField()),
+                ('name', models.CharField(max_length=200)),
+                ('age', models.CharField(blank=True, max_length=100)),
+                ('clothing', models.TextField(blank=True)),
+                ('skin', models.CharField(blank=True, max_length=200)),
+                ('hair', models.CharField(blank=True, max_length=200)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='personas', to='main.storyversion')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location_id', models.PositiveIntegerField()),
+                ('name', models.CharField(max_length=200)),
+                ('description', models.TextField(blank=True)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='main.storyversion')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='storyversion',
+            constraint=models.UniqueConstraint(fields=('story', 'number'), name='unique_story_version_number'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 16:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_story_storyversion_story_current_version_scene_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,3 +1,180 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class StoryJob(models.Model):
+    """A story generation request running in the background."""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    idea = models.TextField()
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"StoryJob {self.id} ({self.status})"
+
+
+class Story(models.Model):
+    """A user's story; every edit adds a StoryVersion."""
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    current_version = models.ForeignKey(
+        'StoryVersion', null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    # Bumped when an edit starts; an edit whose number is stale is discarded
+    generation = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Story {self.id}"
+
+
+class StoryVersion(models.Model):
+    """One immutable snapshot of a story, with its personas, locations and scenes as rows."""
+
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    action = models.CharField(max_length=32, blank=True)
+    storyline = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['story', 'number']
+        constraints = [
+            models.UniqueConstraint(fields=['story', 'number'], name='unique_story_version_number'),
+        ]
+
+    def __str__(self):
+        return f"Story {self.story_id} v{self.number}"
+
+    @classmethod
+    def create_from_dict(cls, story, story_data, action=''):
+        """Snapshot a story dict (as returned by main.logic.ai) as the next version of story."""
+        last = story.versions.order_by('-number').values_list('number', flat=True).first() or 0
+        version = cls.objects.create(
+            story=story,
+            number=last + 1,
+            action=action,
+            storyline=story_data.get('storyline', ''),
+        )
+        Persona.objects.bulk_create([
+            Persona(
+                version=version,
+                persona_id=persona['id'],
+                name=persona.get('name', ''),
+                age=persona.get('age', ''),
+                clothing=persona.get('clothing', ''),
+                skin=persona.get('skin', ''),
+                hair=persona.get('hair', ''),
+            )
+            for persona in story_data.get('persona_description', [])
+        ])
+        Location.objects.bulk_create([
+            Location(
+                version=version,
+                location_id=location['id'],
+                name=location.get('name', ''),
+                description=location.get('description', ''),
+            )
+            for location in story_data.get('setting_description', [])
+        ])
+        Scene.objects.bulk_create([
+            Scene(
+                version=version,
+                scene_id=scene['id'],
+                image_prompt=scene.get('image_prompt', ''),
+                narration=scene.get('narration', ''),
+                emotional_tones=scene.get('emotional_tones', []),
+                characters=scene.get('characters', []),
+                location=scene.get('location', ''),
+                image_path=scene.get('image_path', ''),
+                enhanced_prompt=scene.get('enhanced_prompt', ''),
+            )
+            for scene in story_data.get('scenes', [])
+        ])
+        return version
+
+    def persona_list(self, *fields):
+        """Personas as dicts keyed like persona_description, limited to fields if given."""
+        return _rows_as_dicts(self.personas, 'persona_id', fields)
+
+    def location_list(self, *fields):
+        """Locations as dicts keyed like setting_description, limited to fields if given."""
+        return _rows_as_dicts(self.locations, 'location_id', fields)
+
+    def scene_list(self, *fields):
+        """Scenes as dicts keyed like scenes, limited to fields if given."""
+        return _rows_as_dicts(self.scenes, 'scene_id', fields)
+
+    def to_dict(self):
+        """The full story dict, in the shape main.logic.ai works with."""
+        return {
+            'storyline': self.storyline,
+            'persona_description': self.persona_list(),
+            'setting_description': self.location_list(),
+            'scenes': self.scene_list(),
+        }
+
+
+def _rows_as_dicts(related, id_field, fields):
+    columns = [id_field] + [f for f in fields if f != 'id'] if fields else []
+    rows = related.order_by(id_field).values(*columns)
+    result = []
+    for row in rows:
+        row.pop('id', None)
+        row.pop('version_id', None)
+        row['id'] = row.pop(id_field)
+        result.append(row)
+    return result
+
+
+class Persona(models.Model):
+    version = models.ForeignKey(StoryVersion, on_delete=models.CASCADE, related_name='personas')
+    persona_id = models.PositiveIntegerField()
+    name = models.CharField(max_length=200)
+    age = models.CharField(max_length=100, blank=True)
+    clothing = models.TextField(blank=True)
+    skin = models.CharField(max_length=200, blank=True)
+    hair = models.CharField(max_length=200, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Location(models.Model):
+    version = models.ForeignKey(StoryVersion, on_delete=models.CASCADE, related_name='locations')
+    location_id = models.PositiveIntegerField()
+    name = models.CharField(max_length=200)
+    description = models.TextField(blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Scene(models.Model):
+    version = models.ForeignKey(StoryVersion, on_delete=models.CASCADE, related_name='scenes')
+    scene_id = models.PositiveIntegerField()
+    image_prompt = models.TextField(blank=True)
+    narration = models.TextField(blank=True)
+    emotional_tones = models.JSONField(default=list)
+    characters = models.JSONField(default=list)
+    location = models.CharField(max_length=200, blank=True)
+    image_path = models.CharField(max_length=300, blank=True)
+    enhanced_prompt = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Scene {self.scene_id}"
@@ -0,0 +1,105 @@
+import functools
+import hashlib
+import json
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.template.loader import get_template
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+
+from .logic.metrics import registry
+from .logic.store import current_version
+
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 60)
+
+
+def version_hash(version):
+    """
+    Identify what a story page renders from: one immutable story version and
+    the state of its scene images. Images generated speculatively after an
+    edit are recorded on the saved version's scene rows as they land, so each
+    one changes the hash; pages of a version with images still pending are
+    cached too, and simply stop being served once the images arrive.
+    None without a version.
+    """
+    if version is None:
+        return None
+    images = list(version.scenes.order_by('scene_id').values_list('scene_id', 'image_path'))
+    source = json.dumps([version.story_id, version.id, version.number, version.created_at.isoformat(), images])
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def template_stamp(template_name):
+    """Modification time of a template, so editing or deploying one changes the page's ETag."""
+    origin = get_template(template_name).origin.name
+    try:
+        return str(os.stat(origin).st_mtime_ns)
+    except OSError:
+        return ''
+
+
+def fragment_context(request):
+    """
+    Context for {% cache fragment_timeout <name> page_version ... %} blocks in
+    a story_page view's template. Without a version hash the timeout is 0,
+    so nothing is stored under a key other stories would share.
+    """
+    version = getattr(request, 'page_version', None)
+    return {'page_version': version, 'fragment_timeout': PAGE_CACHE_TIMEOUT if version else 0}
+
+
+def story_page(template_name):
+    """
+    Serve a GET of a story page from the cache, or a 304 when the browser's
+    copy is current. Stories only change on POST, and every POST saves a new
+    version; the only other change is images landing on a version's scenes.
+    So the version hash is the whole page's cache key.
+
+    The view gets request.page_version to key template fragments on (see
+    fragment_context). Whole
+    responses are also keyed on the CSRF cookie: the cached HTML carries
+    form tokens only valid with that cookie.
+
+    Usage: @story_page('main/scene.html') above the view.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            request.page_version = None
+            if request.method not in ('GET', 'HEAD') or 'job' in request.GET:
+                return view(request, *args, **kwargs)
+            digest = version_hash(current_version(request))
+            if digest is None:
+                return view(request, *args, **kwargs)
+
+            page = view.__name__
+            tag = hashlib.sha256(f"{page}:{digest}:{template_stamp(template_name)}".encode("utf-8")).hexdigest()[:32]
+            etag = f'"{tag}"'
+            request.page_version = tag
+            if etag in parse_etags(request.headers.get('If-None-Match', '')):
+                registry.inc('page_cache_total', view=page, result='not_modified')
+                response = HttpResponseNotModified()
+            else:
+                csrf = request.META.get('CSRF_COOKIE')
+                key = f"page:{tag}:{hashlib.sha256(csrf.encode('utf-8')).hexdigest()[:16]}" if csrf else None
+                cached = cache.get(key) if key else None
+                if cached is not None:
+                    registry.inc('page_cache_total', view=page, result='hit')
+                    content, content_type = cached
+                    response = HttpResponse(content, content_type=content_type)
+                else:
+                    registry.inc('page_cache_total', view=page, result='miss')
+                    response = view(request, *args, **kwargs)
+                    if response.status_code != 200 or response.streaming:
+                        return response
+                    if key:
+                        cache.set(key, (response.content, response['Content-Type']), PAGE_CACHE_TIMEOUT)
+            response['ETag'] = etag
+            # Revalidate on every navigation; the ETag makes that a 304
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapped
+    return decorator
@@ -1,3 +1,989 @@
+import datetime
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from django.urls import reverse
+
+from .logic import ai, backends, derivatives
+from .logic.edits import merge_story_patch
+from .logic.linkify import linkify
+from .logic.image_cache import ImageCache
+from .logic.image_gc import collect_garbage
+from .logic.interaction_log import (
+    REMOVED_KEYS, InteractionLogger, apply_story_diff, iter_interactions, log_files, story_diff,
+)
+from .logic.ratelimit import RateLimiter, SharedRateLimiter
+from .logic.scheduler import VISIBLE, ImageScheduler
+from .logic.storage import IMMUTABLE_CACHE_CONTROL, LocalStorage, S3Storage, content_name
+from .logic.suggestions import SuggestionPool
+from .logic.text_cache import TextCache
+from .logic.store import SESSION_KEY, Superseded, begin_edit, current_version, save_story
+from .logic.jobs import STALE_JOB_ERROR, STORY_JOB_STALE_SECONDS
+from .models import Scene, StoryJob, StoryVersion
+from . import views
+from .management.commands import batch_generate
+
+
+def sample_story():
+    return {
+        'storyline': 'A baker opens a shop.',
+        'persona_description': [{'id': 1, 'name': 'Ana', 'description': 'A baker'}],
+        'setting_description': [{'id': 1, 'name': 'Old Mill', 'description': 'A mill'}],
+        'scenes': [
+            {'id': 1, 'narration': 'Ana bakes.', 'image_prompt': 'Ana at the oven', 'image_path': 'generated/1.png'},
+            {'id': 2, 'narration': 'The shop opens.', 'image_prompt': 'A shop front', 'image_path': 'generated/2.png'},
+        ],
+    }
+
+
+class MergeStoryPatchTests(TestCase):
+    def test_replaces_allowed_scene_fields_and_keeps_derived_ones(self):
+        story = sample_story()
+        patch = {'scenes': [{'id': 1, 'narration': 'Ana burns the bread.'}]}
+        merged = merge_story_patch(story, patch, scene_ids=[1])
+        self.assertEqual(merged['scenes'][0]['narration'], 'Ana burns the bread.')
+        self.assertEqual(merged['scenes'][0]['image_path'], 'generated/1.png')
+        # The original is left alone
+        self.assertEqual(story['scenes'][0]['narration'], 'Ana bakes.')
+
+    def test_ignores_items_the_edit_may_not_touch(self):
+        patch = {
+            'scenes': [{'id': 2, 'narration': 'Changed'}, {'id': 9, 'narration': 'New'}],
+            'persona_description': [{'id': 1, 'name': 'Bea', 'description': 'A thief'}],
+        }
+        merged = merge_story_patch(sample_story(), patch, scene_ids=[1], persona_ids=[])
+        self.assertEqual(merged['scenes'], sample_story()['scenes'])
+        self.assertEqual(merged['persona_description'], sample_story()['persona_description'])
+
+    def test_replaces_personas_and_locations_by_id(self):
+        patch = {
+            'persona_description': [{'id': 1, 'name': 'Bea', 'description': 'A thief'}],
+            'setting_description': [{'id': 1, 'name': 'Harbour', 'description': 'Docks'}],
+        }
+        merged = merge_story_patch(sample_story(), patch, scene_ids=[], persona_ids=[1])
+        self.assertEqual(merged['persona_description'][0]['name'], 'Bea')
+        self.assertEqual(merged['setting_description'][0]['name'], 'Harbour')
+
+    def test_storyline_only_replaced_when_given(self):
+        self.assertEqual(merge_story_patch(sample_story(), {}, scene_ids=[])['storyline'], 'A baker opens a shop.')
+        merged = merge_story_patch(sample_story(), {'storyline': 'A heist.'}, scene_ids=[])
+        self.assertEqual(merged['storyline'], 'A heist.')
+
+
+class StoryDiffTests(TestCase):
+    def assertRoundTrips(self, old, new):
+        self.assertEqual(apply_story_diff(old, story_diff(old, new)), new)
+
+    def test_only_changed_items_are_included(self):
+        old = sample_story()
+        new = sample_story()
+        new['scenes'][1]['narration'] = 'The shop closes.'
+        diff = story_diff(old, new)
+        self.assertEqual(diff, {'scenes': {'changed': [new['scenes'][1]], 'removed': [], 'order': [1, 2]}})
+        self.assertRoundTrips(old, new)
+
+    def test_removed_items_and_keys_round_trip(self):
+        old = sample_story()
+        old['title'] = 'Bread'
+        new = sample_story()
+        del new['storyline']
+        new['scenes'].pop(0)
+        new['persona_description'].append({'id': 2, 'name': 'Bea', 'description': 'A thief'})
+        diff = story_diff(old, new)
+        self.assertEqual(diff[REMOVED_KEYS], ['storyline', 'title'])
+        self.assertRoundTrips(old, new)
+
+    def test_added_none_value_round_trips(self):
+        old = sample_story()
+        new = {**sample_story(), 'title': None}
+        self.assertRoundTrips(old, new)
+
+
+class SharedRateLimiterTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "rate_limits.sqlite3"
+
+    def limiter(self, rate_per_minute=600, burst=2):
+        return SharedRateLimiter(self.path, "model", rate_per_minute, burst=burst)
+
+    def test_burst_then_paced(self):
+        limiter = self.limiter()
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.acquire()
+        # Two from the burst, then one every 0.1s
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_limiters_on_one_file_share_the_bucket(self):
+        first, second = self.limiter(), self.limiter()
+        self.assertEqual(first._take(True), 0)
+        self.assertEqual(second._take(True), 0)
+        self.assertGreater(first._take(True), 0)
+
+    def test_batch_waits_while_interactive_caller_waits(self):
+        limiter = self.limiter(burst=1)
+        self.assertEqual(limiter._take(False), 0)
+        interactive_wait = limiter._take(True)
+        self.assertGreater(interactive_wait, 0)
+        time.sleep(interactive_wait + 0.01)
+        # The refilled token is held for the interactive caller
+        self.assertGreater(limiter._take(False), 0)
+        self.assertEqual(limiter._take(True), 0)
+
+    def test_penalize_blocks_every_limiter_then_starts_empty(self):
+        first, second = self.limiter(60), self.limiter(60)
+        first.penalize(0.2)
+        self.assertGreater(second._take(False), 0.1)
+        self.assertGreater(second._take(True), 0.1)
+        time.sleep(0.21)
+        # Nothing accrued during the block, so the bucket is empty when it lifts
+        self.assertGreater(second._take(True), 0.5)
+
+
+class ImageSchedulerTests(TestCase):
+    def setUp(self):
+        # One worker, kept busy so the jobs under test stay queued
+        self.scheduler = ImageScheduler(1)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        started = threading.Event()
+
+        def block():
+            started.set()
+            self.release.wait(5)
+        self.blocker = self.scheduler.submit("blocker", block)
+        started.wait(5)
+
+    def test_same_key_runs_once(self):
+        calls = []
+        first = self.scheduler.submit("a", lambda: calls.append(1) or "image-a", group="story-1")
+        second = self.scheduler.submit("a", lambda: calls.append(2) or "other", group="story-2")
+        self.assertIs(first, second)
+        self.release.set()
+        self.assertEqual(first.result(5), "image-a")
+        self.assertEqual(calls, [1])
+
+    def test_higher_priority_runs_first(self):
+        order = []
+        self.scheduler.submit("later", lambda: order.append("later"))
+        self.scheduler.submit("sooner", lambda: order.append("sooner"))
+        # Asking again at a higher priority moves the queued job up
+        last = self.scheduler.submit("sooner", lambda: order.append("again"), priority=VISIBLE)
+        self.release.set()
+        last.result(5)
+        self.scheduler.submit("later", lambda: None).result(5)
+        self.assertEqual(order, ["sooner", "later"])
+
+    def test_supersede_cancels_only_jobs_nobody_else_wants(self):
+        dropped = self.scheduler.submit("dropped", lambda: "x", group="story-1")
+        shared = self.scheduler.submit("shared", lambda: "y", group="story-1")
+        self.scheduler.submit("shared", lambda: "y", group="story-2")
+        kept = self.scheduler.submit("kept", lambda: "z", group="story-1")
+
+        self.assertEqual(self.scheduler.supersede("story-1", keep_keys={"kept"}), 1)
+        self.assertTrue(dropped.cancelled())
+        self.release.set()
+        self.assertEqual(shared.result(5), "y")
+        self.assertEqual(kept.result(5), "z")
+        self.assertEqual(self.scheduler.pending(), 0)
+
+    def test_running_jobs_are_not_cancelled(self):
+        self.scheduler.supersede(None, keep_keys=set())
+        self.assertFalse(self.blocker.cancelled())
+
+
+class EditSupersessionTests(TestCase):
+    def setUp(self):
+        self.request = SimpleNamespace(session={})
+        save_story(self.request, sample_story(), 'story_generate', new_story=True)
+
+    def test_no_story_no_edit(self):
+        self.assertIsNone(begin_edit(SimpleNamespace(session={})))
+
+    def test_only_the_latest_edit_is_saved(self):
+        first = begin_edit(self.request)
+        second = begin_edit(self.request)
+        self.assertFalse(first.is_current())
+
+        older = {**sample_story(), 'storyline': 'Older edit'}
+        with self.assertRaises(Superseded):
+            save_story(self.request, older, 'storyline_regenerate', token=first)
+        self.assertEqual(current_version(self.request).storyline, 'A baker opens a shop.')
+
+        newer = {**sample_story(), 'storyline': 'Newer edit'}
+        save_story(self.request, newer, 'storyline_regenerate', token=second)
+        self.assertEqual(current_version(self.request).storyline, 'Newer edit')
+        story_id = self.request.session[SESSION_KEY]
+        self.assertEqual(StoryVersion.objects.filter(story_id=story_id).count(), 2)
+
+
+class StoryPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        story = {**sample_story(), 'scenes': [{**scene, 'image_path': ''} for scene in sample_story()['scenes']]}
+        request = SimpleNamespace(session={})
+        self.version = save_story(request, story, 'story_generate', new_story=True)
+        session = self.client.session
+        session[SESSION_KEY] = request.session[SESSION_KEY]
+        session.save()
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.client.get(reverse('personas'))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(reverse('personas'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_landing_image_changes_the_etag(self):
+        etag = self.client.get(reverse('personas'))['ETag']
+        Scene.objects.filter(version=self.version, scene_id=1).update(image_path='generated/1.png')
+        response = self.client.get(reverse('personas'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_new_version_changes_the_etag(self):
+        etag = self.client.get(reverse('personas'))['ETag']
+        request = SimpleNamespace(session={SESSION_KEY: self.version.story_id})
+        save_story(request, {**sample_story(), 'storyline': 'A heist.'}, 'storyline_regenerate')
+        response = self.client.get(reverse('personas'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class ImageCacheTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+
+    def test_hit_and_miss(self):
+        images = ImageCache(self.root)
+        key = ImageCache.make_key("model", "16:9", "A mill at dusk")
+        self.assertIsNone(images.get(key))
+        images.put(key, b"png")
+        self.assertEqual(images.get(key).read_bytes(), b"png")
+        self.assertEqual(images.stats()["hits"], 1)
+        self.assertEqual(images.stats()["misses"], 1)
+
+    def test_evicts_least_recently_used(self):
+        images = ImageCache(self.root, max_entries=2)
+        images.put("a", b"1")
+        images.put("b", b"2")
+        images.get("a")
+        images.put("c", b"3")
+        self.assertIsNone(images.get("b"))
+        self.assertIsNotNone(images.get("a"))
+        self.assertIsNotNone(images.get("c"))
+
+    def test_processes_share_the_index(self):
+        first, second = ImageCache(self.root), ImageCache(self.root)
+        first.put("a", b"1")
+        second.put("b", b"2")
+        # Neither put lost the other's entry, and a fresh reader sees both
+        self.assertEqual(set(ImageCache(self.root).entries), {"a", "b"})
+        self.assertIsNotNone(second.get("a"))
+
+    def test_put_sweeps_unindexed_files(self):
+        images = ImageCache(self.root)
+        (self.root / "orphan").write_bytes(b"left by a crash")
+        images.put("a", b"1")
+        self.assertEqual(sorted(path.name for path in self.root.iterdir()), [".lock", "a", "index.json"])
+
+
+class CollectGarbageTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.storage = LocalStorage(tmp.name)
+
+    def save_old(self, data, age=2 * 24 * 3600):
+        name = self.storage.save(content_name(data), data)
+        old = time.time() - age
+        os.utime(self.storage.path(name), (old, old))
+        return name
+
+    def test_removes_old_unreferenced_files(self):
+        kept = self.save_old(b"\x89PNG kept")
+        dropped = self.save_old(b"\x89PNG dropped")
+        fresh = self.storage.save(content_name(b"\x89PNG fresh"), b"\x89PNG fresh")
+        report = collect_garbage(self.storage, {kept}, grace_seconds=24 * 3600)
+        self.assertEqual(report['files'], [dropped])
+        self.assertTrue(self.storage.exists(kept))
+        self.assertTrue(self.storage.exists(fresh))
+        self.assertFalse(self.storage.exists(dropped))
+
+    def test_saving_again_protects_an_old_file(self):
+        data = b"\x89PNG reused"
+        name = self.save_old(data)
+        # e.g. an image cache hit, before any scene row points at it
+        self.assertEqual(self.storage.save(content_name(data), data), name)
+        report = collect_garbage(self.storage, set(), grace_seconds=24 * 3600)
+        self.assertEqual(report['removed'], 0)
+        self.assertTrue(self.storage.exists(name))
+
+
+def png_bytes(width=512, height=288):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 120, 40)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class DerivativeTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.storage = LocalStorage(tmp.name)
+        patcher = mock.patch.object(derivatives, "get_storage", return_value=self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        derivatives._lookups.clear()
+        self.addCleanup(derivatives._lookups.clear)
+        self.data = png_bytes()
+        self.name = self.storage.save(content_name(self.data), self.data)
+
+    def test_writes_each_width_up_to_the_original(self):
+        written = derivatives.make_derivatives(self.name, self.data)
+        self.assertEqual(len(written), 3)
+        self.assertEqual([width for _, width in derivatives.available_derivatives(self.name)["webp"]], [256, 384, 512])
+        # All there: nothing to write the second time
+        self.assertEqual(derivatives.make_derivatives(self.name, self.data), [])
+
+    def test_collected_derivatives_are_written_again(self):
+        written = derivatives.make_derivatives(self.name, self.data)
+        for name in written:
+            self.storage.delete(name)
+        # The lookup cache still lists them, but storage decides
+        self.assertEqual(sorted(derivatives.make_derivatives(self.name, self.data)), sorted(written))
+        self.assertTrue(all(self.storage.exists(name) for name in written))
+
+    def test_complete_lookups_expire(self):
+        written = derivatives.make_derivatives(self.name, self.data)
+        for name in written:
+            self.storage.delete(name)
+        with mock.patch.object(derivatives, "DERIVATIVE_LOOKUP_TTL", 0):
+            self.assertEqual(derivatives.available_derivatives(self.name), {})
+
+
+class FakeClientError(Exception):
+    pass
+
+
+class FakeS3Client:
+    """In-memory stand-in for the few boto3 S3 client calls S3Storage makes."""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(("head_object", Key))
+        if Key not in self.objects:
+            raise FakeClientError("404")
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append(("put_object", Key))
+        self.objects[Key] = {"Body": Body, **kwargs}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.calls.append(("copy_object", Key))
+        if CopySource["Key"] not in self.objects:
+            raise FakeClientError("404")
+        self.objects[Key] = {**self.objects[CopySource["Key"]], **kwargs}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key]["Body"])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                modified = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+                yield {"Contents": [
+                    {"Key": key, "Size": len(obj["Body"]), "LastModified": modified}
+                    for key, obj in sorted(client.objects.items()) if key.startswith(Prefix)
+                ]}
+        return Paginator()
+
+
+class S3StorageTests(TestCase):
+    def setUp(self):
+        self.client = FakeS3Client()
+        boto3 = SimpleNamespace(client=lambda service, endpoint_url=None: self.client)
+        botocore = SimpleNamespace(exceptions=SimpleNamespace(ClientError=FakeClientError))
+        modules = {"boto3": boto3, "botocore": botocore, "botocore.exceptions": botocore.exceptions}
+        patcher = mock.patch.dict(sys.modules, modules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = S3Storage("bucket", "https://cdn.example.com/")
+
+    def test_save_uploads_once_with_immutable_cache_control(self):
+        data = b"\x89PNG scene"
+        name = content_name(data)
+        self.assertEqual(self.storage.save(name, data), name)
+        self.assertEqual(self.storage.save(name, data), name)
+        self.assertEqual([call for call in self.client.calls if call[0] == "put_object"], [("put_object", name)])
+        uploaded = self.client.objects[name]
+        self.assertEqual(uploaded["CacheControl"], IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(uploaded["ContentType"], "image/png")
+        self.assertEqual(self.storage.read(name), data)
+        self.assertEqual(self.storage.url(name), f"https://cdn.example.com/{name}")
+
+    def test_exists_listdir_and_delete(self):
+        name = self.storage.save(content_name(b"\x89PNG a"), b"\x89PNG a")
+        self.assertTrue(self.storage.exists(name))
+        self.assertFalse(self.storage.exists(content_name(b"\x89PNG b")))
+        self.assertEqual([(key, size) for key, size, _ in self.storage.listdir()], [(name, len(b"\x89PNG a"))])
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        self.assertEqual(list(self.storage.listdir()), [])
+
+    def test_saving_an_existing_object_refreshes_it(self):
+        data = b"\x89PNG reused"
+        name = content_name(data)
+        self.client.put_object(Bucket="bucket", Key=name, Body=data)
+        self.storage.save(name, data)
+        self.assertIn(("copy_object", name), self.client.calls)
+        self.assertEqual(self.client.objects[name]["CacheControl"], IMMUTABLE_CACHE_CONTROL)
+
+    def test_missing_boto3_is_a_clear_error(self):
+        with mock.patch.dict(sys.modules, {"boto3": None}):
+            with self.assertRaises(ImproperlyConfigured):
+                S3Storage("bucket", "https://cdn.example.com")
+
+
+class GeneratedImageViewTests(TestCase):
+    def test_served_with_immutable_cache_control(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = LocalStorage(root)
+            data = png_bytes(8, 8)
+            name = storage.save(content_name(data), data)
+            with mock.patch("main.views.get_storage", return_value=storage):
+                url = storage.url(name)
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Cache-Control'], IMMUTABLE_CACHE_CONTROL)
+                self.assertEqual(b"".join(response.streaming_content), data)
+                response.close()
+                self.assertEqual(self.client.get(storage.url(content_name(b"\x89PNG gone"))).status_code, 404)
+
+
+class CachedImageTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name)
+        self.images = ImageCache(root / "image_cache")
+        self.storage = LocalStorage(root / "storage")
+        for target, name, value in (
+            (ai, "image_cache", self.images),
+            (ai, "get_storage", lambda: self.storage),
+            (ai, "image_rate_limiter", RateLimiter(0)),
+            (derivatives, "get_storage", lambda: self.storage),
+            (backends, "_backend", backends.FakeBackend()),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_blob_evicted_between_lookup_and_read_is_regenerated(self):
+        key = ImageCache.make_key(ai.IMAGE_MODEL, ai.IMAGE_ASPECT_RATIO, "A mill at dusk")
+        self.images.put(key, png_bytes(8, 8))
+        evicted = self.images.root / "evicted-by-another-process"
+        with mock.patch.object(self.images, "get", return_value=evicted):
+            self.assertIsNone(ai.read_cached_image(key))
+            image_path = ai.generate_image_for_prompt("A mill at dusk", scene_id=1)
+        self.assertNotEqual(image_path, ai.FALLBACK_IMAGE)
+        self.assertTrue(self.storage.exists(image_path))
+
+
+class TextSlotTests(TestCase):
+    def test_slot_released_when_the_limiter_fails(self):
+        class BrokenLimiter:
+            def acquire(self):
+                raise sqlite3.OperationalError("database is locked")
+
+        with mock.patch.object(ai, "text_slots", threading.BoundedSemaphore(1)), \
+                mock.patch.dict(ai.model_rate_limiters, {"model": BrokenLimiter()}):
+            for _ in range(2):
+                with self.assertRaises(sqlite3.OperationalError):
+                    with ai.text_slot("model"):
+                        pass
+            self.assertTrue(ai.text_slots.acquire(blocking=False))
+
+
+class CountingBackend(backends.FakeBackend):
+    def __init__(self):
+        super().__init__()
+        self.text_calls = 0
+
+    def generate_text(self, model, prompt, schema=None):
+        self.text_calls += 1
+        return super().generate_text(model, prompt, schema)
+
+
+class TextCachePolicyTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.texts = TextCache(tmp.name)
+        self.backend = CountingBackend()
+        for patcher in (
+            mock.patch.object(ai, "TEXT_CACHE_ENABLED", True),
+            mock.patch.object(ai, "text_cache", self.texts),
+            mock.patch.object(backends, "_backend", self.backend),
+            # Keep the shared quota file out of it
+            mock.patch.dict(ai.model_rate_limiters, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_unseeded_story_generation_always_calls_the_model(self):
+        for _ in range(2):
+            ai.generate_text("A lighthouse keeper", "storyGenerate")
+        self.assertEqual(self.backend.text_calls, 2)
+        self.assertEqual(self.texts.entries, {})
+
+    def test_seeded_story_generation_is_reused(self):
+        first = ai.generate_text("A lighthouse keeper", "storyGenerate", seed=7)
+        second = ai.generate_text("A  lighthouse\nkeeper", "storyGenerate", seed=7)
+        self.assertEqual(first, second)
+        self.assertEqual(self.backend.text_calls, 1)
+        ai.generate_text("A lighthouse keeper", "storyGenerate", seed=8)
+        self.assertEqual(self.backend.text_calls, 2)
+
+    def test_zero_ttl_never_stores(self):
+        with mock.patch.dict(ai.TEXT_CACHE_POLICIES, {'narrationGenerate': {'ttl': 0, 'seeded_only': False}}):
+            for _ in range(2):
+                ai.generate_text("Narrate scene 1", "narrationGenerate")
+        self.assertEqual(self.backend.text_calls, 2)
+        self.assertEqual(list(self.texts.root.glob("*.txt")), [])
+
+    def test_ttl_overrides(self):
+        policies = {'narrationGenerate': {'ttl': 900, 'seeded_only': False}}
+        ai.apply_text_cache_ttls(policies, "narrationGenerate=0, newCall = 60,")
+        self.assertEqual(policies, {
+            'narrationGenerate': {'ttl': 0, 'seeded_only': False},
+            'newCall': {'ttl': 60, 'seeded_only': False},
+        })
+
+
+class StoryJobStatusTests(TestCase):
+    def setUp(self):
+        # Adoption logs the story; keep it out of the real log directory
+        patcher = mock.patch("main.views.save_interaction_log")
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def status(self, job):
+        return self.client.get(reverse('story_job_status', args=[job.id])).json()
+
+    def test_stale_running_job_is_marked_failed(self):
+        job = StoryJob.objects.create(idea="A lighthouse keeper", status=StoryJob.RUNNING)
+        lost = timezone.now() - datetime.timedelta(seconds=STORY_JOB_STALE_SECONDS + 1)
+        StoryJob.objects.filter(id=job.id).update(updated_at=lost)
+
+        response = self.status(job)
+        self.assertEqual(response['status'], StoryJob.FAILED)
+        self.assertEqual(response['error'], STALE_JOB_ERROR)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (StoryJob.FAILED, STALE_JOB_ERROR))
+
+    def test_running_job_with_a_heartbeat_is_left_alone(self):
+        job = StoryJob.objects.create(idea="A lighthouse keeper", status=StoryJob.RUNNING)
+        self.assertEqual(self.status(job)['status'], StoryJob.RUNNING)
+
+    def test_done_job_is_adopted_once(self):
+        job = StoryJob.objects.create(idea="A lighthouse keeper", status=StoryJob.DONE, result=sample_story())
+        session = self.client.session
+        session['story_job_id'] = str(job.id)
+        session.save()
+
+        with mock.patch("main.views.save_story", wraps=save_story) as save:
+            first = self.status(job)
+            second = self.status(job)
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(self.log.call_count, 1)
+        self.assertEqual(first['redirect'], reverse('video'))
+        self.assertEqual(second['redirect'], reverse('video'))
+        self.assertNotIn('story_job_id', self.client.session)
+        self.assertEqual(StoryVersion.objects.count(), 1)
+
+
+def parse_events(chunks):
+    """(event, data) pairs from story_events output, skipping keep-alives and the retry hint."""
+    events = []
+    for chunk in chunks:
+        if chunk.startswith("event: "):
+            event_line, data_line = chunk.strip().split("\n")
+            events.append((event_line[len("event: "):], json.loads(data_line[len("data: "):])))
+    return events
+
+
+@mock.patch.object(views, "STREAM_POLL_SECONDS", 0)
+@mock.patch.object(views, "available_derivatives", lambda image_path: {})
+class StoryEventsTests(TestCase):
+    def test_story_then_scenes_then_done(self):
+        story = sample_story()
+        job = StoryJob.objects.create(idea="A baker", status=StoryJob.RUNNING, result=story)
+        polls = []
+
+        def finish_on_second_poll(seconds):
+            polls.append(seconds)
+            if len(polls) == 1:
+                # Scene 1's image is unchanged; scene 2 gets a new one
+                story['scenes'][1]['image_path'] = 'generated/2b.png'
+                StoryJob.objects.filter(id=job.id).update(result=story, status=StoryJob.DONE)
+
+        with mock.patch.object(views.time, "sleep", finish_on_second_poll):
+            events = parse_events(views.story_events(job.id))
+
+        self.assertEqual([event for event, _ in events], ['story', 'scene', 'scene', 'scene', 'done'])
+        self.assertEqual([scene['id'] for scene in events[0][1]['scenes']], [1, 2])
+        self.assertEqual([(data['id'], data['image_url']) for event, data in events if event == 'scene'], [
+            (1, views.image_url('generated/1.png')),
+            (2, views.image_url('generated/2.png')),
+            (2, views.image_url('generated/2b.png')),
+        ])
+
+    def test_missing_job_fails(self):
+        self.assertEqual(parse_events(views.story_events(uuid.uuid4())), [('failed', {'error': 'Story job not found'})])
+
+    def test_stale_job_fails(self):
+        job = StoryJob.objects.create(idea="A baker", status=StoryJob.RUNNING)
+        lost = timezone.now() - datetime.timedelta(seconds=STORY_JOB_STALE_SECONDS + 1)
+        StoryJob.objects.filter(id=job.id).update(updated_at=lost)
+        self.assertEqual(parse_events(views.story_events(job.id)), [('failed', {'error': STALE_JOB_ERROR})])
+
+    def test_stream_ends_at_the_timeout(self):
+        job = StoryJob.objects.create(idea="A baker", status=StoryJob.RUNNING)
+        with mock.patch.object(views, "STREAM_TIMEOUT_SECONDS", 0):
+            chunks = list(views.story_events(job.id))
+        self.assertEqual(chunks, [f"retry: {views.STREAM_RETRY_MS}\n\n"])
+
+
+class BackendTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.recordings = Path(tmp.name)
+
+    def test_fake_story_is_deterministic_and_consistent(self):
+        fake = backends.FakeBackend()
+        text = fake.generate_text("model", "A lighthouse keeper", ai.story_schema)
+        self.assertEqual(text, backends.FakeBackend().generate_text("model", "A lighthouse keeper", ai.story_schema))
+        story = json.loads(text)
+        names = {persona['name'] for persona in story['persona_description']}
+        places = {location['name'] for location in story['setting_description']}
+        for scene in story['scenes']:
+            self.assertLessEqual(set(scene['characters']), names)
+            self.assertIn(scene['location'], places)
+
+    def test_fake_quota_is_rate_limited(self):
+        fake = backends.FakeBackend(quota_rpm=1)
+        fake.generate_text("model", "one")
+        with self.assertRaises(backends.RateLimited) as raised:
+            fake.generate_text("model", "two")
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    def test_record_then_replay(self):
+        recorder = backends.RecordingBackend(backends.FakeBackend(), self.recordings)
+        story = recorder.generate_text("model", "A lighthouse keeper", ai.story_schema)
+        narration = recorder.generate_text("model", "Narrate scene 1")
+        image = recorder.generate_image("image-model", "A lighthouse at night", "16:9")
+
+        replay = backends.ReplayBackend(self.recordings)
+        self.assertEqual(replay.generate_text("model", "A lighthouse keeper", ai.story_schema), story)
+        self.assertEqual(replay.generate_text("model", "Narrate scene 1"), narration)
+        self.assertEqual(replay.generate_image("image-model", "A lighthouse at night", "16:9"), image)
+        # The schema is part of what was recorded
+        with self.assertRaises(backends.BackendError):
+            replay.generate_text("model", "A lighthouse keeper")
+
+    def test_replay_of_unrecorded_prompt(self):
+        replay = backends.ReplayBackend(self.recordings)
+        with self.assertRaisesRegex(backends.BackendError, "No recorded model response"):
+            replay.generate_text("model", "Never recorded")
+        with self.assertRaisesRegex(backends.BackendError, "No recorded image-model image"):
+            replay.generate_image("image-model", "Never recorded", "16:9")
+
+        fallback = backends.ReplayBackend(self.recordings, fallback=backends.FakeBackend())
+        self.assertEqual(
+            fallback.generate_text("model", "Never recorded"),
+            backends.FakeBackend().generate_text("model", "Never recorded"),
+        )
+
+
+class ModelRoutingTests(TestCase):
+    def test_each_operation_uses_its_tier(self):
+        for call, tier in ai.OPERATION_TIERS.items():
+            self.assertEqual(ai.route_model(call), (tier, ai.MODEL_TIERS[tier]))
+        self.assertEqual(ai.route_model('narrationGenerate')[0], 'fast')
+        self.assertEqual(ai.route_model('storyGenerate')[0], 'pro')
+
+    def test_tier_models_are_read_at_call_time(self):
+        with mock.patch.dict(ai.MODEL_TIERS, {'fast': 'models/custom-flash'}):
+            self.assertEqual(ai.route_model('narrationGenerate'), ('fast', 'models/custom-flash'))
+
+    def test_overrides(self):
+        tiers = {'narrationGenerate': 'fast', 'PromptGenerate': 'pro'}
+        ai.apply_tier_overrides(tiers, "narrationGenerate=pro, PromptGenerate = fast,")
+        self.assertEqual(tiers, {'narrationGenerate': 'pro', 'PromptGenerate': 'fast'})
+
+    def test_unknown_tier_or_operation_fails(self):
+        with self.assertRaisesRegex(ValueError, "Unknown model tier 'turbo'"):
+            ai.apply_tier_overrides({'narrationGenerate': 'fast'}, "narrationGenerate=turbo")
+        with self.assertRaisesRegex(ValueError, "Unknown operation 'narationGenerate'"):
+            ai.apply_tier_overrides({'narrationGenerate': 'fast'}, "narationGenerate=pro")
+        with self.assertRaises(ValueError):
+            ai.route_model('unlistedGenerate')
+
+
+def legacy_linkify(text, story_data):
+    """The template filter linkify replaced: one re.sub per name, locations first."""
+    placeholders = {}
+
+    def placeholder(match, href, css_class):
+        key = f"___PLACEHOLDER_{len(placeholders)}___"
+        placeholders[key] = f'<a href="{href}" class="{css_class}">{match.group(0)}</a>'
+        return key
+
+    groups = (
+        ('setting_description', '/locations/?location={}', 'text-success fw-bold'),
+        ('persona_description', '/personas/?character={}', 'text-primary fw-bold'),
+    )
+    for field, href, css_class in groups:
+        for name in sorted((item['name'] for item in story_data.get(field, [])), key=len, reverse=True):
+            text = re.sub(
+                r'\b' + re.escape(name) + r'\b',
+                lambda m: placeholder(m, href.format(name), css_class),
+                text, flags=re.IGNORECASE,
+            )
+    for key, html in placeholders.items():
+        text = text.replace(key, html)
+    return text
+
+
+def names_story(personas, locations):
+    return {
+        'persona_description': [{'id': i, 'name': name} for i, name in enumerate(personas, 1)],
+        'setting_description': [{'id': i, 'name': name} for i, name in enumerate(locations, 1)],
+    }
+
+
+class LinkifyTests(TestCase):
+    def test_matches_the_old_filter(self):
+        cases = [
+            (names_story(['Ana', 'Anabel'], ['Old Mill', 'Old Mill Road']),
+             "Anabel and ana walk down Old Mill Road to the old mill. Banana."),
+            (names_story(['Mr. Smith', 'C++ Bot'], ['St. Mary (North)']),
+             "Mr. Smith asks the C++ Bot about St. Mary (North) bells. Mr Smith shrugs."),
+            (names_story(['Harbour'], ['Harbour']), "At the harbour, Harbour waits."),
+            (names_story(['Ana'], []), "No names here."),
+        ]
+        for story, text in cases:
+            with self.subTest(text=text):
+                self.assertEqual(linkify(text, story), legacy_linkify(text, story))
+
+    def test_longest_name_wins(self):
+        html = linkify("Old Mill Road, then Old Mill", names_story([], ['Old Mill', 'Old Mill Road']))
+        self.assertEqual(html, (
+            '<a href="/locations/?location=Old Mill Road" class="text-success fw-bold">Old Mill Road</a>, then '
+            '<a href="/locations/?location=Old Mill" class="text-success fw-bold">Old Mill</a>'
+        ))
+
+    def test_names_inside_words_are_not_linked(self):
+        self.assertEqual(linkify("Banana bread", names_story(['Ana'], [])), "Banana bread")
+
+    def test_regex_metacharacters_are_literal(self):
+        story = names_story(['A.B'], [])
+        self.assertEqual(linkify("AxB", story), "AxB")
+        self.assertIn('>A.B</a>', linkify("Meet A.B today", story))
+
+    def test_text_and_names_are_escaped(self):
+        story = names_story(['Tom & Jerry'], [])
+        html = linkify('<script>x</script> "Tom & Jerry" arrive', story)
+        self.assertEqual(html, (
+            '&lt;script&gt;x&lt;/script&gt; &quot;'
+            '<a href="/personas/?character=Tom &amp; Jerry" class="text-primary fw-bold">Tom &amp; Jerry</a>'
+            '&quot; arrive'
+        ))
+        # Already safe text is not escaped twice
+        self.assertEqual(linkify(mark_safe("<b>Tom</b>"), names_story(['Tom'], [])),
+                         '<b><a href="/personas/?character=Tom" class="text-primary fw-bold">Tom</a></b>')
+
+
+class BatchResumeTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name)
+        self.output = root / "batch"
+        self.ideas = root / "ideas.txt"
+        self.ideas.write_text("A robot learns to paint\nA lighthouse keeper\nA heist at the museum\n")
+        storage = LocalStorage(root / "storage")
+        # configure_limits swaps these for the batch; put them back afterwards
+        for patcher in (
+            mock.patch.object(ai, "text_slots", None),
+            mock.patch.object(ai, "image_scheduler", ai.image_scheduler),
+            mock.patch.object(ai, "image_rate_limiter", RateLimiter(0)),
+            mock.patch.dict(ai.model_rate_limiters, {model: RateLimiter(0) for model in ai.model_rate_limiters}),
+            mock.patch.object(ai, "image_cache", ImageCache(root / "image_cache")),
+            mock.patch.object(ai, "get_storage", lambda: storage),
+            mock.patch.object(derivatives, "get_storage", lambda: storage),
+            mock.patch.object(batch_generate, "get_storage", lambda: storage),
+            mock.patch.object(backends, "_backend", backends.FakeBackend()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.story_calls = []
+        self.story_generate = ai.storyGenerate
+
+    def run_batch(self, interrupt_on=None):
+        def story_generate(idea, **kwargs):
+            self.story_calls.append(idea)
+            if len(self.story_calls) == interrupt_on:
+                raise KeyboardInterrupt
+            return self.story_generate(idea, **kwargs)
+
+        with mock.patch.object(ai, "storyGenerate", story_generate):
+            call_command(
+                "batch_generate", str(self.ideas), output=str(self.output),
+                workers=1, text_concurrency=1, image_concurrency=1, stdout=io.StringIO(), stderr=io.StringIO(),
+            )
+
+    def checkpoint(self):
+        return json.loads((self.output / "checkpoint.json").read_text())
+
+    def test_resume_skips_finished_ideas(self):
+        # One worker takes the ideas in order, so nothing else is in flight at the last one
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_batch(interrupt_on=3)
+        states = {entry['idea']: entry['state'] for entry in self.checkpoint().values()}
+        self.assertEqual(states, {"A robot learns to paint": batch_generate.DONE, "A lighthouse keeper": batch_generate.DONE})
+
+        self.story_calls.clear()
+        with mock.patch.object(batch_generate, "atomic_write", wraps=batch_generate.atomic_write) as write:
+            self.run_batch()
+        self.assertEqual(self.story_calls, ["A heist at the museum"])
+        self.assertEqual({entry['state'] for entry in self.checkpoint().values()}, {batch_generate.DONE})
+        # Every checkpoint write went through atomic_write and left no temp files
+        self.assertIn(self.output / "checkpoint.json", [call.args[0] for call in write.call_args_list])
+        self.assertEqual(list(self.output.glob(".*.tmp")), [])
+        for entry_dir in self.output.iterdir():
+            if entry_dir.is_dir():
+                bundle = json.loads((entry_dir / "story.json").read_text())
+                self.assertTrue(all(scene['bundle_image'] for scene in bundle['story']['scenes']))
+
+    def test_saved_text_is_not_generated_again(self):
+        key = batch_generate.idea_key(1, "A robot learns to paint")
+        (self.output / key).mkdir(parents=True)
+        story = json.loads(backends.FakeBackend().generate_text("model", "robot", ai.story_schema))
+        batch_generate.write_json(self.output / key / "story.json", {"key": key, "idea": "A robot learns to paint", "story": story})
+        batch_generate.write_json(self.output / "checkpoint.json", {key: {"state": batch_generate.TEXT, "idea": "A robot learns to paint"}})
+
+        self.run_batch()
+        self.assertNotIn("A robot learns to paint", self.story_calls)
+        self.assertEqual(self.checkpoint()[key]['state'], batch_generate.DONE)
+
+
+class SuggestionPoolTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "suggestion_pool.json"
+
+    def test_pools_sharing_a_file_never_hand_out_an_idea_twice(self):
+        pools = [SuggestionPool(self.path, low_watermark=0), SuggestionPool(self.path, low_watermark=0)]
+        pools[0]._add([f"idea {i}" for i in range(40)])
+        taken = []
+
+        def take(pool):
+            for _ in range(2):
+                taken.extend(pool.take(4))
+
+        with mock.patch("main.logic.suggestions.suggestionGenerate") as generate:
+            threads = [threading.Thread(target=take, args=(pools[i % 2],)) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        generate.assert_not_called()
+        self.assertEqual(sorted(taken), sorted(f"idea {i}" for i in range(40)))
+
+    def test_refill_runs_off_the_request_thread(self):
+        pool = SuggestionPool(self.path, low_watermark=10, target_size=20)
+        pool._add([f"idea {i}" for i in range(12)])
+        release = threading.Event()
+        callers = []
+
+        def generate():
+            callers.append(threading.current_thread())
+            release.wait(5)
+            return {'suggestions': [f"fresh {len(callers)}.{i}" for i in range(4)]}
+
+        with mock.patch("main.logic.suggestions.suggestionGenerate", generate):
+            # Below the watermark afterwards, but served without waiting for the model
+            self.assertEqual(pool.take(4), ["idea 0", "idea 1", "idea 2", "idea 3"])
+            self.assertTrue(pool.refilling.is_set())
+            release.set()
+            deadline = time.monotonic() + 5
+            while pool.refilling.is_set() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertNotIn(threading.current_thread(), callers)
+        self.assertGreaterEqual(len(pool._read()), 20)
+
+
+class InteractionLogRotationTests(TestCase):
+    def test_loggers_sharing_a_dir_rotate_without_losing_entries(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        loggers = [InteractionLogger(tmp.name, max_bytes=2000) for _ in range(2)]
+
+        def write(n):
+            logger = loggers[n % 2]
+            for i in range(40):
+                logger.queue.put({
+                    'action_type': 'edit', 'user_input': '', 'story_id': n,
+                    'story': {'storyline': f"{n}-{i}", 'scenes': [{'id': 1, 'narration': 'x' * 50}]},
+                })
+                logger.flush()
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
 
-# Create your tests here.
+        files = log_files(tmp.name)
+        self.assertGreater(len(files), 2)
+        # Every rotated file was compressed before the next rotation could start
+        self.assertTrue(all(path.suffix == '.gz' for path in files[:-1]))
+        storylines = sorted(entry['story']['storyline'] for entry in iter_interactions(tmp.name))
+        self.assertEqual(storylines, sorted(f"{n}-{i}" for n in range(4) for i in range(40)))
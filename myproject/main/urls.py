@@ -3,9 +3,13 @@ from . import views
 
 urlpatterns = [
     path('', views.idea, name='idea'),
+    path('story/<uuid:job_id>/status/', views.story_job_status, name='story_job_status'),
+    path('story/<uuid:job_id>/stream/', views.story_stream, name='story_stream'),
     path('personas/', views.personas, name='personas'),
     path('locations/', views.locations, name='locations'),
     path('scene/', views.scene, name='scene'),
     path('video/', views.video, name='video'),
     path('draft/', views.draft, name='draft'),
+    path('metrics', views.metrics, name='metrics'),
+    path('images/generated/<path:name>', views.generated_image, name='generated_image'),
 ]
@@ -1,63 +1,185 @@
-from django.shortcuts import render, redirect
-from .logic.ai import suggestionGenerate, characterGenerate, storyGenerate, locationGenerate, storylineGenerate, narrationGenerate, PromptGenerate
+from django.shortcuts import render as django_render, redirect, get_object_or_404
+from .logic.ai import characterGenerate, locationGenerate, storylineGenerate, narrationGenerate, PromptGenerate, ensure_scene_images, cancel_superseded_images
 import logging
 import json
-from datetime import datetime
-from pathlib import Path
 logger = logging.getLogger(__name__)
 from django.urls import reverse
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 import time
+from .models import StoryJob
+from .logic.jobs import STALE_JOB_ERROR, fail_if_stale, submit_story_job
+from .logic.store import SESSION_KEY as STORY_SESSION_KEY, Superseded, begin_edit, current_version, load_story, save_story, story_group, update_scene_images
+from .logic.interaction_log import interaction_logger
+from .logic.suggestions import suggestion_pool
+from .logic.derivatives import available_derivatives
+from .logic.storage import GENERATED_PREFIX, IMMUTABLE_CACHE_CONTROL, LocalStorage, get_storage, image_url
+from .logic.metrics import registry, span
+from .page_cache import fragment_context, story_page
+from django.http import Http404, HttpResponse
+from django.views.static import serve
 
-from datetime import datetime
 
-def save_interaction_log(user_input, output_data, images, action_type):
-    """Save each interaction to local storage."""
-    log_dir = Path("user_logs")
-    log_dir.mkdir(exist_ok=True)
-    
-    timestamp = datetime.now().isoformat()
-    log_entry = {
-        'timestamp': timestamp,
-        'action_type': action_type,
-        'user_input': user_input,
-        'output_data': output_data,
-        'images': images
-    }
-    
-    log_file = log_dir / f"interaction_{timestamp.replace(':', '-')}.json"
-    with open(log_file, 'w') as f:
-        json.dump(log_entry, f, indent=2)
-    
-    logger.info(f"Saved interaction log: {log_file}")
+def render(request, template_name, context=None):
+    with span("template_render", template=template_name):
+        return django_render(request, template_name, context)
+
+def metrics(request):
+    """Stage timings, token and retry counts for this process, in Prometheus text format."""
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def generated_image(request, name):
+    """
+    A generated image from local storage. Names are content hashes, so a
+    changed image always has a new URL and browsers may keep this one forever.
+    """
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        raise Http404("Generated images are served by the storage backend")
+    response = serve(request, name, document_root=storage.path(GENERATED_PREFIX))
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+def save_interaction_log(user_input, output_data, action_type, story_id=None):
+    """Queue each interaction for the background log writer."""
+    interaction_logger.log(action_type, user_input, output_data, story_id=story_id)
 
 def idea(request):
     if request.method == 'GET' and request.headers.get('x-requested-with') == 'XMLHttpRequest':
-        result = suggestionGenerate()
-        return JsonResponse(result)
+        # Served from the pre-generated pool; refilled in the background
+        return JsonResponse({'suggestions': suggestion_pool.take(4)})
     if request.method == 'POST':
         idea_text = request.POST.get('story_prompt', '')
         
-        # Generate FULL story directly from the raw idea
-        full_story = storyGenerate(idea_text)
-        
-        # Store complete story in session
-        request.session['story'] = full_story
-        request.session.modified = True
-        save_interaction_log(
-                user_input=idea_text,
-                output_data=full_story,
-                images=[s.get('image_path') for s in full_story.get('scenes', [])],
-                action_type='storyline_regenerate'
-            )
-        return redirect('video')
+        # Generate FULL story from the raw idea in the background
+        job = submit_story_job(idea_text)
+        request.session['story_job_id'] = str(job.id)
+        return redirect(f"{reverse('video')}?job={job.id}")
     
     return render(request, 'main/idea.html')
 
+STREAM_POLL_SECONDS = 0.5
+# A stream holds a worker, so it ends after this long and the browser's
+# EventSource reconnects after STREAM_RETRY_MS, resuming where it left off
+STREAM_TIMEOUT_SECONDS = 60
+STREAM_RETRY_MS = 1000
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def story_events(job_id):
+    """Yield SSE events for a story job: the text once, then each scene image as it lands."""
+    sent_story = False
+    sent_images = {}
+    deadline = time.monotonic() + STREAM_TIMEOUT_SECONDS
+    yield f"retry: {STREAM_RETRY_MS}\n\n"
+
+    while time.monotonic() < deadline:
+        job = StoryJob.objects.filter(id=job_id).values('status', 'result', 'error', 'updated_at').first()
+        if job is None:
+            yield sse_event('failed', {'error': 'Story job not found'})
+            return
+        if fail_if_stale(job_id, job['status'], job['updated_at']):
+            yield sse_event('failed', {'error': STALE_JOB_ERROR})
+            return
+
+        story = job['result'] or {}
+        if story.get('scenes') and not sent_story:
+            yield sse_event('story', {
+                'storyline': story.get('storyline', ''),
+                'scenes': [{'id': s['id'], 'narration': s.get('narration', '')} for s in story['scenes']],
+            })
+            sent_story = True
+
+        for scene in story.get('scenes', []):
+            image_path = scene.get('image_path')
+            if image_path and sent_images.get(scene['id']) != image_path:
+                webp = available_derivatives(image_path).get('webp', [])
+                yield sse_event('scene', {
+                    'id': scene['id'],
+                    'image_url': image_url(image_path),
+                    'srcset': ", ".join(f"{image_url(name)} {width}w" for name, width in webp),
+                })
+                sent_images[scene['id']] = image_path
+
+        if job['status'] == StoryJob.DONE:
+            yield sse_event('done', {'status_url': reverse('story_job_status', args=[job_id])})
+            return
+        if job['status'] == StoryJob.FAILED:
+            yield sse_event('failed', {'error': job['error']})
+            return
+
+        # Keep the connection alive through proxies while the models work
+        yield ": waiting\n\n"
+        time.sleep(STREAM_POLL_SECONDS)
+
+def story_stream(request, job_id):
+    get_object_or_404(StoryJob, id=job_id)
+    response = StreamingHttpResponse(story_events(job_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def story_job_status(request, job_id):
+    job = get_object_or_404(StoryJob, id=job_id)
+    if fail_if_stale(job.id, job.status, job.updated_at):
+        job.refresh_from_db()
+    response = {'id': str(job.id), 'status': job.status}
+
+    if job.status == StoryJob.DONE:
+        # Adopt the finished story into this user's session exactly once
+        if request.session.get('story_job_id') == str(job.id):
+            full_story = job.result
+            save_story(request, full_story, 'story_generate', new_story=True)
+            del request.session['story_job_id']
+            save_interaction_log(
+                user_input=job.idea,
+                output_data=full_story,
+                action_type='storyline_regenerate',
+                story_id=request.session.get(STORY_SESSION_KEY)
+            )
+        response['redirect'] = reverse('video')
+    elif job.status == StoryJob.FAILED:
+        response['error'] = job.error
+        response['redirect'] = reverse('idea')
+
+    return JsonResponse(response)
+
+def linkify_data(version):
+    """Just the persona and location names the linkify filter needs."""
+    return {
+        'persona_description': version.persona_list('name'),
+        'setting_description': version.location_list('name'),
+    }
+
+def start_edit(request):
+    """
+    Begin an edit of the user's story. Any earlier edit still running is
+    superseded: its queued images are dropped and its result won't be saved.
+    """
+    token = begin_edit(request)
+    if token is not None:
+        version = current_version(request)
+        pending = version.scenes.filter(image_path='').values_list('enhanced_prompt', flat=True) if version else []
+        cancel_superseded_images(token.group, pending)
+    return token
+
+def scenes_with_images(request, version, *fields, visible_ids=()):
+    """
+    Scenes of version with their images, waiting for any still being
+    generated speculatively (visible_ids first) and recording them.
+    """
+    scenes = version.scene_list('image_path', *fields)
+    if all(scene['image_path'] for scene in scenes):
+        return scenes
+    scenes = version.scene_list('image_path', 'enhanced_prompt', *fields)
+    filled = ensure_scene_images(scenes, visible_ids=visible_ids, group=story_group(request))
+    update_scene_images(version, filled)
+    return scenes
+
 def draft(request):
-    story = request.session.get('story', {})
+    version = current_version(request)
     
-    if not story:
+    if version is None:
         return redirect('idea')
     
     if request.method == 'POST':
@@ -65,23 +187,27 @@ def draft(request):
         
         if action == 'regenerate':
             feedback = request.POST.get('feedback')
+            token = start_edit(request)
             
-            updated_story = storylineGenerate(story, feedback)
-            save_interaction_log(
-                user_input=feedback,
-                output_data=updated_story,
-                images=[s.get('image_path') for s in updated_story.get('scenes', [])],
-                action_type='storyline_regenerate'
-            )
-            request.session['story'] = updated_story
-            request.session.modified = True
-            story = updated_story
-            logger.warning(f"Storyline regenerated with full story update")
+            try:
+                # Only the storyline shows here, so images render while the user reads it
+                updated_story = storylineGenerate(version.to_dict(), feedback, token=token, wait_for_images=False)
+                version = save_story(request, updated_story, 'storyline_regenerate', token=token)
+                save_interaction_log(
+                    user_input=feedback,
+                    output_data=updated_story,
+                    action_type='storyline_regenerate',
+                    story_id=request.session.get(STORY_SESSION_KEY)
+                )
+                logger.warning(f"Storyline regenerated with full story update")
+            except Superseded:
+                logger.info("Discarded storyline edit superseded by a newer one")
+                version = current_version(request)
             
         elif action == 'next':
             return redirect('personas')
     
-    scenes = story.get("scenes", [])
+    scenes = version.scene_list('emotional_tones')
 
     emotional_tones = list({
         tone
@@ -90,120 +216,139 @@ def draft(request):
     })
     return render(request, 'main/draft.html', {
     'draft': {
-        'storyline': story.get('storyline', ''),
+        'storyline': version.storyline,
         'emotional_tones': emotional_tones
     },
-    'story_data': story  # <-- full story so filter can access characters & locations
+    'story_data': linkify_data(version)  # <-- names so filter can access characters & locations
     })
 
+@story_page('main/personas.html')
 def personas(request):
-    story_data = request.session.get('story', {})
-    
     if request.method == 'POST':
         action = request.POST.get('action')
         
         if action == 'regenerate':
             persona_id = int(request.POST.get('persona_id'))
             feedback = request.POST.get('feedback')
+            token = start_edit(request)
             
-            updated_story = characterGenerate(story_data, persona_id, feedback)
-            
-            save_interaction_log(
-                user_input=feedback,
-                output_data=updated_story,
-                images=[s.get('image_path') for s in updated_story.get('scenes', [])],
-                action_type='persona_regenerate'
-            )
-            request.session['story'] = updated_story
-            request.session.modified = True
-            story_data = updated_story 
-            print("DEBUG updated_story:", updated_story)
+            try:
+                updated_story = characterGenerate(load_story(request), persona_id, feedback, token=token)
+                save_story(request, updated_story, 'persona_regenerate', token=token)
+                save_interaction_log(
+                    user_input=feedback,
+                    output_data=updated_story,
+                    action_type='persona_regenerate',
+                    story_id=request.session.get(STORY_SESSION_KEY)
+                )
+                logger.debug(f"Updated story: {updated_story}")
+            except Superseded:
+                logger.info(f"Discarded persona {persona_id} edit superseded by a newer one")
         return redirect(f"{reverse('personas')}?slide={persona_id}")
     
+    version = current_version(request)
     return render(request, 'main/personas.html', {
-        'persona_description': story_data.get('persona_description', []),
+        'persona_description': version.persona_list() if version else [],
     })
 
 
 
+@story_page('main/locations.html')
 def locations(request):
-    story_data = request.session.get('story', {})
-    
     if request.method == 'POST':
         action = request.POST.get('action')
         
         if action == 'regenerate':
             location_id = int(request.POST.get('location_id'))
             feedback = request.POST.get('feedback')
+            token = start_edit(request)
             
-            updated_story = locationGenerate(story_data, location_id, feedback)
-            save_interaction_log(
-                user_input=feedback,
-                output_data=updated_story,
-                images=[s.get('image_path') for s in updated_story.get('scenes', [])],
-                action_type='location_regenerate'
-            )
-            request.session['story'] = updated_story
-            request.session.modified = True
-            print("DEBUG updated_story:", updated_story)
-            story_data = updated_story
+            try:
+                updated_story = locationGenerate(load_story(request), location_id, feedback, token=token)
+                save_story(request, updated_story, 'location_regenerate', token=token)
+                save_interaction_log(
+                    user_input=feedback,
+                    output_data=updated_story,
+                    action_type='location_regenerate',
+                    story_id=request.session.get(STORY_SESSION_KEY)
+                )
+                logger.debug(f"Updated story: {updated_story}")
+            except Superseded:
+                logger.info(f"Discarded location {location_id} edit superseded by a newer one")
         return redirect(f"{reverse('locations')}?slide={location_id}")
     
+    version = current_version(request)
     return render(request, 'main/locations.html', {
-        'setting_description': story_data.get('setting_description', []),
+        'setting_description': version.location_list() if version else [],
     })
 
 
+@story_page('main/scene.html')
 def scene(request):
-    story_data = request.session.get('story', {})
-    
     if request.method == 'POST':
         action = request.POST.get('action')
         scene_id = int(request.POST.get('scene_id'))
+        token = start_edit(request)
+        story_data = load_story(request)
         
-        if action == 'regenerate_narration':
-            feedback = request.POST.get('narration_feedback')
-            from main.logic.ai import narrationGenerate
-            updated_narration = narrationGenerate(story_data, scene_id, feedback)
-            save_interaction_log(
-                user_input=feedback,
-                output_data=updated_story,
-                images=[s.get('image_path') for s in updated_story.get('scenes', [])],
-                action_type='narration_regenerate'
-            )
-            for scene in story_data['scenes']:
-                if scene['id'] == scene_id:
-                    scene['narration'] = updated_narration
-                    break
-            
-            request.session['story'] = story_data
-            request.session.modified = True
-            logger.warning(f"Narration updated for scene {scene_id}")
-            
-        elif action == 'regenerate_image':
-            feedback = request.POST.get('image_prompt_feedback')
-            updated_story = PromptGenerate(story_data, scene_id, feedback)
-            save_interaction_log(
-                user_input=feedback,
-                output_data=updated_story,
-                images=[s.get('image_path') for s in updated_story.get('scenes', [])],
-                action_type='image_regenerate'
-            )
-            request.session['story'] = updated_story
-            request.session.modified = True
-            story_data = updated_story
-            logger.warning(f"Full story regenerated from scene {scene_id} image prompt edit")
+        try:
+            if action == 'regenerate_narration':
+                feedback = request.POST.get('narration_feedback')
+                updated_narration = narrationGenerate(story_data, scene_id, feedback)
+                for scene in story_data['scenes']:
+                    if scene['id'] == scene_id:
+                        scene['narration'] = updated_narration
+                        break
+                save_story(request, story_data, 'narration_regenerate', token=token)
+                save_interaction_log(
+                    user_input=feedback,
+                    output_data=story_data,
+                    action_type='narration_regenerate',
+                    story_id=request.session.get(STORY_SESSION_KEY)
+                )
+                logger.warning(f"Narration updated for scene {scene_id}")
+                
+            elif action == 'regenerate_image':
+                feedback = request.POST.get('image_prompt_feedback')
+                updated_story = PromptGenerate(story_data, scene_id, feedback, token=token)
+                save_story(request, updated_story, 'image_regenerate', token=token)
+                save_interaction_log(
+                    user_input=feedback,
+                    output_data=updated_story,
+                    action_type='image_regenerate',
+                    story_id=request.session.get(STORY_SESSION_KEY)
+                )
+                logger.warning(f"Full story regenerated from scene {scene_id} image prompt edit")
+        except Superseded:
+            logger.info(f"Discarded scene {scene_id} edit superseded by a newer one")
         return redirect(f"{reverse('scene')}?slide={scene_id}")
     
+    version = current_version(request)
+    if version is None:
+        return render(request, 'main/scene.html', {'scenes': [], 'story_data': {}, **fragment_context(request)})
+    # The carousel opens on ?slide=<scene id>, so that image is needed first
+    slide = request.GET.get('slide', '1')
+    slide = int(slide) if slide.isdigit() else 1
     return render(request, 'main/scene.html', {
-        'scenes': story_data.get('scenes', []),
-        'story_data': story_data
+        'scenes': scenes_with_images(request, version, 'image_prompt', 'narration', 'emotional_tones', visible_ids=[slide]),
+        'story_data': linkify_data(version),
+        **fragment_context(request),
     })
 
+@story_page('main/video.html')
 def video(request):
-    story_data = request.session.get('story', {})
+    job_id = request.GET.get('job')
+
+    # A story still being generated is streamed into the page tile by tile
+    if job_id and request.session.get('story_job_id') == job_id:
+        return render(request, 'main/video.html', {
+            'scenes': [],
+            'job_id': job_id,
+            **fragment_context(request),
+        })
     
+    version = current_version(request)
     return render(request, 'main/video.html', {
-        'scenes': story_data.get('scenes', []),
-        'story_data': story_data
+        'scenes': scenes_with_images(request, version, 'narration') if version else [],
+        **fragment_context(request),
     })
\ No newline at end of file
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,9 +78,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Story jobs write from background threads; wait for the lock instead of failing
+        'OPTIONS': {
+            'timeout': 20,
+            # Take the write lock when a transaction starts: a read lock can't be
+            # upgraded while another writer holds the database, and that fails
+            # straight away instead of waiting for the timeout
+            'transaction_mode': 'IMMEDIATE',
+        },
+    }
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Rendered story pages and fragments (see main.page_cache), keyed on story
+# versions so they never need invalidating. Per process; a shared
+# FileBasedCache or Redis lets every worker reuse one render.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'story-pages',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 2000},
     }
 }
 
+# Seconds a rendered story page or fragment stays cached
+PAGE_CACHE_TIMEOUT = 60 * 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -121,3 +149,8 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Add a Server-Timing header with per-stage durations to every response
+# (see main.middleware.RequestTimingMiddleware). Stage names reveal a little
+# about the backend, so it is on for development only by default.
+SERVER_TIMING = DEBUG